@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import socket
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Client"))
+from Framing import encode_frame
+from ClientMessageParser import ClientMessageParser
+from LoadGenerator import start_server, stop_server
+
+"""
+Measures the memory the server uses per idle connection.
+
+Starts Server.py, opens a number of connections that stay idle (optionally logged
+in), and reports how much the resident memory (VmRSS) of the server grew, per
+connection:
+    python ConnectionMemory.py --connections 5000 --server-args "--mode async"
+"""
+
+
+def get_resident_memory(pid):
+    # VmRSS of the process, in bytes
+    with open('/proc/' + str(pid) + '/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def wait_until_stable(pid, timeout=10.0):
+    # The server may still be handling the last connections
+    deadline = time.time() + timeout
+    memory = get_resident_memory(pid)
+    while time.time() < deadline:
+        time.sleep(0.5)
+        new_memory = get_resident_memory(pid)
+        if new_memory == memory:
+            break
+        memory = new_memory
+    return memory
+
+
+def open_connections(server_address, count, log_in):
+    connections = []
+    for number in range(count):
+        connection = socket.create_connection(server_address)
+        if log_in:
+            login = ClientMessageParser.encode_request_to_json('login', 'idle%05d' % number)
+            connection.sendall(encode_frame(login))
+        connections.append(connection)
+    return connections
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Measures the server memory per idle connection")
+    argument_parser.add_argument('--host', default='localhost')
+    argument_parser.add_argument('--port', type=int, default=10005)
+    argument_parser.add_argument('--connections', type=int, default=2000)
+    argument_parser.add_argument('--login', action='store_true',
+                                 help="log in every connection (the server then also sends each of them the "
+                                      "login response, a resume token and the history. They do not "
+                                      "subscribe to presence, so they get no presence deltas)")
+    argument_parser.add_argument('--server-args', default='', help="arguments for Server.py, e.g. \"--mode async\"")
+    arguments = argument_parser.parse_args()
+
+    server_address = (arguments.host, arguments.port)
+    server = start_server(arguments.server_args, server_address)
+    try:
+        memory_before = wait_until_stable(server.pid)
+        connections = open_connections(server_address, arguments.connections, arguments.login)
+        memory_after = wait_until_stable(server.pid)
+        print "Connections:        " + str(len(connections))
+        print "Server memory:      %.1f MB -> %.1f MB" % (memory_before / 1048576.0, memory_after / 1048576.0)
+        print "Per connection:     %.0f bytes" % (float(memory_after - memory_before) / len(connections))
+    finally:
+        stop_server(server)
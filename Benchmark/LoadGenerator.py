@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import argparse
+import json
+import os
+import resource
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Client"))
+from SimulatedClient import SimulatedClient
+from BinaryEncoding import ENCODINGS, JSON
+from Framing import COMPRESSIONS, NO_COMPRESSION
+
+"""
+Load generator and latency benchmark for the chat server.
+
+Simulates a large number of clients from a single asyncore event loop, and runs
+them through the following phases:
+
+    connect     clients connect (at most connect_rate per second) and log in
+    names       every client sends 'names' names_requests times, one at a time
+    messages    the first sender_count clients send message_count messages each,
+                one every message_interval seconds, to the default room
+    drain       waits until every logged in client has received every message
+    logout      every client logs out
+
+and reports the connect rate, the request and broadcast throughput, and latency
+percentiles. All clients are in the default room, so every message is delivered to
+every client.
+
+Run it against a running server on localhost:
+    python LoadGenerator.py --clients 1000
+
+or let it start (and stop) the server, e.g. in CI:
+    python LoadGenerator.py --start-server --server-args "--mode async" --max-p99-latency 500
+
+The exit code is 1 if a client failed, a message was lost, or a latency limit was
+exceeded, so a regression fails the run.
+"""
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server", "Server.py")
+
+
+def percentile(sorted_values, percent):
+    # Nearest-rank percentile of a sorted list
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def summarize_latencies(latencies):
+    # Latencies in seconds, summarized in milliseconds
+    latencies = sorted(latencies)
+    summary = {'count': len(latencies)}
+    if latencies:
+        for percent in PERCENTILES:
+            summary['p' + str(percent)] = percentile(latencies, percent) * 1000.0
+        summary['max'] = latencies[-1] * 1000.0
+        summary['mean'] = sum(latencies) / len(latencies) * 1000.0
+    return summary
+
+
+class LoadGenerator:
+
+    def __init__(self, server_address, client_count=1000, connect_rate=500, names_requests=1,
+                 sender_count=10, message_count=20, message_interval=0.1, message_size=100,
+                 drain_timeout=30.0, encoding=JSON, compression=NO_COMPRESSION):
+        self.server_address = server_address
+        self.client_count = client_count
+        self.connect_rate = connect_rate
+        self.names_requests = names_requests
+        self.sender_count = min(sender_count, client_count)
+        self.message_count = message_count
+        self.message_interval = message_interval
+        self.message_size = message_size
+        self.drain_timeout = drain_timeout
+        # Encoding the clients ask for at login, see BinaryEncoding.py
+        self.encoding = encoding
+        # Compression the clients ask for at login, see Framing.py
+        self.compression = compression
+
+        self.socket_map = {}
+        self.clients = []
+
+        # Latencies in seconds
+        self.connect_latencies = []
+        self.login_latencies = []
+        self.names_latencies = []
+        self.delivery_latencies = []
+        self.errors = []
+        # Bytes received by all clients, as sent by the server (compressed or not)
+        self.received_bytes = 0
+        # The connect rate is measured from the first connect to the last established connection
+        self.first_connect_time = None
+        self.last_connect_time = None
+
+        # Start and end time of every phase
+        self.phase_times = {}
+
+    """
+        Called by the simulated clients
+    """
+
+    def record_connect(self, start_time, end_time):
+        self.connect_latencies.append(end_time - start_time)
+        if self.first_connect_time is None:
+            self.first_connect_time = start_time
+        self.last_connect_time = end_time
+
+    def record_login(self, latency):
+        self.login_latencies.append(latency)
+
+    def record_names(self, latency):
+        self.names_latencies.append(latency)
+
+    def record_delivery(self, latency):
+        self.delivery_latencies.append(latency)
+
+    def record_received(self, byte_count):
+        self.received_bytes += byte_count
+
+    def record_error(self, error):
+        self.errors.append(error)
+
+    """
+        Phases
+    """
+
+    def run(self):
+        self.raise_file_limit()
+        self.run_phase('connect', self.connect_clients)
+        self.run_phase('names', self.request_names)
+        self.run_phase('messages', self.send_messages)
+        self.run_phase('drain', self.wait_for_deliveries)
+        self.run_phase('logout', self.logout_clients)
+        asyncore.close_all(map=self.socket_map)
+
+    def run_phase(self, name, phase):
+        start_time = time.time()
+        phase()
+        self.phase_times[name] = (start_time, time.time())
+
+    def poll(self, timeout=0.01):
+        asyncore.loop(timeout=timeout, use_poll=True, map=self.socket_map, count=1)
+
+    def active_clients(self):
+        return [client for client in self.clients if client.logged_in and not client.is_done()]
+
+    def connect_clients(self):
+        start_time = time.time()
+        while len(self.clients) < self.client_count:
+            # Clients are opened at connect_rate, and the event loop runs in between
+            due = self.client_count
+            if self.connect_rate:
+                due = min(int((time.time() - start_time) * self.connect_rate) + 1, self.client_count)
+            while len(self.clients) < due:
+                try:
+                    self.clients.append(SimulatedClient(self, len(self.clients), self.server_address))
+                except socket.error as error:
+                    self.record_error("connect: " + str(error))
+                    self.client_count = len(self.clients)
+            self.poll(0.001)
+        self.poll_until(lambda: all(client.logged_in or client.is_done() for client in self.clients),
+                        self.drain_timeout)
+
+    def request_names(self):
+        if not self.names_requests:
+            return
+        for client in self.active_clients():
+            client.send_names()
+
+        def names_done():
+            done = True
+            for client in self.active_clients():
+                if client.names_responses + len(client.names_sent_times) < self.names_requests \
+                        and not client.names_sent_times:
+                    client.send_names()
+                if client.names_responses < self.names_requests:
+                    done = False
+            return done
+        self.poll_until(names_done, self.drain_timeout)
+
+    def send_messages(self):
+        senders = self.active_clients()[:self.sender_count]
+        # The senders are spread evenly over the message interval
+        start_time = time.time()
+        for message_number in range(self.message_count):
+            for sender_number, sender in enumerate(senders):
+                send_time = start_time + (message_number + float(sender_number) / len(senders)) * \
+                    self.message_interval
+                while time.time() < send_time:
+                    self.poll(min(max(send_time - time.time(), 0), 0.01))
+                if not sender.is_done():
+                    sender.send_message(self.message_size)
+
+    def expected_deliveries(self):
+        messages_sent = sum(client.messages_sent for client in self.clients)
+        return messages_sent * len(self.active_clients())
+
+    def wait_for_deliveries(self):
+        self.poll_until(lambda: len(self.delivery_latencies) >= self.expected_deliveries(), self.drain_timeout)
+
+    def logout_clients(self):
+        for client in self.active_clients():
+            client.send_logout()
+        self.poll_until(lambda: all(client.is_done() or not client.logged_in for client in self.clients),
+                        self.drain_timeout)
+
+    def poll_until(self, condition, timeout):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.poll()
+
+    @staticmethod
+    def raise_file_limit():
+        # Every simulated client uses a file descriptor
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit < hard_limit:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    """
+        Results
+    """
+
+    def phase_duration(self, name):
+        start_time, end_time = self.phase_times.get(name, (0, 0))
+        return max(end_time - start_time, 1e-9)
+
+    def get_results(self):
+        messages_sent = sum(client.messages_sent for client in self.clients)
+        delivery_duration = self.phase_duration('messages') + self.phase_duration('drain')
+        connect_duration = 1e-9
+        if self.first_connect_time is not None:
+            connect_duration = max(self.last_connect_time - self.first_connect_time, connect_duration)
+        return \
+            {
+                'clients': self.client_count,
+                'connected': len(self.connect_latencies),
+                'logged_in': len(self.login_latencies),
+                'connects_per_second': len(self.connect_latencies) / connect_duration,
+                'names_per_second': len(self.names_latencies) / self.phase_duration('names'),
+                'messages_sent': messages_sent,
+                'messages_sent_per_second': messages_sent / self.phase_duration('messages'),
+                'deliveries': len(self.delivery_latencies),
+                'expected_deliveries': messages_sent * len(self.login_latencies),
+                'deliveries_per_second': len(self.delivery_latencies) / delivery_duration,
+                'received_bytes': self.received_bytes,
+                'connect_latency_ms': summarize_latencies(self.connect_latencies),
+                'login_latency_ms': summarize_latencies(self.login_latencies),
+                'names_latency_ms': summarize_latencies(self.names_latencies),
+                'broadcast_latency_ms': summarize_latencies(self.delivery_latencies),
+                'errors': len(self.errors),
+                'first_errors': self.errors[:10]
+            }
+
+
+def print_results(results):
+    print "Clients:            " + str(results['connected']) + " connected, " + \
+        str(results['logged_in']) + " logged in (of " + str(results['clients']) + ")"
+    print "Connect rate:       %.1f connections/s" % results['connects_per_second']
+    print "Names requests:     %.1f requests/s" % results['names_per_second']
+    print "Messages sent:      %d (%.1f messages/s)" % (results['messages_sent'], results['messages_sent_per_second'])
+    print "Deliveries:         %d of %d (%.1f messages/s)" % \
+        (results['deliveries'], results['expected_deliveries'], results['deliveries_per_second'])
+    print "Bytes received:     %d" % results['received_bytes']
+    for name in ['connect_latency_ms', 'login_latency_ms', 'names_latency_ms', 'broadcast_latency_ms']:
+        summary = results[name]
+        line = (name[:-len('_latency_ms')] + " latency:").ljust(20)
+        if summary['count'] == 0:
+            print line + "no samples"
+            continue
+        line += ", ".join("p%s %.2f ms" % (percent, summary['p' + str(percent)]) for percent in PERCENTILES)
+        print line + ", max %.2f ms" % summary['max']
+    print "Errors:             " + str(results['errors'])
+    for error in results['first_errors']:
+        print "    " + error
+
+
+def check_results(results, max_p99_latency):
+    # Returns a list of the reasons why the run failed
+    failures = []
+    if results['errors']:
+        failures.append(str(results['errors']) + " client errors")
+    if results['logged_in'] < results['clients']:
+        failures.append(str(results['clients'] - results['logged_in']) + " clients did not log in")
+    if results['deliveries'] < results['expected_deliveries']:
+        failures.append(str(results['expected_deliveries'] - results['deliveries']) + " messages were not delivered")
+    p99 = results['broadcast_latency_ms'].get('p99')
+    if max_p99_latency and p99 is not None and p99 > max_p99_latency:
+        failures.append("broadcast p99 latency %.2f ms exceeds %.2f ms" % (p99, max_p99_latency))
+    return failures
+
+
+def start_server(server_args, server_address, timeout=10.0):
+    # Starts Server.py, and waits until it accepts connections
+    server = subprocess.Popen([sys.executable, SERVER_PATH] + shlex.split(server_args),
+                              cwd=os.path.dirname(SERVER_PATH), stdout=open(os.devnull, 'w'))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(server_address, 1.0).close()
+            return server
+        except socket.error:
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+    stop_server(server)
+    raise RuntimeError("The server did not start.")
+
+
+def stop_server(server):
+    if server.poll() is None:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Load generator and latency benchmark for the chat server")
+    argument_parser.add_argument('--host', default='localhost')
+    argument_parser.add_argument('--port', type=int, default=10005)
+    argument_parser.add_argument('--clients', type=int, default=1000, help="number of simulated clients")
+    argument_parser.add_argument('--connect-rate', type=int, default=500,
+                                 help="max new connections per second (0: as fast as possible)")
+    argument_parser.add_argument('--names-requests', type=int, default=1,
+                                 help="number of 'names' requests sent by every client")
+    argument_parser.add_argument('--senders', type=int, default=10, help="number of clients sending messages")
+    argument_parser.add_argument('--messages', type=int, default=20, help="number of messages sent by every sender")
+    argument_parser.add_argument('--message-interval', type=float, default=0.1, metavar='SECONDS',
+                                 help="time between the messages of a sender")
+    argument_parser.add_argument('--message-size', type=int, default=100, metavar='BYTES',
+                                 help="size of the content of a message")
+    argument_parser.add_argument('--timeout', type=float, default=30.0, metavar='SECONDS',
+                                 help="max time to wait for logins, responses and deliveries in every phase")
+    argument_parser.add_argument('--max-p99-latency', type=float, default=0, metavar='MS',
+                                 help="fail if the p99 broadcast latency is higher (0: no limit)")
+    argument_parser.add_argument('--start-server', action='store_true',
+                                 help="start Server.py for the run, and stop it afterwards")
+    argument_parser.add_argument('--server-args', default='',
+                                 help="arguments for Server.py when using --start-server, e.g. \"--mode async\"")
+    argument_parser.add_argument('--encoding', choices=ENCODINGS, default=JSON,
+                                 help="encoding of the requests and responses after login")
+    argument_parser.add_argument('--compression', choices=COMPRESSIONS, default=NO_COMPRESSION,
+                                 help="compression of large frames, asked for at login")
+    argument_parser.add_argument('--json', action='store_true', help="print the results as json")
+    arguments = argument_parser.parse_args()
+
+    server_address = (arguments.host, arguments.port)
+    server = None
+    if arguments.start_server:
+        server = start_server(arguments.server_args, server_address)
+    try:
+        generator = LoadGenerator(server_address, arguments.clients, arguments.connect_rate,
+                                  arguments.names_requests, arguments.senders, arguments.messages,
+                                  arguments.message_interval, arguments.message_size, arguments.timeout,
+                                  arguments.encoding, arguments.compression)
+        generator.run()
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    results = generator.get_results()
+    failures = check_results(results, arguments.max_p99_latency)
+    if arguments.json:
+        results['failures'] = failures
+        print json.dumps(results, indent=4, sort_keys=True)
+    else:
+        print_results(results)
+        for failure in failures:
+            print "FAILED: " + failure
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import sys
+import socket
+import json
+import time
+from Framing import encode_frame, encode_compressed_frame, FrameDecoder, FrameError, ZLIB
+from ClientMessageParser import ClientMessageParser
+from BinaryEncoding import BINARY, is_binary, decode_response, encode_request
+
+"""
+A headless chat client used by the LoadGenerator. It speaks the same protocol as
+Client.py, but is driven by the event loop of the generator instead of raw_input,
+so a single process can simulate thousands of clients.
+
+Benchmark messages carry the time they were sent, so every client receiving a
+broadcast can measure the end-to-end latency:
+
+    bench <epoch time sent> <padding>
+"""
+
+BENCHMARK_MESSAGE_PREFIX = 'bench '
+
+
+class SimulatedClient(asyncore.dispatcher):
+
+    def __init__(self, generator, number, server_address):
+        asyncore.dispatcher.__init__(self, map=generator.socket_map)
+        self.generator = generator
+        self.username = 'bench%05d' % number
+        self.unsent_data = ""
+        self.frame_decoder = FrameDecoder()
+        self.logged_in = False
+        self.logged_out = False
+        self.failed = False
+        # Times when the requests still waiting for a response were sent
+        self.login_sent_time = None
+        self.names_sent_times = []
+        self.names_responses = 0
+        self.messages_sent = 0
+        # Requests are sent in binary once the server accepted the login with the binary encoding
+        self.binary_requests = False
+        # Large requests are compressed once the server accepted the login with compression
+        self.compressed_requests = False
+
+        self.connect_start_time = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(server_address)
+
+    """
+        Requests
+    """
+
+    def send_request(self, request, content='None'):
+        if self.binary_requests:
+            payload = encode_request(request, content)
+        else:
+            payload = ClientMessageParser.encode_request_to_json(request, content)
+        if self.compressed_requests:
+            self.unsent_data += encode_compressed_frame(payload)
+        else:
+            self.unsent_data += encode_frame(payload)
+
+    def send_names(self):
+        self.names_sent_times.append(time.time())
+        self.send_request('names')
+
+    def send_message(self, message_size):
+        content = BENCHMARK_MESSAGE_PREFIX + repr(time.time()) + ' '
+        content += 'x' * max(message_size - len(content), 0)
+        self.send_request('msg', content)
+        self.messages_sent += 1
+
+    def send_logout(self):
+        self.send_request('logout')
+
+    """
+        Event loop callbacks
+    """
+
+    def writable(self):
+        return not self.connected or len(self.unsent_data) > 0
+
+    def handle_connect(self):
+        now = time.time()
+        self.generator.record_connect(self.connect_start_time, now)
+        self.login_sent_time = now
+        login = ClientMessageParser.encode_login_request_to_json(self.username, self.generator.encoding,
+                                                                 self.generator.compression)
+        self.unsent_data += encode_frame(login)
+
+    def handle_write(self):
+        sent = self.send(self.unsent_data)
+        self.unsent_data = self.unsent_data[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        self.generator.record_received(len(data))
+        try:
+            payloads = self.frame_decoder.feed(data)
+        except FrameError:
+            self.fail("invalid frame")
+            self.close()
+            return
+        now = time.time()
+        for payload in payloads:
+            if is_binary(payload):
+                self.handle_response(decode_response(payload), now)
+            else:
+                self.handle_response(json.loads(payload), now)
+
+    def handle_response(self, response, now):
+        content = response['content']
+        if response['response'] == 'message':
+            if content.startswith(BENCHMARK_MESSAGE_PREFIX):
+                sent_time = float(content[len(BENCHMARK_MESSAGE_PREFIX):].split(' ', 1)[0])
+                self.generator.record_delivery(now - sent_time)
+        elif response['response'] == 'ping':
+            # The server disconnects clients that do not answer
+            self.send_request('pong')
+        elif response['response'] == 'error':
+            if not self.logged_in:
+                self.fail("login failed: " + content)
+            else:
+                self.generator.record_error(self.username + ": " + content)
+        elif response['response'] == 'info':
+            if content.startswith("Login successful"):
+                self.logged_in = True
+                self.binary_requests = self.generator.encoding == BINARY
+                self.compressed_requests = self.generator.compression == ZLIB
+                self.generator.record_login(now - self.login_sent_time)
+            elif content.startswith("Logged in users:") and self.names_sent_times:
+                self.names_responses += 1
+                self.generator.record_names(now - self.names_sent_times.pop(0))
+            elif content.startswith("Logout successful"):
+                self.logged_out = True
+                self.close()
+
+    def handle_close(self):
+        if not self.logged_out:
+            self.fail("disconnected by the server")
+        self.close()
+
+    def handle_error(self):
+        # Connection errors are counted instead of printing a traceback for every client
+        error = sys.exc_info()[1]
+        self.fail(error.__class__.__name__ + ": " + str(error))
+        self.close()
+
+    def fail(self, reason):
+        if not self.failed and not self.logged_out:
+            self.failed = True
+            self.generator.record_error(self.username + ": " + reason)
+
+    def is_done(self):
+        return self.logged_out or self.failed
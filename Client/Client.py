@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import argparse
 import socket
 import time
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
 from MessageReceiver import MessageReceiver
 from ClientMessageParser import ClientMessageParser
 from MessageSender import MessageSender
+from BinaryEncoding import ENCODINGS, JSON
+from Framing import COMPRESSIONS, NO_COMPRESSION
 
 
 class Client:
@@ -14,7 +20,7 @@ class Client:
     # Set to True if you wish to exit the chat client
     exit = False
 
-    def __init__(self, host, server_port):
+    def __init__(self, host, server_port, encoding=JSON, compression=NO_COMPRESSION):
         """
         This method is run when creating a new Client object
         """
@@ -24,7 +30,7 @@ class Client:
         self.server_address = (host, server_port)
 
         # Initiate the message parser class
-        self.client_message_parser = ClientMessageParser()
+        self.client_message_parser = ClientMessageParser(encoding, compression=compression)
         self.message_sender_thread = MessageSender
         self.message_receiver_thread = MessageReceiver
         self.run()
@@ -53,11 +59,12 @@ class Client:
                     encoded_message = self.client_message_parser.parse_user_input(payload)
                     self.message_sender_thread.queue_payload_for_sending(encoded_message)
         finally:
-            # Have to wait for the logout message to actually be sent
             self.disconnect()
             print "Disconnected from server."
 
     def disconnect(self):
+        # Have to wait for the queued messages (e.g. a logout) to actually be sent
+        self.message_sender_thread.stop()
         self.connection.close()
 
     def input_is_valid(self, payload):
@@ -72,4 +79,13 @@ if __name__ == '__main__':
 
     No alterations are necessary
     """
-    client = Client('localhost', 10005)
+    argument_parser = argparse.ArgumentParser(description="Chat client")
+    argument_parser.add_argument('--host', default='localhost')
+    argument_parser.add_argument('--port', type=int, default=10005)
+    argument_parser.add_argument('--encoding', choices=ENCODINGS, default=JSON,
+                                 help="encoding of the responses from the server, asked for at login")
+    argument_parser.add_argument('--compression', choices=COMPRESSIONS, default=NO_COMPRESSION,
+                                 help="compression of large frames, asked for at login")
+    arguments = argument_parser.parse_args()
+
+    client = Client(arguments.host, arguments.port, arguments.encoding, arguments.compression)
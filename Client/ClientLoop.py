@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import time
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from BinaryEncoding import JSON
+from Framing import NO_COMPRESSION
+from HeadlessClient import HeadlessClient
+
+
+class ClientLoop:
+
+    """
+    The event loop of a group of HeadlessClients. All clients of a loop are served by
+    a single thread, with poll, so one process can drive thousands of sessions.
+    The loop only runs inside poll, run_until and responses, so requests can be
+    queued from the code using the clients in between.
+    """
+
+    def __init__(self):
+        self.socket_map = {}
+        self.clients = []
+
+    def connect(self, host='localhost', port=10005, encoding=JSON, follow_presence=False, compression=NO_COMPRESSION):
+        client = HeadlessClient(self, host, port, encoding, follow_presence, compression)
+        self.clients.append(client)
+        return client
+
+    def reconnect(self, client):
+        # Returns a new client, resuming the session of a client whose connection was lost
+        if client in self.clients:
+            self.clients.remove(client)
+        client.close()
+        new_client = self.connect(*client.connect_arguments)
+        new_client.resume(*client.get_resume_state())
+        return new_client
+
+    def poll(self, timeout=0.01):
+        # Runs the loop once, waiting at most timeout seconds for a socket to be ready
+        asyncore.loop(timeout=timeout, use_poll=True, map=self.socket_map, count=1)
+
+    def run_until(self, condition, timeout=10.0):
+        # Runs the loop until condition() is True, returns False on timeout
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline or not self.socket_map:
+                return False
+            self.poll()
+        return True
+
+    def responses(self, timeout=None):
+        """
+        Generator of (client, response) for the responses of all clients, in the order
+        they were received by each client. Stops when no response was received for
+        timeout seconds, or when every client is closed.
+        """
+        last_response_time = time.time()
+        while True:
+            received = False
+            for client in self.clients:
+                response = client.get_response()
+                while response is not None:
+                    received = True
+                    yield client, response
+                    response = client.get_response()
+            if received:
+                last_response_time = time.time()
+            elif timeout is not None and time.time() - last_response_time > timeout:
+                return
+            elif not self.socket_map:
+                return
+            self.poll()
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
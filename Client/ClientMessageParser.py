@@ -1,9 +1,11 @@
 import json
+from BinaryEncoding import JSON, BINARY, is_binary, decode_response, encode_request
+from Framing import NO_COMPRESSION, ZLIB, encode_frame, encode_compressed_frame
 
 
 class ClientMessageParser:
 
-    def __init__(self):
+    def __init__(self, encoding=JSON, follow_presence=True, compression=NO_COMPRESSION):
 
         # Possible requests to server from the client that does not require content
         self.possible_requests_without_content = \
@@ -11,6 +13,8 @@ class ClientMessageParser:
                 'logout',
                 'names',
                 'help',
+                'rooms',
+                'presence',
             ]
 
         # Possible responses from the server to the client
@@ -18,24 +22,79 @@ class ClientMessageParser:
         self.info_response = 'info'
         self.message_response = 'message'
         self.history_response = 'history'
+        self.presence_response = 'presence'
+        self.search_response = 'search'
+        self.session_response = 'session'
+        self.ping_response = 'ping'
 
         self.possible_responses = {
             self.error_response: self.parse_error,
             self.info_response: self.parse_info,
             self.message_response: self.parse_message,
-            self.history_response: self.parse_history
+            self.history_response: self.parse_history,
+            self.presence_response: self.parse_presence,
+            self.search_response: self.parse_search,
+            self.session_response: self.parse_session,
+            self.ping_response: self.parse_ping
         }
         self.possible_requests = {
 
         }
 
+        # Used to request older messages from the chat history with 'history'
+        self.history_request = 'history'
+        self.history_page_size = 20
+        # Sequence number of the oldest message received from the history, None if there is no older message
+        self.oldest_history_seq = None
+
+        # Used to resume the session with 'resume' after the connection was lost: the token given by the
+        # server at login, and the sequence number of the newest message received
+        self.resume_request = 'resume'
+        self.resume_token = None
+        self.last_seq = 0
+        # Sequence numbers of the messages received while a session is resumed, which are left out
+        # of the missed messages sent after it. None when not resuming
+        self.resumed_seqs = None
+
+        # The logged in users, kept up to date from the presence snapshot and deltas,
+        # and the version of the last one received (None before the first snapshot)
+        self.roster = set()
+        self.presence_version = None
+
+        # The encoding asked for at login (see BinaryEncoding.py). Requests are sent in json
+        # until the server accepted the login, as a server that only knows json refuses the rest
+        self.encoding = encoding
+        self.binary_requests = False
+
+        # The compression asked for at login (see Framing.py). Large requests are compressed
+        # once the server accepted the login, for the same reason
+        self.compression = compression
+        self.compressed_requests = False
+
+        # Subscribes to the presence after login, see parse_info
+        self.follow_presence = follow_presence
+
+        # Requests the client must send on its own (e.g. following the presence after login),
+        # taken by the MessageReceiver
+        self.pending_requests = []
+
     """
         Methods for parsing incoming responses from the chat server
     """
     def parse(self, payload):
-        # Assumes that the payload is in json format
-        payload = json.loads(payload)
+        return self.parse_response(self.decode(payload))
 
+    @staticmethod
+    def decode(payload):
+        # The payload is either binary or json, told apart by its first byte
+        if is_binary(payload):
+            return decode_response(payload)
+        return json.loads(payload)
+
+    def parse_response(self, payload):
+        # Takes a decoded response, and returns it as text for the user
+        if self.is_duplicate(payload):
+            return ""
         if payload['response'] in self.possible_responses:
             return self.possible_responses[payload['response']](payload)
         else:
@@ -51,19 +110,125 @@ class ClientMessageParser:
         sender = payload['sender']  # In this case the server
         response = payload['response']
         content = payload['content']
+        if content.startswith("Resume successful"):
+            self.resumed_seqs = set()
+        if content.startswith("Login successful") or content.startswith("Resume successful"):
+            self.binary_requests = self.encoding == BINARY
+            self.compressed_requests = self.compression == ZLIB
+            if self.follow_presence:
+                # Follow who logs in and out
+                self.pending_requests.append(self.encode_request('presence', 'None'))
         return content + "\n"
 
+    def is_duplicate(self, payload):
+        # A message received again after resuming the session
+        return payload['response'] == self.message_response and payload.get('seq', self.last_seq + 1) <= self.last_seq
+
     def parse_message(self, payload):
+        if 'seq' in payload:
+            self.last_seq = payload['seq']
+            if self.resumed_seqs is not None:
+                self.resumed_seqs.add(payload['seq'])
         timestamp = payload['timestamp']
         sender = payload['sender']  # In this case the server
         response = payload['response']
         content = payload['content']
-        return sender + ": " + timestamp + "\n" + content + "\n"
+        if 'recipient' in payload:
+            # Direct message
+            return "[dm to " + payload['recipient'] + "] " + sender + ": " + timestamp + "\n" + content + "\n"
+        return self.format_room(payload.get('room')) + sender + ": " + timestamp + "\n" + content + "\n"
 
     def parse_history(self, payload):
         response = payload['response']
         content = payload['content']
-        return "Chat history:\n\n" + content + "-------------------" + "\n"
+        messages = content['messages']
+        if content.get('resumed'):
+            return self.parse_missed_messages(content)
+        if len(messages) > 0:
+            self.last_seq = max(self.last_seq, messages[-1]['seq'])
+        if len(messages) == 0:
+            self.oldest_history_seq = None
+            return "There are no older messages in the chat history.\n"
+        history = ""
+        for message in messages:
+            history += self.format_room(message.get('room')) + message['sender'] + ": " + message['timestamp'] + \
+                "\n" + message['content'] + "\n\n"
+        if content['more']:
+            self.oldest_history_seq = messages[0]['seq']
+            history += "Enter 'history' to see older messages.\n"
+        else:
+            self.oldest_history_seq = None
+        return "Chat history:\n\n" + history + "-------------------" + "\n"
+
+    def parse_missed_messages(self, content):
+        # The messages sent while the connection was lost, after resuming the session
+        resumed_seqs = self.resumed_seqs or set()
+        self.resumed_seqs = None
+        messages = [message for message in content['messages'] if message['seq'] not in resumed_seqs]
+        content['messages'] = messages
+        if len(messages) == 0:
+            return "You did not miss any messages.\n"
+        self.last_seq = max(self.last_seq, messages[-1]['seq'])
+        missed = ""
+        for message in messages:
+            missed += self.format_room(message.get('room')) + message['sender'] + ": " + message['timestamp'] + \
+                "\n" + message['content'] + "\n\n"
+        if content['more']:
+            self.oldest_history_seq = messages[0]['seq']
+            missed += "Enter 'history' to see older messages.\n"
+        return "Messages you missed:\n\n" + missed + "-------------------" + "\n"
+
+    def parse_session(self, payload):
+        # Nothing to show, the token is kept to resume the session
+        self.resume_token = payload['content']['token']
+        return ""
+
+    def parse_ping(self, payload):
+        # The server checks that the client is still there, nothing to show
+        self.pending_requests.append(self.encode_request('pong', 'None'))
+        return ""
+
+    def parse_presence(self, payload):
+        content = payload['content']
+        if 'users' in content:
+            # Snapshot
+            self.roster = set(content['users'])
+            self.presence_version = content['version']
+            return str(len(self.roster)) + " users are logged in. Enter 'names' to see who.\n"
+        if self.presence_version is None:
+            return ""
+        if not content['version'] == self.presence_version + 1:
+            # A delta was missed, so a new snapshot is requested
+            self.pending_requests.append(self.encode_request('presence', 'None'))
+        self.presence_version = content['version']
+        self.roster.update(content['joined'])
+        self.roster.difference_update(content['left'])
+        presence = ""
+        for username in content['joined']:
+            presence += username + " logged in.\n"
+        for username in content['left']:
+            presence += username + " logged out.\n"
+        return presence
+
+    def parse_search(self, payload):
+        content = payload['content']
+        messages = content['messages']
+        if len(messages) == 0:
+            return "No messages found for '" + content['query'] + "'.\n"
+        results = ""
+        for message in messages:
+            results += self.format_room(message.get('room')) + message['sender'] + ": " + message['timestamp'] + \
+                "\n" + message['content'] + "\n\n"
+        if content['total'] > len(messages):
+            results += "Showing the last " + str(len(messages)) + " of " + str(content['total']) + " messages.\n"
+        return "Search results for '" + content['query'] + "':\n\n" + results + "-------------------" + "\n"
+
+    @staticmethod
+    def format_room(room):
+        # Messages are shown with the room they were sent to, e.g. '[lobby] '
+        if room is None:
+            return ""
+        return "[" + room + "] "
 
     def response_not_valid(self):
         return "Client:\n" + "The server attempted to send a response, but the response was invalid."
@@ -76,12 +241,33 @@ class ClientMessageParser:
         request = user_input.split(' ')[0]
         if request in self.possible_requests_without_content:
             content = 'None'
+        elif request == self.history_request and len(user_input.split()) == 1:
+            content = self.get_history_page_content()
+        elif request == self.resume_request and len(user_input.split()) == 1:
+            content = self.get_resume_content()
         else:
             content = user_input[len(request)+1:]
-        return self.encode_request_to_json(request, content)
+        if request == 'login':
+            return self.encode_login_request_to_json(content, self.encoding, self.compression)
+        if request == self.resume_request:
+            return self.encode_session_request_to_json(request, content, self.encoding, self.compression)
+        return self.encode_request(request, content)
+
+
+
+    def get_history_page_content(self):
+        # 'history' without content requests the page before the oldest message received so far,
+        # or the last messages if there are no older messages
+        if self.oldest_history_seq is None:
+            return 'None'
+        return str(self.oldest_history_seq) + " " + str(self.history_page_size)
 
 
 
+    def get_resume_content(self):
+        # 'resume' without content resumes the session of this client
+        return str(self.resume_token) + " " + str(self.last_seq)
+
     """
         Method that returns json in the format that the server requires
     """
@@ -94,6 +280,37 @@ class ClientMessageParser:
             }
         return json.dumps(request_payload)
 
+    @staticmethod
+    def encode_login_request_to_json(username, encoding=JSON, compression=NO_COMPRESSION):
+        return ClientMessageParser.encode_session_request_to_json('login', username, encoding, compression)
+
+    @staticmethod
+    def encode_session_request_to_json(request, content, encoding=JSON, compression=NO_COMPRESSION):
+        # A login or resume, always in json. The encoding and compression are only asked for if they
+        # are not the default, so old servers accept the login
+        request_payload = \
+            {
+                'request': request,
+                'content': content
+            }
+        if not encoding == JSON:
+            request_payload['encoding'] = encoding
+        if not compression == NO_COMPRESSION:
+            request_payload['compression'] = compression
+        return json.dumps(request_payload)
+
+    def encode_request(self, request, content):
+        # Binary once the server accepted it at login, json otherwise
+        if self.binary_requests:
+            return encode_request(request, content)
+        return self.encode_request_to_json(request, content)
+
+    def encode_frame(self, payload):
+        # Large requests are compressed once the server accepted it at login
+        if self.compressed_requests:
+            return encode_compressed_frame(payload)
+        return encode_frame(payload)
+
 
     """
         Requests
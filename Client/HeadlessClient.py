@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import socket
+import sys
+import os
+from collections import deque
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Framing import FrameDecoder, FrameError, NO_COMPRESSION
+from BinaryEncoding import JSON
+from ClientMessageParser import ClientMessageParser
+
+
+class HeadlessClient(asyncore.dispatcher):
+
+    """
+    A chat client for bots and integrations, without raw_input, print or threads.
+    Clients are driven by the event loop of a ClientLoop, so a single process can
+    run thousands of them:
+
+        loop = ClientLoop()
+        client = loop.connect('localhost', 10005)
+        client.login('chatbot')
+        for client, response in loop.responses(timeout=5.0):
+            if response['response'] == 'message':
+                client.send_message("Hello " + response['sender'])
+
+    Requests are queued, and sent when the loop runs. Responses are kept as the
+    decoded dictionaries ('timestamp', 'sender', 'response', 'content', ...), in the
+    order they were received. The ClientMessageParser of the client follows the
+    responses, so the roster and the history paging work as in Client.py.
+    """
+
+    def __init__(self, loop, host='localhost', port=10005, encoding=JSON, follow_presence=False,
+                 compression=NO_COMPRESSION):
+        asyncore.dispatcher.__init__(self, map=loop.socket_map)
+        self.loop = loop
+        self.parser = ClientMessageParser(encoding, follow_presence, compression)
+        # Used by ClientLoop.reconnect
+        self.connect_arguments = (host, port, encoding, follow_presence, compression)
+        self.frame_decoder = FrameDecoder()
+        self.unsent_data = ""
+        self.responses = deque()
+        self.username = None
+        self.logged_in = False
+        self.closed = False
+        # The exception that closed the connection, if any
+        self.error = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    """
+        Requests
+    """
+
+    def login(self, username):
+        self.username = username
+        self.send_payload(self.parser.encode_login_request_to_json(username, self.parser.encoding,
+                                                                   self.parser.compression))
+
+    def resume(self, token=None, last_seq=None):
+        """
+        Resumes the session of a client whose connection was lost, on this new connection.
+        The client then gets the messages sent to its rooms after last_seq. Without
+        arguments the session this client had is resumed.
+        """
+        if token is not None:
+            self.parser.resume_token = token
+        if last_seq is not None:
+            self.parser.last_seq = last_seq
+        self.send_payload(self.parser.encode_session_request_to_json('resume', self.parser.get_resume_content(),
+                                                                     self.parser.encoding, self.parser.compression))
+
+    def get_resume_state(self):
+        # (resume token, last seq), to resume the session of this client on another connection
+        return self.parser.resume_token, self.parser.last_seq
+
+    def logout(self):
+        self.send_request('logout')
+
+    def send_message(self, message):
+        # To the active room
+        self.send_request('msg', message)
+
+    def send_direct_message(self, username, message):
+        self.send_request('dm', username + " " + message)
+
+    def join(self, room):
+        self.send_request('join', room)
+
+    def leave(self, room):
+        self.send_request('leave', room)
+
+    def request_names(self):
+        self.send_request('names')
+
+    def request_history(self):
+        # The page before the oldest message received so far
+        self.send_request('history', self.parser.get_history_page_content())
+
+    def search(self, query):
+        # E.g. 'deploy from:alice after:2016-03-01'
+        self.send_request('search', query)
+
+    def send_request(self, request, content='None'):
+        self.send_payload(self.parser.encode_request(request, content))
+
+    def send_payload(self, payload):
+        self.unsent_data += self.parser.encode_frame(payload)
+
+    """
+        Responses
+    """
+
+    def get_response(self):
+        # Returns the oldest response not taken yet, or None
+        if self.responses:
+            return self.responses.popleft()
+        return None
+
+    def get_roster(self):
+        # The logged in users, if the client follows the presence
+        return self.parser.roster
+
+    """
+        Event loop callbacks
+    """
+
+    def writable(self):
+        return not self.connected or len(self.unsent_data) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.unsent_data)
+        self.unsent_data = self.unsent_data[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        try:
+            payloads = self.frame_decoder.feed(data)
+        except FrameError as error:
+            self.error = error
+            self.close()
+            return
+        for payload in payloads:
+            response = self.parser.decode(payload)
+            if self.parser.is_duplicate(response):
+                # Received again after resuming the session
+                continue
+            self.parser.parse_response(response)
+            if response['response'] == 'ping':
+                # The parser queued a pong, which is sent below
+                continue
+            if response['response'] == 'info':
+                if response['content'].startswith("Login successful") or \
+                        response['content'].startswith("Resume successful"):
+                    self.logged_in = True
+                elif response['content'].startswith("Logout successful"):
+                    self.logged_in = False
+            self.responses.append(response)
+        # Requests the parser decided to send, e.g. a new presence snapshot
+        while self.parser.pending_requests:
+            self.send_payload(self.parser.pending_requests.pop(0))
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        # The error is kept, instead of printing a traceback for every client
+        self.error = sys.exc_info()[1]
+        self.close()
+
+    def close(self):
+        self.logged_in = False
+        self.closed = True
+        asyncore.dispatcher.close(self)
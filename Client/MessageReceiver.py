@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from threading import Thread
-from ClientMessageParser import ClientMessageParser
+from Framing import FrameDecoder
 
 
 class MessageReceiver(Thread):
@@ -20,13 +20,28 @@ class MessageReceiver(Thread):
         self.daemon = True
         self.client = client
         self.connection = connection
-        self.client_message_parser = ClientMessageParser()
+        # The parser of the client is used, as it remembers which messages of the history have been received
+        self.client_message_parser = client.client_message_parser
 
     def run(self):
+        frame_decoder = FrameDecoder()
         while True:
-            payload = self.connection.recv(4096)
-            message = self.client_message_parser.parse(payload)
-            self.print_message(message)
+            data = self.connection.recv(4096)
+            if not data:
+                self.print_message("The server closed the connection.")
+                break
+            # A single recv may contain several payloads, or only a part of one
+            for payload in frame_decoder.feed(data):
+                message = self.client_message_parser.parse(payload)
+                if message:
+                    self.print_message(message)
+            self.send_pending_requests()
+
+    def send_pending_requests(self):
+        # Requests the parser decided to send, e.g. to follow the presence after login
+        while self.client_message_parser.pending_requests:
+            payload = self.client_message_parser.pending_requests.pop(0)
+            self.client.message_sender_thread.queue_payload_for_sending(payload)
 
     @staticmethod
     def print_message(message):
@@ -1,37 +1,66 @@
 # -*- coding: utf-8 -*-
 from threading import Thread
-from ClientMessageParser import ClientMessageParser
-from Queue import Queue
+from Queue import Queue, Empty
+import socket
 
 
 class MessageSender(Thread):
 
     """
-    This is the message receiver class. The class inherits Thread, something that
-    is necessary to make the MessageReceiver start a new thread, and it allows
+    This is the message sender class. The class inherits Thread, something that
+    is necessary to make the MessageSender start a new thread, and it allows
     the chat client to both send and receive messages at the same time
+
+    The thread sleeps until a payload is queued. All the payloads queued by then are
+    sent with a single write, so a bot sending a lot of requests does not make a
+    system call for every one of them.
     """
 
     def __init__(self, client, connection):
         """
-        This method is executed when creating a new MessageReceiver object
+        This method is executed when creating a new MessageSender object
         """
         Thread.__init__(self)
         # Flag to run thread as a deamon
         self.daemon = True
         self.client = client
         self.connection = connection
-        self.client_message_parser = ClientMessageParser()
+        # Shared with the client, which knows the compression accepted at login
+        self.client_message_parser = client.client_message_parser
         self.payload_queue = Queue()
+        self.stop_marker = object()
 
     def run(self):
-        while True:
-            if not self.payload_queue.empty():
-                payload = self.payload_queue.get()
-                self.send_payload_from_queue(payload)
+        stopped = False
+        while not stopped:
+            # Blocks until there is something to send
+            payloads = [self.payload_queue.get()]
+            # Takes the rest of the queued payloads without blocking
+            try:
+                while True:
+                    payloads.append(self.payload_queue.get_nowait())
+            except Empty:
+                pass
+            if self.stop_marker in payloads:
+                # The payloads queued before stop are still sent
+                stopped = True
+                payloads = payloads[:payloads.index(self.stop_marker)]
+            if payloads and not self.send_payloads(payloads):
+                break
 
     def queue_payload_for_sending(self, payload):
         self.payload_queue.put(payload)
 
-    def send_payload_from_queue(self, payload):
-        self.connection.sendall(payload)
+    def send_payloads(self, payloads):
+        # Returns False if the connection is lost
+        try:
+            self.connection.sendall("".join(self.client_message_parser.encode_frame(payload)
+                                            for payload in payloads))
+        except socket.error:
+            return False
+        return True
+
+    def stop(self, timeout=1.0):
+        # Sends the payloads that are already queued, and then stops the thread
+        self.payload_queue.put(self.stop_marker)
+        self.join(timeout)
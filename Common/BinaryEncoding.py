@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import struct
+import json
+import time
+
+"""
+Compact binary encoding of the payloads, as an alternative to json.
+
+A client asks for it when logging in, by adding "encoding": "binary" to the (json)
+login request. If the login succeeds, the server sends every following response to
+that client in the binary encoding. Either side tells the encodings apart by the
+first byte of a payload: a json payload always starts with '{', a binary payload
+with the MAGIC byte. Clients and servers that only know json keep using json.
+
+Responses (server to client):
+
+    MAGIC | response code (1 byte) | flags (1 byte) | epoch timestamp (8 byte double)
+    [response name (1 byte length + utf-8), only if the response code is 0]
+    sender (1 byte length + utf-8)
+    content (4 byte length + utf-8, or json if the CONTENT_JSON flag is set)
+    [room (1 byte length + utf-8), if the HAS_ROOM flag is set]
+    [recipient (1 byte length + utf-8), if the HAS_RECIPIENT flag is set]
+    [sequence number (8 byte unsigned), if the HAS_SEQ flag is set]
+
+Requests (client to server):
+
+    MAGIC | request code (1 byte)
+    [request name (1 byte length + utf-8), only if the request code is 0]
+    content (4 byte length + utf-8)
+
+Requests and responses are sent as codes from the lists below. Names missing from
+the lists are sent with code 0 followed by the name, so new requests still work
+before they are given a code. Codes must never be reused or reordered.
+All numbers are big endian.
+"""
+
+BINARY = 'binary'
+JSON = 'json'
+ENCODINGS = [JSON, BINARY]
+
+MAGIC = '\x00'
+
+REQUEST_CODES = ['login', 'logout', 'msg', 'names', 'help', 'history', 'join', 'leave', 'rooms', 'dm', 'presence',
+                 'search', 'resume', 'pong']
+RESPONSE_CODES = ['error', 'info', 'message', 'history', 'presence', 'search', 'session', 'ping']
+
+# Flags of a response
+CONTENT_JSON = 1
+HAS_ROOM = 2
+HAS_RECIPIENT = 4
+HAS_SEQ = 8
+
+RESPONSE_HEADER = struct.Struct('!cBBd')
+REQUEST_HEADER = struct.Struct('!cB')
+SHORT_LENGTH = struct.Struct('!B')
+LONG_LENGTH = struct.Struct('!I')
+SEQ = struct.Struct('!Q')
+
+REQUEST_NUMBERS = dict((request, code + 1) for code, request in enumerate(REQUEST_CODES))
+RESPONSE_NUMBERS = dict((response, code + 1) for code, response in enumerate(RESPONSE_CODES))
+
+
+# (second, formatted time) of the last decoded response, as most responses are from the same second
+cached_timestamp = (None, None)
+
+
+def format_timestamp(timestamp):
+    # Local time in format 'Tue Jan 13 10:17:09 2009', as in json responses
+    global cached_timestamp
+    second = int(timestamp)
+    if not cached_timestamp[0] == second:
+        cached_timestamp = (second, time.asctime(time.localtime(second)))
+    return cached_timestamp[1]
+
+
+def is_binary(payload):
+    return payload[:1] == MAGIC
+
+
+def encode_string(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def short_field(value):
+    value = encode_string(value)
+    return SHORT_LENGTH.pack(len(value)) + value
+
+
+def long_field(value):
+    value = encode_string(value)
+    return LONG_LENGTH.pack(len(value)) + value
+
+
+class FieldReader(object):
+
+    # Reads the length-prefixed fields of a payload, in order
+
+    __slots__ = ('payload', 'offset')
+
+    def __init__(self, payload, offset):
+        self.payload = payload
+        self.offset = offset
+
+    def read(self, length_struct):
+        length = length_struct.unpack_from(self.payload, self.offset)[0]
+        start = self.offset + length_struct.size
+        self.offset = start + length
+        if self.offset > len(self.payload):
+            raise ValueError("Binary payload is truncated.")
+        return self.payload[start:self.offset].decode('utf-8')
+
+    def read_number(self, number_struct):
+        value = number_struct.unpack_from(self.payload, self.offset)[0]
+        self.offset += number_struct.size
+        return value
+
+
+def encode_response(sender, response, content, room=None, recipient=None, timestamp=None, seq=None):
+    if timestamp is None:
+        timestamp = time.time()
+    flags = 0
+    if not isinstance(content, basestring):
+        # Structured content, e.g. the messages of a history response
+        content = json.dumps(content)
+        flags |= CONTENT_JSON
+    if room is not None:
+        flags |= HAS_ROOM
+    if recipient is not None:
+        flags |= HAS_RECIPIENT
+    if seq is not None:
+        flags |= HAS_SEQ
+    code = RESPONSE_NUMBERS.get(response, 0)
+    payload = RESPONSE_HEADER.pack(MAGIC, code, flags, timestamp)
+    if code == 0:
+        payload += short_field(response)
+    payload += short_field(sender) + long_field(content)
+    if room is not None:
+        payload += short_field(room)
+    if recipient is not None:
+        payload += short_field(recipient)
+    if seq is not None:
+        payload += SEQ.pack(seq)
+    return payload
+
+
+def decode_response(payload):
+    # Returns the response as the same dictionary as a json response
+    try:
+        magic, code, flags, timestamp = RESPONSE_HEADER.unpack_from(payload)
+        reader = FieldReader(payload, RESPONSE_HEADER.size)
+        if code == 0:
+            response = reader.read(SHORT_LENGTH)
+        else:
+            response = RESPONSE_CODES[code - 1]
+        decoded = \
+            {
+                'timestamp': format_timestamp(timestamp),
+                'sender': reader.read(SHORT_LENGTH),
+                'response': response,
+                'content': reader.read(LONG_LENGTH)
+            }
+        if flags & CONTENT_JSON:
+            decoded['content'] = json.loads(decoded['content'])
+        if flags & HAS_ROOM:
+            decoded['room'] = reader.read(SHORT_LENGTH)
+        if flags & HAS_RECIPIENT:
+            decoded['recipient'] = reader.read(SHORT_LENGTH)
+        if flags & HAS_SEQ:
+            decoded['seq'] = reader.read_number(SEQ)
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError("Binary payload is not valid.")
+    return decoded
+
+
+def encode_request(request, content):
+    code = REQUEST_NUMBERS.get(request, 0)
+    payload = REQUEST_HEADER.pack(MAGIC, code)
+    if code == 0:
+        payload += short_field(request)
+    return payload + long_field(content)
+
+
+def decode_request(payload):
+    # Returns the request as the same dictionary as a json request
+    try:
+        magic, code = REQUEST_HEADER.unpack_from(payload)
+        reader = FieldReader(payload, REQUEST_HEADER.size)
+        if code == 0:
+            request = reader.read(SHORT_LENGTH)
+        else:
+            request = REQUEST_CODES[code - 1]
+        return {'request': request, 'content': reader.read(LONG_LENGTH)}
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError("Binary payload is not valid.")
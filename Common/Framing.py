@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import struct
+import zlib
+
+"""
+Framing of the payloads sent between the client and the server.
+
+TCP is a byte stream, so one recv() may return half a payload, or several payloads
+at once. Every payload is therefore sent as a frame:
+
+    +------------------------+-------------------------+
+    | length (4 bytes, big   | payload (length bytes)  |
+    | endian, unsigned)      |                         |
+    +------------------------+-------------------------+
+
+FrameDecoder buffers the received bytes and returns only complete payloads.
+
+A payload may be compressed with zlib, if the client asked for it at login by adding
+"compression": "zlib" to the login request. Only payloads of at least the
+compression threshold are compressed, and only if that makes them smaller. The
+highest bit of the length is set for a compressed payload, which is never set
+otherwise, as frames are much smaller than 2 GB. FrameDecoder decompresses these
+payloads, so the rest of the code never sees a compressed payload.
+"""
+
+HEADER = struct.Struct('!I')
+
+# Frames larger than this are treated as a protocol error, also after decompressing them
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+COMPRESSED = 0x80000000
+
+NO_COMPRESSION = 'none'
+ZLIB = 'zlib'
+COMPRESSIONS = [NO_COMPRESSION, ZLIB]
+
+# Payloads smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_compressed_frame(payload, threshold=COMPRESSION_THRESHOLD):
+    # A frame with the payload compressed, if it is large enough and compresses well
+    if len(payload) >= threshold:
+        compressed_payload = zlib.compress(payload, COMPRESSION_LEVEL)
+        if len(compressed_payload) < len(payload):
+            return HEADER.pack(len(compressed_payload) | COMPRESSED) + compressed_payload
+    return encode_frame(payload)
+
+
+def decompress_payload(payload, max_size):
+    # The size is limited, so a small frame can not decompress to an enormous payload
+    decompressor = zlib.decompressobj()
+    try:
+        decompressed_payload = decompressor.decompress(payload, max_size)
+    except zlib.error as error:
+        raise FrameError("Compressed frame is not valid: " + str(error))
+    if decompressor.unconsumed_tail:
+        raise FrameError("Compressed frame exceeds the maximum frame size.")
+    return decompressed_payload
+
+
+class FrameDecoder(object):
+
+    # There is one decoder for every connection
+    __slots__ = ('max_frame_size', 'buffer')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received bytes to the buffer, and returns a list of all payloads that
+        are now complete. Incomplete payloads are kept until the rest arrives.
+        """
+        self.buffer.extend(data)
+        payloads = []
+        offset = 0
+        buffered = len(self.buffer)
+        while buffered - offset >= HEADER.size:
+            length = HEADER.unpack_from(self.buffer, offset)[0]
+            compressed = length & COMPRESSED
+            length &= ~COMPRESSED
+            if length > self.max_frame_size:
+                raise FrameError("Frame of " + str(length) + " bytes exceeds the maximum frame size.")
+            end = offset + HEADER.size + length
+            if end > buffered:
+                break
+            payload = str(self.buffer[offset + HEADER.size:end])
+            if compressed:
+                payload = decompress_payload(payload, self.max_frame_size)
+            payloads.append(payload)
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return payloads
+
+    def pending_bytes(self):
+        return len(self.buffer)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+from threading import Thread
+from Metrics import metrics
+
+"""
+Serves the metrics of the process (see Metrics.py) over http, for a scraper or for
+    curl http://localhost:<admin port>/metrics
+
+Only listens on localhost, as the metrics are not meant for the chat clients.
+"""
+
+
+class AdminRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        # Scrapes are not printed
+        pass
+
+
+class AdminServer(Thread):
+
+    def __init__(self, port):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.http_server = BaseHTTPServer.HTTPServer(('localhost', port), AdminRequestHandler)
+
+    def run(self):
+        self.http_server.serve_forever()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
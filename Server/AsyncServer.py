@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import socket
+import resource
+import os
+import fcntl
+import time
+from Framing import FrameDecoder, FrameError
+from ClientSession import ClientSession
+from ClientHandlerMixin import ClientHandlerMixin
+from ChatServerMixin import ChatServerMixin
+from OutboundQueue import OutboundQueue
+from MultiProcessServer import SO_REUSEPORT
+from Metrics import metrics
+
+"""
+Single threaded server mode. All clients are served from one asyncore event loop,
+instead of one thread per client as in ThreadedTCPServer. An idle client then only
+costs a socket and a small handler object, which lets the server hold a lot more
+concurrent connections.
+"""
+
+
+class AsyncClientHandler(ClientHandlerMixin, asyncore.dispatcher):
+
+    """
+    The event loop counterpart of ClientHandler. One object is created for every
+    connected client. The request logic is shared with ClientHandler through
+    ClientHandlerMixin.
+    """
+
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        # Frames are batched by the server (see OutboundQueue.py), so Nagle's algorithm would only delay them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Idle clients are the common case, so a handler only holds what it needs,
+        # and the login state is kept in a ClientSession
+        self.ip = client_address[0]
+        self.server = server
+        self.session = ClientSession(server.rate_limiter.new_client_bucket())
+        # Frames are written by the event loop when the socket is writable
+        self.outbound = OutboundQueue(server.outbound_queue_size, server.slow_consumer_policy,
+                                      server.write_batch_window)
+        # The part of a frame that has not been written yet
+        self.unsent_data = ""
+        self.frame_decoder = FrameDecoder()
+        self.closed = False
+        # Checked by the idle_reaper of the server
+        self.last_read_time = time.time()
+        if server.idle_reaper is not None:
+            server.idle_reaper.add(self)
+        metrics.increment('chat_connections')
+        metrics.increment('chat_connections_total')
+        print "Client connected on IP: " + self.ip
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        if self.outbound.overflowed:
+            # The client did not keep up with the messages sent to it
+            self.handle_close()
+            return False
+        if len(self.unsent_data) > 0 or self.outbound.ready_to_write():
+            return True
+        if self.outbound.has_frames():
+            # Held back by the batch window, so the loop must not sleep for long
+            self.server.write_pending = True
+        return False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        self.last_read_time = time.time()
+        try:
+            payloads = self.frame_decoder.feed(data)
+        except FrameError:
+            self.handle_close()
+            return
+        for payload in payloads:
+            self.handle_payload(payload)
+        # The requests may have queued frames
+        self.server.write_pending = True
+
+    def handle_write(self):
+        if not self.unsent_data:
+            # The frames queued since the last write are sent together
+            frames = self.outbound.get_frames_nowait()
+            if not frames:
+                return
+            self.unsent_data = "".join(frames)
+            metrics.observe('chat_write_frames', len(frames))
+        sent = self.send(self.unsent_data)
+        self.unsent_data = self.unsent_data[sent:]
+
+    def handle_close(self):
+        # asyncore may report the same disconnect both as a read and as a hangup
+        if self.closed:
+            return
+        self.closed = True
+        print "Client with IP: " + self.ip + " disconnected."
+        if self.server.idle_reaper is not None:
+            self.server.idle_reaper.remove(self)
+        if self.session.logged_in:
+            self.disconnect_user()
+        self.outbound.close()
+        self.close()
+        metrics.increment('chat_connections', -1)
+
+    def close_idle(self):
+        # Called by the event loop, see AsyncChatServer.serve_forever
+        print "Client with IP: " + self.ip + " timed out."
+        self.handle_close()
+
+
+class Waker(asyncore.file_dispatcher):
+
+    """
+    Interrupts the event loop when frames are queued from another thread (the message
+    bus of a worker process), so they are written without waiting for the poll timeout.
+    """
+
+    def __init__(self, socket_map):
+        read_descriptor, self.write_descriptor = os.pipe()
+        # wake() must never block the thread calling it
+        flags = fcntl.fcntl(self.write_descriptor, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_descriptor, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # file_dispatcher reads from a copy of the descriptor
+        asyncore.file_dispatcher.__init__(self, read_descriptor, map=socket_map)
+        os.close(read_descriptor)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def wake(self):
+        try:
+            os.write(self.write_descriptor, 'x')
+        except OSError:
+            # The pipe is full, so the loop will wake up anyway
+            pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_descriptor)
+
+
+class AsyncChatServer(ChatServerMixin, asyncore.dispatcher):
+
+    """
+    Accepts clients and hands them over to AsyncClientHandler objects.
+    Has the same interface as ThreadedTCPServer (serve_forever, shutdown, server_close).
+    """
+
+    request_queue_size = 1024
+    # History reads do not wait for the log writer, as that would block the event loop
+    history_read_timeout = 0
+
+    def __init__(self, server_address, handler_class):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.handler_class = handler_class
+        self.running = False
+        # True if frames may have been queued, see serve_forever
+        self.write_pending = False
+        self.raise_file_limit()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.waker = Waker(self.socket_map)
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+
+    @staticmethod
+    def raise_file_limit():
+        # Every client uses a file descriptor, so allow as many as the system permits
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit < hard_limit:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            self.handler_class(sock, client_address, self)
+
+    def serve_forever(self, poll_interval=0.5):
+        # poll() is used instead of select(), as select() is limited to 1024 file descriptors
+        self.running = True
+        while self.running and self.socket_map:
+            timeout = poll_interval
+            if self.write_pending and self.write_batch_window:
+                # Frames held back by the batch window are written when it has passed
+                timeout = min(poll_interval, self.write_batch_window)
+            self.write_pending = False
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.socket_map, count=1)
+            if self.idle_reaper is not None:
+                # Pings and closes idle clients from the loop, which owns the handlers
+                self.idle_reaper.check(time.time())
+
+    def wake(self):
+        self.write_pending = True
+        self.waker.wake()
+
+    def shutdown(self):
+        self.running = False
+
+    def server_close(self):
+        asyncore.close_all(map=self.socket_map)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import threading
+import os
+import time
+from collections import deque
+from OutboundQueue import DISCONNECT
+from Framing import COMPRESSION_THRESHOLD
+from SuspendedSessions import SuspendedSessions
+from Metrics import metrics
+
+"""
+State and settings shared by all the clients of a server, for both server modes
+(ThreadedTCPServer and AsyncChatServer).
+The settings may be changed from the command line, see Server.py
+
+When the server runs as several worker processes (see MultiProcessServer.py), every
+worker only holds its own clients. Messages, presence and room membership are then
+shared with the other workers through the message_bus (a BusClient), and the
+methods below hide whether a client is served by this process or by another.
+"""
+
+
+class ChatServerMixin:
+
+    # Hold all logged in clients, as username -> OutboundQueue
+    logged_in_clients = {}
+    logged_in_clients_lock = threading.Lock()
+
+    # Members of every room, as room -> set of usernames. Also protected by logged_in_clients_lock.
+    # Clients join the default room when they log in
+    rooms = {}
+    default_room = 'lobby'
+
+    # Parses the requests of all clients (a ServerMessageParser)
+    request_parser = None
+
+    # Limits the requests per client, and of all clients together (a RateLimiter).
+    # Rates are in requests per second, 0 is unlimited
+    rate_limiter = None
+    client_rate_limit = 20
+    client_rate_burst = 50
+    global_rate_limit = 0
+    global_rate_burst = 1000
+
+    # Tells the clients who is logged in (a Presence)
+    presence = None
+    presence_window_ms = 100
+
+    # The message history, a HistoryStore in history_directory.
+    # Only the last history_replay_limit messages are sent to a client on login, and
+    # older messages can be requested history_page_limit messages at a time
+    history_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Log", "history")
+    history_store = None
+    # Messages are written to the history_store by the log_writer (a LogWriter).
+    # None in worker processes, where the main process writes the history
+    log_writer = None
+    # The last messages of the history, kept in memory (a RecentMessages), see read_history
+    recent_messages = None
+    # How long a history read waits for the log_writer to write the messages it needs
+    history_read_timeout = 1.0
+    # Room messages are numbered in the order they are added to numbered_messages, and
+    # sent by one thread at a time. Senders wait when max_queued_messages are queued,
+    # see send_room_message
+    message_lock = threading.Lock()
+    numbered_messages = deque()
+    delivery_lock = threading.Lock()
+    max_queued_messages = 100
+    history_replay_limit = 100
+    history_page_limit = 500
+    # Finds messages in the history for 'search' requests (a SearchIndex),
+    # which are answered with at most search_result_limit messages
+    search_index = None
+    search_result_limit = 20
+
+    # Max number of frames waiting to be written to a single client,
+    # and what to do when a client does not read fast enough (see OutboundQueue.py)
+    outbound_queue_size = 1000
+    slow_consumer_policy = DISCONNECT
+    # Seconds a frame may be held back, so it is written together with the next frames (see OutboundQueue.py)
+    write_batch_window = 0.0
+    # Frames of at least this many bytes are compressed for the clients that asked for it
+    compression_threshold = COMPRESSION_THRESHOLD
+
+    # Sessions of clients that lost their connection, which can be resumed for resume_timeout
+    # seconds (0: never). With several workers they are held by the main process
+    suspended_sessions = SuspendedSessions()
+    resume_timeout = 300
+
+    # Disconnects clients that sent nothing for idle_timeout seconds (an IdleReaper, None if off),
+    # after sending them a 'ping' when they sent nothing for heartbeat_interval seconds
+    idle_reaper = None
+    idle_timeout = 90
+    heartbeat_interval = 30
+
+    # Set in worker processes, where several servers accept clients on the same port
+    reuse_port = False
+    message_bus = None
+
+    """
+        Logged in users
+    """
+
+    def claim_username(self, username):
+        # Returns True if nobody is logged in with the username
+        if self.message_bus is not None:
+            return self.message_bus.claim_username(username)
+        with self.logged_in_clients_lock:
+            return username not in self.logged_in_clients
+
+    def add_client(self, username, outbound):
+        with self.logged_in_clients_lock:
+            self.logged_in_clients[username] = outbound
+        # With a message bus, the presence learns about every login from the bus
+        if self.message_bus is None:
+            self.presence.add(username)
+
+    def remove_client(self, username):
+        # Returns False if the user was not logged in
+        with self.logged_in_clients_lock:
+            outbound = self.logged_in_clients.pop(username, None)
+        if outbound is None:
+            return False
+        self.presence.unsubscribe(username, outbound)
+        if self.message_bus is not None:
+            self.message_bus.release_username(username)
+        else:
+            self.presence.remove(username)
+        return True
+
+    def suspend_session(self, token, username, rooms, active_room):
+        if self.message_bus is not None:
+            self.message_bus.publish(('suspend', token, username, rooms, active_room,
+                                      time.time() + self.resume_timeout))
+        else:
+            self.suspended_sessions.suspend(token, username, rooms, active_room, time.time() + self.resume_timeout)
+
+    def resume_session(self, token):
+        """
+        Returns the (username, rooms, active room) of the suspended session with the token,
+        or None if there is none, or the user logged in again. Like claim_username, the
+        username is reserved for the client. With several workers the sessions are held
+        by the main process, as the client may have been served by another worker.
+        """
+        if self.message_bus is not None:
+            return self.message_bus.resume_session(token)
+        session = self.suspended_sessions.resume(token)
+        if session is None or not self.claim_username(session[0]):
+            return None
+        return session
+
+    def get_usernames(self):
+        # Sorted, and the same list object until a user logs in or out
+        return self.presence.get_usernames()
+
+    def is_logged_in(self, username):
+        if self.message_bus is not None:
+            return self.message_bus.is_logged_in(username)
+        return username in self.logged_in_clients
+
+    """
+        Rooms
+    """
+
+    def add_room_member(self, room, username):
+        # Returns False if the user already was a member of the room
+        with self.logged_in_clients_lock:
+            members = self.rooms.setdefault(room, set())
+            already_member = username in members
+            members.add(username)
+        if self.message_bus is not None and not already_member:
+            self.message_bus.publish(('join', username, room))
+        return not already_member
+
+    def remove_room_member(self, room, username):
+        with self.logged_in_clients_lock:
+            members = self.rooms.get(room, set())
+            members.discard(username)
+            if not members:
+                self.rooms.pop(room, None)
+        if self.message_bus is not None:
+            self.message_bus.publish(('leave', username, room))
+
+    def get_room_sizes(self):
+        # Returns a sorted list of (room, number of members)
+        if self.message_bus is not None:
+            return self.message_bus.get_room_sizes()
+        with self.logged_in_clients_lock:
+            return sorted((room, len(members)) for room, members in self.rooms.iteritems())
+
+    """
+        Sending responses to clients.
+        The send_to methods send to all matching clients, also those of other workers.
+        The deliver_to methods only send to the clients of this process.
+        A Response is encoded to a frame at most once per encoding, see Response.py
+    """
+
+    def send_to_all(self, response, excluded_username=None):
+        self.deliver_to_all(response, excluded_username)
+        if self.message_bus is not None:
+            self.message_bus.publish(('all', response.to_tuple(), excluded_username))
+
+    def send_to_room(self, room, response, excluded_username=None):
+        self.deliver_to_room(room, response, excluded_username)
+        if self.message_bus is not None:
+            self.message_bus.publish(('room', room, response.to_tuple(), excluded_username))
+
+    def send_room_message(self, room, response, record, timestamp):
+        """
+        Writes a message to the history, and sends it to the members of the room with its
+        sequence number in the history (see the 'resume' request). Every client gets the
+        messages in the order of their numbers, so a client that received a message also
+        received the ones before it: messages are queued as they are numbered, and sent in
+        batches by whichever thread holds the delivery_lock (see deliver_room_messages).
+        With several workers the main process numbers the message, and sends it to the
+        members in every worker, this one included.
+        """
+        if self.message_bus is not None:
+            self.message_bus.publish(('message', room, response.to_tuple(), record, timestamp))
+            return
+        with self.message_lock:
+            response.seq = self.log_writer.log(record, timestamp)
+            self.recent_messages.add(response.seq, timestamp, record)
+            self.numbered_messages.append((room, response))
+        # Threads only wait for the delivery_lock when many messages are queued, which slows
+        # down the senders. The thread holding it checks for new messages after releasing it
+        while self.numbered_messages:
+            if not self.delivery_lock.acquire(len(self.numbered_messages) >= self.max_queued_messages):
+                return
+            try:
+                messages = []
+                while self.numbered_messages:
+                    messages.append(self.numbered_messages.popleft())
+                self.deliver_room_messages(messages)
+            finally:
+                self.delivery_lock.release()
+
+    """
+        Reading the history
+    """
+
+    def read_history(self, start_seq, count):
+        """
+        Returns up to count messages from start_seq, as (seq, timestamp, record) tuples.
+        The recent messages are taken from memory, and only older ones are read from the
+        history_store.
+
+        Messages may be numbered before the log_writer has written them, and no longer be
+        in memory. The read waits up to history_read_timeout for them, and otherwise only
+        returns the messages up to the last one written, so the client can page again.
+        """
+        end_seq = start_seq + count
+        first_recent_seq, messages = self.recent_messages.read_range(start_seq, end_seq)
+        if start_seq >= first_recent_seq:
+            metrics.increment('chat_history_reads_total', labels=(('source', 'memory'),))
+            return messages
+        metrics.increment('chat_history_reads_total', labels=(('source', 'disk'),))
+        stored_end_seq = min(end_seq, first_recent_seq)
+        if not self.wait_for_history(stored_end_seq - 1, self.history_read_timeout):
+            # The messages in memory do not follow on the ones written
+            messages = []
+        return self.history_store.read_range(start_seq, stored_end_seq - start_seq) + messages
+
+    def get_last_history_seq(self):
+        # The sequence number of the last message, which may not be written yet
+        self.history_store.refresh()
+        return max(self.recent_messages.last_seq, self.history_store.last_seq)
+
+    def wait_for_history(self, seq, timeout):
+        # Waits until the messages up to seq are written to the history. Returns False on timeout
+        deadline = time.time() + timeout
+        while True:
+            self.history_store.refresh()
+            if self.history_store.last_seq >= seq:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.002)
+
+    def send_to_user(self, username, response):
+        # Returns False if the user is not logged in
+        if self.deliver_to_user(username, response):
+            return True
+        if self.message_bus is not None and self.message_bus.is_logged_in(username):
+            self.message_bus.publish(('user', username, response.to_tuple()))
+            return True
+        return False
+
+    def deliver_to_all(self, response, excluded_username=None):
+        """
+        The response is put on the outbound queue of every recipient. The lock is only held
+        while copying the recipients, so a full queue (with the 'block' policy) does not
+        stop other clients from logging in or out.
+        Disconnected clients are removed by their own handler.
+        """
+        start_time = time.time()
+        with self.logged_in_clients_lock:
+            recipients = [outbound for username, outbound in self.logged_in_clients.iteritems()
+                          if not username == excluded_username]
+        for outbound in recipients:
+            outbound.put_response(response)
+        self.record_fanout(start_time, len(recipients))
+
+    def deliver_to_room(self, room, response, excluded_username=None):
+        """
+        Sends to the members of a room only, so the cost depends on the size of the room,
+        and not on the number of logged in clients.
+        """
+        start_time = time.time()
+        with self.logged_in_clients_lock:
+            recipients = [self.logged_in_clients[username]
+                          for username in self.rooms.get(room, ())
+                          if not username == excluded_username and username in self.logged_in_clients]
+        for outbound in recipients:
+            outbound.put_response(response)
+        self.record_fanout(start_time, len(recipients))
+
+    def deliver_room_messages(self, messages):
+        """
+        Sends a list of (room, response), in order. Every recipient gets all its responses
+        at once, so under load a single write sends it the messages of many senders.
+        """
+        start_time = time.time()
+        recipients = {}
+        with self.logged_in_clients_lock:
+            for room, response in messages:
+                for username in self.rooms.get(room, ()):
+                    outbound = self.logged_in_clients.get(username)
+                    if outbound is not None:
+                        recipients.setdefault(outbound, []).append(response)
+        for outbound, responses in recipients.iteritems():
+            outbound.put_responses(responses)
+        self.record_fanout(start_time, len(recipients))
+
+    @staticmethod
+    def record_fanout(start_time, recipient_count):
+        metrics.observe('chat_fanout_seconds', time.time() - start_time)
+        metrics.observe('chat_fanout_recipients', recipient_count)
+
+    def deliver_to_user(self, username, response):
+        # Looks up the user in logged_in_clients, so no other client is touched
+        with self.logged_in_clients_lock:
+            outbound = self.logged_in_clients.get(username)
+        return outbound is not None and outbound.put_response(response)
+
+    def wake(self):
+        """
+        Called after responses were queued from another thread than the one serving the
+        clients (e.g. by the message bus). Only needed by the async server, whose event
+        loop must notice the new frames.
+        """
+        pass
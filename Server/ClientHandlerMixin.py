@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import time
+import os
+import binascii
+from Metrics import metrics
+from Framing import ZLIB
+
+"""
+Request logic shared by every kind of client handler (threaded and async).
+
+A class using this mixin must provide the following attributes:
+    - server            the server object holding the shared state, and the
+                        request_parser (a ServerMessageParser) shared by all clients
+    - outbound          the OutboundQueue of the client
+    - session           the ClientSession of the client (username, rooms, ...)
+"""
+
+
+class ClientHandlerMixin:
+
+    def handle_payload(self, payload):
+        """
+        Parses a single payload from the client and acts on it
+        """
+        request_parser = self.server.request_parser
+        # Checked before the payload is decoded, so a flood of requests is refused cheaply
+        if not self.server.rate_limiter.allow(self.session.request_bucket):
+            if not self.session.rate_limited:
+                self.session.rate_limited = True
+                self.send_json(self.outbound, request_parser.rate_limited_json())
+            return
+        self.session.rate_limited = False
+        start_time = time.time()
+        parsed_payload = request_parser.parse(self.session, payload)
+        parse_end_time = time.time()
+        request = parsed_payload[0]
+        content = parsed_payload[1]
+        request_is_valid = parsed_payload[2]
+        json_response = parsed_payload[3]
+
+        # LOGIN
+        if request_parser.is_login(request) and request_is_valid:
+            self.login_user(content)
+            print "User " + self.session.username + " logged in."
+            self.send_json(self.outbound, json_response)
+            self.send_json(self.outbound, request_parser.get_session_response_json(self.session))
+            is_log, history_response = request_parser.get_history_response_json(self.session)
+            if is_log:
+                self.send_json(self.outbound, history_response)
+
+        # RESUME, after the connection was lost. Content is the suspended session, and the
+        # sequence number of the last message the client received
+        elif request_parser.is_resume(request) and request_is_valid:
+            username, rooms, active_room, last_seq = content
+            self.resume_user(username, rooms, active_room)
+            print "User " + self.session.username + " resumed the session."
+            self.send_json(self.outbound, json_response)
+            self.send_json(self.outbound, request_parser.get_session_response_json(self.session))
+            self.send_json(self.outbound, request_parser.get_missed_messages_response_json(self.session, last_seq))
+
+        # LOGOUT
+        elif request_parser.is_logout(request) and request_is_valid:
+            self.send_json(self.outbound, json_response)
+            self.logout_user()
+            print "User " + self.session.username + " logged out."
+
+        elif request_parser.is_message(request) and request_is_valid:
+            self.send_room_message(content, json_response)
+
+        elif request_parser.is_direct_message(request) and request_is_valid:
+            self.send_direct_message(content, json_response)
+
+        elif request_parser.is_presence(request) and request_is_valid:
+            # The response is the snapshot, which is sent by the presence
+            self.server.presence.subscribe(self.session.username, self.outbound)
+
+        # PONG, the answer to a ping. Receiving it already showed the client is alive
+        elif request_parser.is_pong(request) and request_is_valid:
+            pass
+
+        elif request_parser.is_join(request) and request_is_valid:
+            self.join_room(content)
+            self.send_json(self.outbound, json_response)
+
+        elif request_parser.is_leave(request) and request_is_valid:
+            self.leave_room(content)
+            self.send_json(self.outbound, json_response)
+
+        else:
+            self.send_json(self.outbound, json_response)
+
+        self.record_request(request, request_is_valid, start_time, parse_end_time)
+
+    def record_request(self, request, request_is_valid, start_time, parse_end_time):
+        # Requests that do not exist are counted together, so clients can not add labels
+        if request not in self.server.request_parser.possible_requests:
+            request = 'unknown'
+        labels = (('request', request),)
+        metrics.increment('chat_requests_total', labels=labels)
+        if not request_is_valid:
+            metrics.increment('chat_invalid_requests_total')
+        metrics.observe('chat_parse_seconds', parse_end_time - start_time)
+        metrics.observe('chat_request_seconds', time.time() - start_time, labels)
+
+    @staticmethod
+    def send_json(outbound, json_response):
+        # Every payload is sent as a frame (see Framing.py), in the encoding of the client
+        outbound.put_response(json_response)
+
+    def send_ping(self):
+        # Called by the IdleReaper when the client sent nothing for a while
+        self.send_json(self.outbound, self.server.request_parser.ping_json())
+
+    def login_user(self, username):
+        self.session.username = username
+        self.session.logged_in = True
+        self.session.resume_token = binascii.hexlify(os.urandom(16))
+        # Adding the client to the set of logged in clients. The subscribers of the
+        # presence are told about the login, see Presence.py
+        self.outbound.encoding = self.session.encoding
+        if self.session.compression == ZLIB:
+            self.outbound.compression_threshold = self.server.compression_threshold
+        else:
+            self.outbound.compression_threshold = None
+        self.server.add_client(self.session.username, self.outbound)
+        # The room is not notified of a login, as that is what the presence is for
+        self.join_room(self.server.default_room, False)
+
+    def logout_user(self):
+        self.session.logged_in = False
+        for room in list(self.session.rooms):
+            self.leave_room(room, False)
+        self.server.remove_client(self.session.username)
+
+    def resume_user(self, username, rooms, active_room):
+        self.login_user(username)
+        for room in rooms:
+            self.join_room(room, False)
+        if active_room in self.session.rooms:
+            self.session.active_room = active_room
+
+    def disconnect_user(self):
+        # The connection was lost, so the session is kept for the client to resume it
+        rooms = list(self.session.rooms)
+        active_room = self.session.active_room
+        self.logout_user()
+        if self.server.resume_timeout:
+            self.server.suspend_session(self.session.resume_token, self.session.username, rooms, active_room)
+
+    def join_room(self, room, notify_room=True):
+        newly_joined = self.server.add_room_member(room, self.session.username)
+        self.session.rooms.add(room)
+        self.session.active_room = room
+        if notify_room and newly_joined:
+            joined_json = self.server.request_parser.user_joined_room_json(self.session, room)
+            self.send_message_to_room(room, joined_json, self.session.username)
+
+    def leave_room(self, room, notify_room=True):
+        self.server.remove_room_member(room, self.session.username)
+        self.session.rooms.discard(room)
+        if self.session.active_room == room:
+            # Messages go to one of the other joined rooms, if any
+            self.session.active_room = next(iter(self.session.rooms), None)
+        if notify_room:
+            left_json = self.server.request_parser.user_left_room_json(self.session, room)
+            self.send_message_to_room(room, left_json)
+
+    def send_message_to_room(self, room, message_json, excluded_username=None):
+        # The response is encoded to a frame only once per encoding, for all recipients
+        self.server.send_to_room(room, message_json, excluded_username)
+
+    def send_direct_message(self, content, message_json):
+        """
+        Only the recipient is looked up, so no other client is touched.
+        The sender gets a copy of the message, or an error if the recipient logged out.
+        """
+        recipient = self.server.request_parser.split_direct_message(content)[0]
+        if not self.server.send_to_user(recipient, message_json):
+            self.send_json(self.outbound, self.server.request_parser.user_not_logged_in_json(recipient))
+        elif not recipient == self.session.username:
+            self.send_json(self.outbound, message_json)
+
+    def send_room_message(self, content, message_json):
+        # The message is written to the history by the log writer thread, and sent with its sequence number
+        now = time.time()
+        room = self.session.active_room
+        record = \
+            {
+                'timestamp': time.asctime(time.localtime(now)),
+                'sender': self.session.username,
+                'content': content,
+                'room': room
+            }
+        self.server.send_room_message(room, message_json, record, now)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from BinaryEncoding import JSON
+from Framing import NO_COMPRESSION
+
+
+class ClientSession(object):
+
+    """
+    The login state of one connected client, used by the shared ServerMessageParser.
+    Uses __slots__, as there is one session for every connection, and most of the
+    connections of a large server are idle.
+    """
+
+    __slots__ = ('username', 'logged_in', 'rooms', 'active_room', 'encoding', 'compression', 'request_bucket',
+                 'rate_limited', 'resume_token')
+
+    def __init__(self, request_bucket=None):
+        self.username = ""
+        self.logged_in = False
+        # The rooms the client has joined, and the room messages from the client are sent to
+        self.rooms = set()
+        self.active_room = None
+        # The encoding of the responses to the client, see BinaryEncoding.py
+        self.encoding = JSON
+        # Whether large frames to the client are compressed, see Framing.py
+        self.compression = NO_COMPRESSION
+        # Limits the requests of the client (a TokenBucket, None if not limited), see RateLimiter.py.
+        # rate_limited is True while the requests are refused, so the client is only told once
+        self.request_bucket = request_bucket
+        self.rate_limited = False
+        # Given to the client at login, to resume the session if the connection is lost
+        self.resume_token = None
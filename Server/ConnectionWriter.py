@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from threading import Thread
+import socket
+from Metrics import metrics
+
+
+class ConnectionWriter(Thread):
+
+    """
+    Writes the frames of an OutboundQueue to a client socket. Used in threaded mode,
+    where every ClientHandler has one ConnectionWriter, so that a blocking sendall()
+    only ever stalls the client it is writing to. The frames queued since the last
+    write are written together, with a single sendall().
+    """
+
+    def __init__(self, connection, outbound_queue):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.connection = connection
+        self.outbound_queue = outbound_queue
+
+    def run(self):
+        try:
+            while True:
+                frames = self.outbound_queue.get_frames()
+                if frames is None:
+                    break
+                self.connection.sendall("".join(frames))
+                metrics.observe('chat_write_frames', len(frames))
+        except socket.error:
+            self.outbound_queue.close()
+            self.disconnect()
+        if self.outbound_queue.overflowed:
+            self.disconnect()
+
+    def disconnect(self):
+        # Makes the blocking recv() in ClientHandler.handle return, so the client is logged out
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+
+
+class Histogram(object):
+
+    """
+    Counts observed values in buckets with fixed upper bounds, as in the text format
+    of Prometheus: a value is counted in the first bucket it is not larger than, and
+    values above the last bound only in the count. Not thread safe, see Metrics.py
+    """
+
+    __slots__ = ('bounds', 'bucket_counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.bucket_counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        if index < len(self.bounds):
+            self.bucket_counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        # (bound, number of values not larger than the bound)
+        cumulative_counts = []
+        total = 0
+        for bound, bucket_count in zip(self.bounds, self.bucket_counts):
+            total += bucket_count
+            cumulative_counts.append((bound, total))
+        return cumulative_counts
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from threading import Thread, Event
+import time
+from Metrics import metrics
+
+"""
+Keeps the message history from growing without bound. Runs in the process writing
+the history, and every check_interval seconds:
+
+    - deletes the oldest segments whose last message is older than retention_seconds
+    - deletes the oldest segments while the history is larger than max_bytes
+    - compresses the segments whose last message is older than archive_after_seconds
+
+The segment written to is never compressed or deleted, so a limit is only kept to
+the size of a segment (see HistoryStore.py). A limit of 0 turns it off.
+"""
+
+
+class HistoryRetention(Thread):
+
+    def __init__(self, history_store, archive_after_seconds=0, retention_seconds=0, max_bytes=0,
+                 check_interval=60.0):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.history_store = history_store
+        self.archive_after_seconds = archive_after_seconds
+        self.retention_seconds = retention_seconds
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.stopped = Event()
+
+    def run(self):
+        metrics.set_callback('chat_history_bytes', self.history_store.get_size)
+        while not self.stopped.wait(self.check_interval):
+            try:
+                self.apply()
+            except (IOError, OSError) as error:
+                # Tried again at the next check
+                print "History retention failed: " + str(error)
+
+    def apply(self):
+        now = time.time()
+        closed_segments = self.history_store.get_closed_segments()
+        # Deleted oldest first, as the sequence numbers in the history must stay contiguous
+        total_size = self.history_store.get_size()
+        while closed_segments:
+            first_seq, last_timestamp, size, compressed = closed_segments[0]
+            too_old = self.retention_seconds and now - last_timestamp > self.retention_seconds
+            too_large = self.max_bytes and total_size > self.max_bytes
+            if not too_old and not too_large:
+                break
+            self.history_store.delete_oldest_segment()
+            metrics.increment('chat_history_segments_deleted_total')
+            total_size -= size
+            closed_segments.pop(0)
+        if self.archive_after_seconds:
+            for first_seq, last_timestamp, size, compressed in closed_segments:
+                if not compressed and now - last_timestamp > self.archive_after_seconds:
+                    self.history_store.archive_segment(first_seq)
+                    metrics.increment('chat_history_segments_archived_total')
+
+    def stop(self):
+        # Waits for a segment that is being compressed, so the history is not closed meanwhile
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import shutil
+import struct
+import json
+import time
+import bisect
+import threading
+
+"""
+Append-only store for the message history.
+
+Messages are numbered with a sequence number (starting at 1), and appended to
+segment files. When a segment grows larger than max_segment_bytes a new segment is
+started. Every segment has a sidecar index file, so that a message can be found
+without reading the segment from the start:
+
+    <first seq>.seg     records:  seq (8 bytes) | epoch timestamp (8 bytes) |
+                                  length (4 bytes) | json payload (length bytes)
+    <first seq>.idx     entries:  seq (8 bytes) | epoch timestamp (8 bytes) |
+                                  offset of the record in the segment (8 bytes)
+
+A new segment is also started when the first message of the current segment is
+older than max_segment_seconds (if set). Old segments may be compressed to
+<first seq>.seg.gz (the index is kept as it is) or deleted, see HistoryRetention.py.
+Reads span the live and the compressed segments, so clients do not see the
+difference, but a compressed segment is slower to read, as it is decompressed up
+to the message that is read.
+
+The sequence numbers in a segment are contiguous, so the index entry of a sequence
+number is found directly from its position, and timestamps are found with a binary
+search over the index. Reading a range of messages therefore costs the same no
+matter how large the history grows.
+
+Writes are buffered, and flushed before reads and when the store is closed.
+LogWriter writes to the store in batches from its own thread.
+
+A store may also be opened read only, by processes that read the history while
+another process writes it (see MultiProcessServer.py). It then looks for new
+messages and segments before every read.
+"""
+
+RECORD_HEADER = struct.Struct('!QdI')
+INDEX_ENTRY = struct.Struct('!QdQ')
+
+SEGMENT_EXTENSION = '.seg'
+INDEX_EXTENSION = '.idx'
+ARCHIVE_EXTENSION = '.seg.gz'
+
+
+class HistoryStore:
+
+    def __init__(self, directory, max_segment_bytes=64 * 1024 * 1024, write_buffer_bytes=64 * 1024,
+                 read_only=False, max_segment_seconds=0):
+        self.directory = directory
+        self.read_only = read_only
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.write_buffer_bytes = write_buffer_bytes
+        self.lock = threading.RLock()
+        # First sequence number of every segment, sorted, and of the compressed segments
+        self.segments = []
+        self.archived = set()
+        self.segment_file = None
+        self.index_file = None
+        self.segment_size = 0
+        # Timestamp of the first message in the current segment, None if it is empty
+        self.segment_start_time = None
+        self.last_seq = 0
+        self.dirty = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.open_segments()
+
+    """
+        Opening and recovery
+    """
+
+    def open_segments(self):
+        self.segments, self.archived = self.list_segments()
+        if self.read_only:
+            self.refresh()
+            return
+        if not self.segments:
+            self.start_segment(1)
+            return
+        first_seq = self.segments[-1]
+        self.recover_segment(first_seq)
+        self.segment_file = open(self.segment_path(first_seq), 'ab', self.write_buffer_bytes)
+        self.index_file = open(self.index_path(first_seq), 'ab', self.write_buffer_bytes)
+        self.segment_size = os.path.getsize(self.segment_path(first_seq))
+        self.last_seq = first_seq - 1 + os.path.getsize(self.index_path(first_seq)) // INDEX_ENTRY.size
+        if self.last_seq >= first_seq:
+            self.segment_start_time = self.read_index_entry(first_seq, 0)[1]
+
+    def list_segments(self):
+        # Returns the sorted first sequence numbers of the segments, and the set of those that are compressed
+        segments = set()
+        archived = set()
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(SEGMENT_EXTENSION):
+                segments.add(int(file_name[:-len(SEGMENT_EXTENSION)]))
+            elif file_name.endswith(ARCHIVE_EXTENSION):
+                archived.add(int(file_name[:-len(ARCHIVE_EXTENSION)]))
+        return sorted(segments | archived), archived
+
+    def refresh(self):
+        """
+        Makes the messages written so far readable. A writable store flushes its buffers,
+        a read only store finds the messages written by the other process.
+        """
+        with self.lock:
+            if not self.read_only:
+                self.flush()
+                return
+            segments, self.archived = self.list_segments()
+            if not segments:
+                # Nothing has been written yet
+                segments = [1]
+                self.last_seq = 0
+            else:
+                index_path = self.index_path(segments[-1])
+                entries = os.path.getsize(index_path) // INDEX_ENTRY.size if os.path.exists(index_path) else 0
+                self.last_seq = segments[-1] - 1 + entries
+            self.segments = segments
+
+    def recover_segment(self, first_seq):
+        """
+        The last segment may have been cut off if the server was stopped while writing.
+        Removes incomplete records and index entries, and indexes the records that
+        were written to the segment but not to the index.
+        """
+        segment_path = self.segment_path(first_seq)
+        index_path = self.index_path(first_seq)
+        if not os.path.exists(index_path):
+            open(index_path, 'wb').close()
+        segment_size = os.path.getsize(segment_path)
+        entries = os.path.getsize(index_path) // INDEX_ENTRY.size
+        # The index must not point to records that were never written
+        while entries > 0 and self.read_index_entry(first_seq, entries - 1)[2] + RECORD_HEADER.size > segment_size:
+            entries -= 1
+        offset = 0
+        if entries > 0:
+            # The last indexed record is checked again, as it may be incomplete
+            entries -= 1
+            offset = self.read_index_entry(first_seq, entries)[2]
+        with open(index_path, 'r+b') as index:
+            index.truncate(entries * INDEX_ENTRY.size)
+            index.seek(0, os.SEEK_END)
+            with open(segment_path, 'r+b') as segment:
+                segment.seek(offset)
+                while True:
+                    header = segment.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    seq, timestamp, length = RECORD_HEADER.unpack(header)
+                    if offset + RECORD_HEADER.size + length > segment_size:
+                        break
+                    index.write(INDEX_ENTRY.pack(seq, timestamp, offset))
+                    offset += RECORD_HEADER.size + length
+                    segment.seek(offset)
+                segment.truncate(offset)
+
+    def start_segment(self, first_seq):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.index_file.close()
+        self.segment_file = open(self.segment_path(first_seq), 'ab', self.write_buffer_bytes)
+        self.index_file = open(self.index_path(first_seq), 'ab', self.write_buffer_bytes)
+        self.segment_size = 0
+        self.segment_start_time = None
+        if not self.segments or self.segments[-1] != first_seq:
+            self.segments.append(first_seq)
+
+    def segment_path(self, first_seq):
+        return os.path.join(self.directory, '%020d' % first_seq + SEGMENT_EXTENSION)
+
+    def index_path(self, first_seq):
+        return os.path.join(self.directory, '%020d' % first_seq + INDEX_EXTENSION)
+
+    def archive_path(self, first_seq):
+        return os.path.join(self.directory, '%020d' % first_seq + ARCHIVE_EXTENSION)
+
+    """
+        Writing
+    """
+
+    def append(self, record, timestamp=None):
+        """
+        Appends a message (a dictionary that can be encoded to json) to the history.
+        Returns the sequence number of the message.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        return self.append_batch([(record, timestamp)])[0]
+
+    def append_batch(self, messages):
+        """
+        Appends a list of (record, timestamp) tuples. The records of a batch are
+        joined, so the whole batch is written to the segment (and to the index) with
+        a single write, unless the batch starts a new segment.
+        Returns the sequence numbers of the messages.
+        """
+        encoded_messages = [(json.dumps(record), timestamp) for record, timestamp in messages]
+        seqs = []
+        with self.lock:
+            records = []
+            index_entries = []
+            # last_seq only counts the messages that were written
+            seq = self.last_seq
+            for payload, timestamp in encoded_messages:
+                if self.segment_size >= self.max_segment_bytes or self.segment_is_expired(timestamp):
+                    self.write_records(records, index_entries)
+                    self.last_seq = seq
+                    records = []
+                    index_entries = []
+                    self.flush()
+                    self.start_segment(seq + 1)
+                seq += 1
+                records.append(RECORD_HEADER.pack(seq, timestamp, len(payload)) + payload)
+                index_entries.append(INDEX_ENTRY.pack(seq, timestamp, self.segment_size))
+                self.segment_size += RECORD_HEADER.size + len(payload)
+                if self.segment_start_time is None:
+                    self.segment_start_time = timestamp
+                seqs.append(seq)
+            self.write_records(records, index_entries)
+            self.last_seq = seq
+        return seqs
+
+    def segment_is_expired(self, timestamp):
+        return self.max_segment_seconds and self.segment_start_time is not None and \
+            timestamp - self.segment_start_time >= self.max_segment_seconds
+
+    def write_records(self, records, index_entries):
+        if records:
+            self.segment_file.write(''.join(records))
+            self.index_file.write(''.join(index_entries))
+            self.dirty = True
+
+    def recover(self):
+        """
+        Reopens the last segment after a failed write or flush. The buffered data that
+        could not be written is dropped, and the records that were written completely
+        are kept, so last_seq tells which messages are in the history.
+        """
+        with self.lock:
+            for open_file in [self.segment_file, self.index_file]:
+                if open_file is not None:
+                    try:
+                        open_file.close()
+                    except (IOError, OSError):
+                        pass
+            self.segment_file = None
+            self.index_file = None
+            self.dirty = False
+            self.open_segments()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                # The segment is flushed first, so the index never points past the data
+                self.segment_file.flush()
+                self.index_file.flush()
+                self.dirty = False
+
+    def sync(self):
+        # Makes sure the written messages are stored on disk, and not only in the OS cache
+        with self.lock:
+            self.flush()
+            os.fsync(self.segment_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        if self.read_only:
+            return
+        with self.lock:
+            self.flush()
+            self.segment_file.close()
+            self.index_file.close()
+
+    """
+        Reading
+    """
+
+    def first_seq(self):
+        return self.segments[0]
+
+    def read_range(self, start_seq, count):
+        """
+        Returns up to count messages, starting at start_seq, as a list of
+        (seq, timestamp, record) tuples. Messages deleted by the retention are left
+        out, so the messages are always before start_seq + count
+        """
+        with self.lock:
+            self.refresh()
+            end_seq = min(start_seq + count, self.last_seq + 1)
+            start_seq = max(start_seq, self.first_seq())
+            segments = list(self.segments)
+        messages = []
+        seq = start_seq
+        try:
+            while seq < end_seq:
+                segment_number = bisect.bisect_right(segments, seq) - 1
+                first_seq = segments[segment_number]
+                with open(self.index_path(first_seq), 'rb') as index:
+                    index.seek((seq - first_seq) * INDEX_ENTRY.size)
+                    offset = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[2]
+                with self.open_segment(first_seq) as segment:
+                    segment.seek(offset)
+                    while seq < end_seq:
+                        header = segment.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            # The rest of the range is in the next segment
+                            break
+                        record_seq, timestamp, length = RECORD_HEADER.unpack(header)
+                        messages.append((record_seq, timestamp, json.loads(segment.read(length))))
+                        seq += 1
+        except (IOError, OSError):
+            # The segment was deleted by the retention while reading it
+            pass
+        return messages
+
+    def open_segment(self, first_seq):
+        # Opens a segment for reading, whether it is compressed or not
+        if first_seq not in self.archived:
+            try:
+                return open(self.segment_path(first_seq), 'rb')
+            except IOError:
+                # Compressed since the segments were listed (by another process)
+                pass
+        return gzip.open(self.archive_path(first_seq), 'rb')
+
+    def read_last(self, count):
+        # Returns the last count messages
+        self.refresh()
+        return self.read_range(self.last_seq - count + 1, count)
+
+    def find_seq_by_timestamp(self, timestamp):
+        """
+        Returns the sequence number of the first message logged at or after the
+        timestamp, or last_seq + 1 if there is no such message
+        """
+        with self.lock:
+            self.refresh()
+            segments = list(self.segments)
+            last_seq = self.last_seq
+        # The segment where the message may be is found from the first index entry of each segment
+        low, high = 0, len(segments)
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_index_entry(segments[middle], 0)[1] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        segment_number = max(low - 1, 0)
+        first_seq = segments[segment_number]
+        if segment_number + 1 < len(segments):
+            entries = segments[segment_number + 1] - first_seq
+        else:
+            entries = last_seq - first_seq + 1
+        low, high = 0, entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.read_index_entry(first_seq, middle)[1] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return first_seq + low
+
+    def read_index_entry(self, first_seq, position):
+        with open(self.index_path(first_seq), 'rb') as index:
+            index.seek(position * INDEX_ENTRY.size)
+            entry = index.read(INDEX_ENTRY.size)
+        if len(entry) < INDEX_ENTRY.size:
+            # Empty segment
+            return None, float('inf'), None
+        return INDEX_ENTRY.unpack(entry)
+
+    """
+        Archiving and retention, used by HistoryRetention
+    """
+
+    def get_closed_segments(self):
+        """
+        Returns the segments that are no longer written to, oldest first, as a list of
+        (first seq, timestamp of the last message, size in bytes, compressed) tuples
+        """
+        with self.lock:
+            segments = list(self.segments)
+            archived = set(self.archived)
+        closed_segments = []
+        for first_seq, next_first_seq in zip(segments, segments[1:]):
+            last_timestamp = self.read_index_entry(first_seq, next_first_seq - first_seq - 1)[1]
+            compressed = first_seq in archived
+            path = self.archive_path(first_seq) if compressed else self.segment_path(first_seq)
+            size = os.path.getsize(path) + os.path.getsize(self.index_path(first_seq))
+            closed_segments.append((first_seq, last_timestamp, size, compressed))
+        return closed_segments
+
+    def get_size(self):
+        # Bytes used by the history on disk
+        size = 0
+        for file_name in os.listdir(self.directory):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, file_name))
+            except OSError:
+                # Renamed or deleted by the retention since the directory was listed
+                pass
+        return size
+
+    def archive_segment(self, first_seq):
+        """
+        Compresses a closed segment. The store is not locked while compressing, so
+        messages are still written and read meanwhile.
+        """
+        with self.lock:
+            if self.read_only or first_seq == self.segments[-1] or first_seq in self.archived:
+                return False
+        temporary_path = self.archive_path(first_seq) + '.tmp'
+        with open(self.segment_path(first_seq), 'rb') as segment:
+            archive = gzip.open(temporary_path, 'wb')
+            try:
+                shutil.copyfileobj(segment, archive, 1024 * 1024)
+            finally:
+                archive.close()
+        # Readers that listed the segment before it was compressed fall back to the archive
+        os.rename(temporary_path, self.archive_path(first_seq))
+        with self.lock:
+            self.archived.add(first_seq)
+        os.remove(self.segment_path(first_seq))
+        return True
+
+    def delete_oldest_segment(self):
+        # Deletes the oldest segment, unless it is the one written to. Returns its first seq, or None
+        with self.lock:
+            if self.read_only or len(self.segments) < 2:
+                return None
+            first_seq = self.segments.pop(0)
+            self.archived.discard(first_seq)
+        for path in [self.segment_path(first_seq), self.archive_path(first_seq), self.index_path(first_seq)]:
+            if os.path.exists(path):
+                os.remove(path)
+        return first_seq
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from threading import Thread
+import time
+from TimerWheel import TimerWheel
+from Metrics import metrics
+
+"""
+Finds connections whose client stopped answering, e.g. half-open sockets left by a
+client that lost its network, which would otherwise stay connected (and logged in)
+forever, as recv() never returns for them.
+
+A client that sent nothing for heartbeat_interval seconds is sent a 'ping', which
+it answers with a 'pong' request. A client that sent nothing for idle_timeout
+seconds is disconnected, so a logged in user can resume the session later.
+
+Every connection has one timer in a TimerWheel, which is not moved when data is
+received: the handler only keeps the time it last received data (last_read_time).
+When the timer fires, it is set again from that time, so a busy connection costs a
+timer every heartbeat_interval, and not one for every request.
+
+The handlers must provide last_read_time, send_ping() and close_idle().
+In threaded mode the reaper runs as its own thread. The async server calls check()
+from its event loop instead, as its handlers may only be closed by the loop.
+"""
+
+
+class IdleReaper(Thread):
+
+    def __init__(self, idle_timeout, heartbeat_interval=0, tick=1.0):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.tick = tick
+        self.timers = TimerWheel(time.time(), tick)
+
+    def add(self, handler):
+        self.timers.schedule(handler, self.get_next_check(handler.last_read_time))
+
+    def remove(self, handler):
+        self.timers.cancel(handler)
+
+    def get_next_check(self, last_read_time):
+        # When the client is pinged, or disconnected if heartbeats are off
+        return last_read_time + (self.heartbeat_interval or self.idle_timeout)
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.check(time.time())
+
+    def check(self, now):
+        for handler in self.timers.expire(now):
+            last_read_time = handler.last_read_time
+            idle_time = now - last_read_time
+            if idle_time >= self.idle_timeout:
+                metrics.increment('chat_idle_disconnects_total')
+                handler.close_idle()
+            elif self.heartbeat_interval and idle_time >= self.heartbeat_interval:
+                metrics.increment('chat_pings_total')
+                handler.send_ping()
+                self.timers.schedule(handler, last_read_time + self.idle_timeout)
+            else:
+                # Data was received since the timer was set
+                self.timers.schedule(handler, self.get_next_check(last_read_time))
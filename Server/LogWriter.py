@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from threading import Thread, Lock
+from Queue import Queue, Empty
+import time
+from Metrics import metrics
+
+
+class LogWriter(Thread):
+
+    """
+    Writes messages to the HistoryStore from its own thread, so that clients sending
+    messages never wait for the disk.
+
+    Messages are put on a queue by log(), which returns the sequence number the message
+    gets in the history, so it can be sent to the clients before it is written. The
+    writer takes all queued messages (up to max_batch_size) and writes them to the
+    store as one batch. When the disk is slow the queue grows and the batches get
+    larger, so the writer keeps up.
+
+    How often the written messages are synced to disk (fsync) is configurable:
+        - fsync_interval_ms     sync at most this many milliseconds after a write
+        - fsync_records         sync when this many records have been written since the last sync
+    If both are 0, the messages are never synced, and the OS decides when they are stored.
+
+    The messages are numbered (and sent to the clients) before they are written, so a
+    batch that can not be written (e.g. the disk is full) is not dropped. The error is
+    printed and counted, and the rest of the batch is written again every
+    retry_interval seconds, after the store was recovered from what is on disk.
+    """
+
+    retry_interval = 1.0
+
+    def __init__(self, history_store, max_batch_size=1000, fsync_interval_ms=0, fsync_records=0):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.history_store = history_store
+        self.max_batch_size = max_batch_size
+        self.fsync_interval_ms = fsync_interval_ms
+        self.fsync_records = fsync_records
+        self.queue = Queue()
+        # The sequence number of the last message queued. Numbered under the lock, so the
+        # messages are queued (and written) in the order of their numbers
+        self.last_numbered_seq = history_store.last_seq
+        self.numbering_lock = Lock()
+        self.stop_marker = object()
+        self.stopped = False
+        # Set by stop(), so a batch that can not be written is given up
+        self.stop_requested = False
+        # The messages written are added to the search_index (a SearchIndex), if there is one
+        self.search_index = None
+        # Compresses and deletes old history (a HistoryRetention), if there is one
+        self.history_retention = None
+
+        # Records written since the last fsync, and when the first of them was written
+        self.unsynced_records = 0
+        self.first_unsynced_time = None
+
+        # Metrics
+        self.metrics_lock = Lock()
+        self.batches_written = 0
+        self.records_written = 0
+        self.max_batch_written = 0
+        self.max_queue_depth = 0
+        self.fsyncs = 0
+
+    def log(self, record, timestamp=None):
+        # Queues a message (a dictionary that can be encoded to json) for writing. Returns its sequence number
+        if timestamp is None:
+            timestamp = time.time()
+        with self.numbering_lock:
+            self.last_numbered_seq += 1
+            self.queue.put((record, timestamp))
+            return self.last_numbered_seq
+
+    def run(self):
+        # Registered and started here, as the LogWriter is copied to the worker processes, but only runs in one
+        metrics.set_callback('chat_log_queue_depth', self.queue.qsize)
+        if self.history_retention is not None:
+            self.history_retention.start()
+        while not self.stopped:
+            batch = self.get_batch()
+            if batch:
+                start_time = time.time()
+                seqs = self.write_batch(batch)
+                if seqs is None:
+                    break
+                metrics.observe('chat_log_write_seconds', time.time() - start_time)
+                metrics.increment('chat_log_records_total', len(batch))
+                self.record_batch(len(batch))
+                if self.search_index is not None:
+                    self.search_index.add_messages([(seq, record) for seq, (record, timestamp) in zip(seqs, batch)])
+                self.unsynced_records += len(batch)
+                if self.first_unsynced_time is None:
+                    self.first_unsynced_time = time.time()
+            if self.sync_is_due():
+                try:
+                    self.sync()
+                except (IOError, OSError) as error:
+                    # The written messages are synced again with the next batch
+                    metrics.increment('chat_log_write_errors_total')
+                    print "Syncing the history failed: " + str(error)
+
+    def write_batch(self, batch):
+        # Returns the sequence numbers of the messages, or None if the batch was given up when stopping
+        first_seq = self.history_store.last_seq + 1
+        failed = False
+        while True:
+            try:
+                if failed:
+                    self.history_store.recover()
+                written = self.history_store.last_seq + 1 - first_seq
+                self.history_store.append_batch(batch[written:])
+                self.history_store.flush()
+                return range(first_seq, first_seq + len(batch))
+            except (IOError, OSError) as error:
+                failed = True
+                metrics.increment('chat_log_write_errors_total')
+                print "Writing the history failed: " + str(error)
+                if self.stop_requested:
+                    print "Stopped without writing the last " + str(len(batch) - written) + " messages, " \
+                          "and the messages still queued."
+                    return None
+                time.sleep(self.retry_interval)
+
+    def get_batch(self):
+        """
+        Blocks until there is at least one message in the queue, then takes the rest
+        of the queued messages without blocking. When waiting for an interval fsync,
+        the wait is limited so the sync is not delayed.
+        """
+        batch = []
+        timeout = None
+        if self.fsync_interval_ms and self.first_unsynced_time is not None:
+            timeout = max(self.first_unsynced_time + self.fsync_interval_ms / 1000.0 - time.time(), 0)
+        try:
+            item = self.queue.get(timeout=timeout) if timeout is not None else self.queue.get()
+            while True:
+                if item is self.stop_marker:
+                    self.stopped = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_batch_size:
+                    break
+                item = self.queue.get_nowait()
+        except Empty:
+            pass
+        return batch
+
+    def sync_is_due(self):
+        if self.unsynced_records == 0:
+            return False
+        if self.stopped and (self.fsync_interval_ms or self.fsync_records):
+            return True
+        if self.fsync_records and self.unsynced_records >= self.fsync_records:
+            return True
+        if self.fsync_interval_ms and \
+                time.time() - self.first_unsynced_time >= self.fsync_interval_ms / 1000.0:
+            return True
+        return False
+
+    def sync(self):
+        self.history_store.sync()
+        self.unsynced_records = 0
+        self.first_unsynced_time = None
+        with self.metrics_lock:
+            self.fsyncs += 1
+
+    def record_batch(self, batch_size):
+        with self.metrics_lock:
+            self.batches_written += 1
+            self.records_written += batch_size
+            self.max_batch_written = max(self.max_batch_written, batch_size)
+            self.max_queue_depth = max(self.max_queue_depth, batch_size + self.queue.qsize())
+
+    def stop(self):
+        # Writes the messages that are already queued, and then stops the thread
+        if self.history_retention is not None:
+            self.history_retention.stop()
+        self.stop_requested = True
+        self.queue.put(self.stop_marker)
+        self.join()
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            average_batch_size = 0.0
+            if self.batches_written:
+                average_batch_size = float(self.records_written) / self.batches_written
+            return \
+                {
+                    'queue_depth': self.queue.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'batches_written': self.batches_written,
+                    'records_written': self.records_written,
+                    'average_batch_size': average_batch_size,
+                    'max_batch_size': self.max_batch_written,
+                    'fsyncs': self.fsyncs
+                }
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import marshal
+from Framing import encode_frame, FrameDecoder
+from Response import Response
+from SuspendedSessions import SuspendedSessions
+
+"""
+Message bus between the worker processes of the multi-process server (see MultiProcessServer.py).
+
+The MessageBusHub runs in the main process, and every worker connects to it with a
+BusClient. Events are tuples, encoded with marshal and sent as frames over Unix sockets.
+Responses are sent as the tuple of their fields (see Response.py).
+
+The hub knows which worker serves each logged in user, and the members of every
+room, so it only relays an event to the workers that have a recipient for it:
+
+    worker -> hub
+        ('claim', username)                     reserve a username, answered with ('claimed', True/False)
+        ('resume', token)                       resume a suspended session, answered with
+                                                ('resumed', (username, rooms, active room) or None)
+        ('release', username)                   the user logged out
+        ('join', username, room)                the user joined a room
+        ('leave', username, room)               the user left a room
+        ('all', response, excluded_username)    send a response to all users
+        ('room', room, response, excluded_username)
+        ('user', username, response)            send a response to a single user
+        ('message', room, response, record, timestamp)
+                                                write a message to the history, and send it to
+                                                the room with its sequence number
+        ('suspend', token, username, rooms, active_room, expiry_time)
+                                                the connection of a logged in user was lost
+
+    hub -> worker
+        ('snapshot', usernames, rooms)          sent when the worker connects
+        ('online', username), ('offline', username)
+        ('join', username, room), ('leave', username, room)
+        ('all', ...), ('room', ...), ('user', ...) as above
+        ('message', room, response, record, timestamp)
+                                                a numbered message, sent to every worker, as
+                                                they all keep the recent messages in memory
+
+Claims (and the other requests that are answered) are sent on a separate connection,
+so that a worker can wait for the answer while its other connection is being read by
+the BusClient thread.
+
+Messages to rooms are numbered and sent on by the hub, under a lock, so every worker
+gets the messages in the order of their sequence numbers.
+"""
+
+EVENTS_CONNECTION = 'events'
+RPC_CONNECTION = 'rpc'
+
+
+def send_event(connection, event):
+    connection.sendall(encode_frame(marshal.dumps(event)))
+
+
+def receive_events(connection):
+    # Yields the events received on the connection until it is closed
+    frame_decoder = FrameDecoder()
+    while True:
+        data = connection.recv(65536)
+        if not data:
+            return
+        for payload in frame_decoder.feed(data):
+            yield marshal.loads(payload)
+
+
+class WorkerConnection:
+
+    # The events connection to a worker. Several hub threads may send to it at once.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+
+    def send(self, event):
+        try:
+            with self.send_lock:
+                send_event(self.connection, event)
+        except socket.error:
+            # The worker is gone, and is removed by its own thread
+            pass
+
+
+class MessageBusHub:
+
+    def __init__(self, path, log_writer):
+        self.path = path
+        self.log_writer = log_writer
+        self.lock = threading.Lock()
+        # Held while numbering and sending a message to a room
+        self.message_lock = threading.Lock()
+        self.suspended_sessions = SuspendedSessions()
+        # worker id -> WorkerConnection
+        self.workers = {}
+        # username -> id of the worker serving the user
+        self.usernames = {}
+        # room -> set of usernames
+        self.rooms = {}
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(128)
+
+    def start(self):
+        accept_thread = threading.Thread(target=self.accept_connections)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_connections(self):
+        while True:
+            try:
+                connection = self.listener.accept()[0]
+            except socket.error:
+                # The listener was closed
+                break
+            connection_thread = threading.Thread(target=self.serve_connection, args=(connection,))
+            connection_thread.daemon = True
+            connection_thread.start()
+
+    def serve_connection(self, connection):
+        events = receive_events(connection)
+        try:
+            hello, connection_type, worker_id = next(events)
+            if connection_type == RPC_CONNECTION:
+                for event in events:
+                    send_event(connection, self.handle_call(event, worker_id))
+            else:
+                self.serve_worker(WorkerConnection(connection), events, worker_id)
+        except (socket.error, StopIteration):
+            pass
+        finally:
+            connection.close()
+
+    def serve_worker(self, worker, events, worker_id):
+        with self.lock:
+            # Sent while holding the lock, so no event is lost between the snapshot and the registration
+            rooms = dict((room, list(members)) for room, members in self.rooms.iteritems())
+            worker.send(('snapshot', list(self.usernames), rooms))
+            self.workers[worker_id] = worker
+        try:
+            for event in events:
+                self.handle_event(event, worker_id)
+        finally:
+            with self.lock:
+                self.workers.pop(worker_id, None)
+                usernames = [username for username, owner in self.usernames.iteritems() if owner == worker_id]
+            # The users of a stopped worker are logged out
+            for username in usernames:
+                self.release_username(username, worker_id)
+
+    def handle_event(self, event, worker_id):
+        event_type = event[0]
+        if event_type == 'message':
+            self.send_room_message(event[1], Response.from_tuple(event[2]), event[3], event[4])
+        elif event_type == 'suspend':
+            self.suspended_sessions.suspend(*event[1:])
+        elif event_type == 'release':
+            self.release_username(event[1], worker_id)
+        elif event_type == 'join':
+            with self.lock:
+                self.rooms.setdefault(event[2], set()).add(event[1])
+            self.send_to_workers(event)
+        elif event_type == 'leave':
+            with self.lock:
+                self.remove_room_member(event[2], event[1])
+            self.send_to_workers(event)
+        elif event_type == 'all':
+            self.send_to_workers(event, worker_id)
+        elif event_type == 'room':
+            with self.lock:
+                worker_ids = set(self.usernames.get(username) for username in self.rooms.get(event[1], ()))
+            self.send_to_workers(event, worker_id, worker_ids)
+        elif event_type == 'user':
+            with self.lock:
+                owner = self.usernames.get(event[1])
+            if owner is not None:
+                self.send_to_workers(event, worker_id, [owner])
+
+    def handle_call(self, event, worker_id):
+        # Returns the answer to a request sent on the rpc connection of a worker
+        event_type = event[0]
+        if event_type == 'claim':
+            return 'claimed', self.claim_username(event[1], worker_id)
+        elif event_type == 'resume':
+            return 'resumed', self.resume_session(event[1], worker_id)
+        return 'unknown', None
+
+    def send_room_message(self, room, response, record, timestamp):
+        with self.message_lock:
+            response.seq = self.log_writer.log(record, timestamp)
+            self.send_to_workers(('message', room, response.to_tuple(), record, timestamp))
+
+    def send_to_workers(self, event, excluded_worker_id=None, worker_ids=None):
+        with self.lock:
+            if worker_ids is None:
+                worker_ids = self.workers.keys()
+            workers = [self.workers[worker_id] for worker_id in worker_ids
+                       if worker_id in self.workers and not worker_id == excluded_worker_id]
+        for worker in workers:
+            worker.send(event)
+
+    def claim_username(self, username, worker_id):
+        with self.lock:
+            if username in self.usernames:
+                return False
+            self.usernames[username] = worker_id
+        self.send_to_workers(('online', username))
+        return True
+
+    def resume_session(self, token, worker_id):
+        """
+        Returns the (username, rooms, active room) of a suspended session, or None. The
+        user is claimed for the worker, and added to the rooms right away, so the room
+        sizes are right before the worker has joined the rooms again.
+        """
+        session = self.suspended_sessions.resume(token)
+        if session is None:
+            return None
+        username, rooms, active_room = session
+        with self.lock:
+            if username in self.usernames:
+                return None
+            self.usernames[username] = worker_id
+            for room in rooms:
+                self.rooms.setdefault(room, set()).add(username)
+        self.send_to_workers(('online', username))
+        for room in rooms:
+            self.send_to_workers(('join', username, room))
+        return session
+
+    def release_username(self, username, worker_id):
+        with self.lock:
+            if not self.usernames.get(username) == worker_id:
+                return
+            self.usernames.pop(username)
+            for room in list(self.rooms):
+                self.remove_room_member(room, username)
+        self.send_to_workers(('offline', username))
+
+    def remove_room_member(self, room, username):
+        # Must be called with the lock held
+        members = self.rooms.get(room, set())
+        members.discard(username)
+        if not members:
+            self.rooms.pop(room, None)
+
+    def close(self):
+        self.listener.close()
+
+
+class BusClient(threading.Thread):
+
+    """
+    The connection of a worker process to the MessageBusHub. Used by the server of the
+    worker as its message_bus (see ChatServerMixin).
+
+    The thread receives the events relayed by the hub, delivers responses to the clients
+    of this worker, and keeps a copy of the logged in users and the room members of
+    all workers.
+    """
+
+    def __init__(self, path, worker_id):
+        threading.Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.server = None
+        self.lock = threading.Lock()
+        self.usernames = set()
+        self.rooms = {}
+
+        self.events_connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.events_connection.connect(path)
+        send_event(self.events_connection, ('hello', EVENTS_CONNECTION, worker_id))
+        self.send_lock = threading.Lock()
+
+        self.rpc_connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.rpc_connection.connect(path)
+        send_event(self.rpc_connection, ('hello', RPC_CONNECTION, worker_id))
+        self.rpc_replies = receive_events(self.rpc_connection)
+        self.rpc_lock = threading.Lock()
+
+    def start_serving(self, server):
+        # Events are only read once the server can deliver them
+        self.server = server
+        self.start()
+
+    def run(self):
+        try:
+            for event in receive_events(self.events_connection):
+                self.handle_event(event)
+        except socket.error:
+            pass
+        print "Lost the connection to the message bus."
+
+    def handle_event(self, event):
+        event_type = event[0]
+        if event_type == 'all':
+            self.server.deliver_to_all(Response.from_tuple(event[1]), event[2])
+            self.server.wake()
+        elif event_type == 'room':
+            self.server.deliver_to_room(event[1], Response.from_tuple(event[2]), event[3])
+            self.server.wake()
+        elif event_type == 'message':
+            response = Response.from_tuple(event[2])
+            self.server.recent_messages.add(response.seq, event[4], event[3])
+            self.server.deliver_to_room(event[1], response)
+            self.server.wake()
+        elif event_type == 'user':
+            self.server.deliver_to_user(event[1], Response.from_tuple(event[2]))
+            self.server.wake()
+        else:
+            with self.lock:
+                if event_type == 'snapshot':
+                    self.usernames = set(event[1])
+                    self.rooms = dict((room, set(members)) for room, members in event[2].iteritems())
+                elif event_type == 'online':
+                    self.usernames.add(event[1])
+                elif event_type == 'offline':
+                    self.usernames.discard(event[1])
+                    for room in list(self.rooms):
+                        self.remove_room_member(room, event[1])
+                elif event_type == 'join':
+                    self.rooms.setdefault(event[2], set()).add(event[1])
+                elif event_type == 'leave':
+                    self.remove_room_member(event[2], event[1])
+            # The presence of the worker is told about the users of all workers
+            if event_type == 'snapshot':
+                for username in event[1]:
+                    self.server.presence.add(username)
+            elif event_type == 'online':
+                self.server.presence.add(event[1])
+            elif event_type == 'offline':
+                self.server.presence.remove(event[1])
+
+    def remove_room_member(self, room, username):
+        # Must be called with the lock held
+        members = self.rooms.get(room, set())
+        members.discard(username)
+        if not members:
+            self.rooms.pop(room, None)
+
+    def publish(self, event):
+        with self.send_lock:
+            send_event(self.events_connection, event)
+
+    def call(self, event):
+        # Sends a request to the hub, and returns its answer
+        with self.rpc_lock:
+            send_event(self.rpc_connection, event)
+            return next(self.rpc_replies)[1]
+
+    def claim_username(self, username):
+        claimed = self.call(('claim', username))
+        if claimed:
+            # Known right away, instead of when the hub tells every worker
+            with self.lock:
+                self.usernames.add(username)
+        return claimed
+
+    def release_username(self, username):
+        self.publish(('release', username))
+
+    def resume_session(self, token):
+        session = self.call(('resume', token))
+        if session is not None:
+            username, rooms, active_room = session
+            # Known right away, instead of when the hub tells every worker
+            with self.lock:
+                self.usernames.add(username)
+                for room in rooms:
+                    self.rooms.setdefault(room, set()).add(username)
+        return session
+
+    def is_logged_in(self, username):
+        with self.lock:
+            return username in self.usernames
+
+    def get_room_sizes(self):
+        with self.lock:
+            return sorted((room, len(members)) for room, members in self.rooms.iteritems())
+
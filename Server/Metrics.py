@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+from Histogram import Histogram
+
+"""
+Counters, gauges and latency histograms of the server, shown in the text format of
+Prometheus by the AdminServer (see AdminServer.py):
+
+    # HELP chat_requests_total Requests handled, by request type.
+    # TYPE chat_requests_total counter
+    chat_requests_total{request="msg"} 1520
+
+Every metric is described once, at the end of this file. Values are kept per
+process, so with several workers every worker has its own admin port.
+Latencies are in seconds.
+"""
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+def format_labels(labels):
+    # labels is a tuple of (name, value) pairs
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = Lock()
+        # name -> (type, help, histogram bounds)
+        self.descriptions = {}
+        # name -> {labels: value, or Histogram}
+        self.values = {}
+        # name -> function returning the value, for values that are kept elsewhere
+        self.callbacks = {}
+
+    def describe(self, name, metric_type, help_text, bounds=LATENCY_BUCKETS):
+        self.descriptions[name] = (metric_type, help_text, bounds)
+        self.values[name] = {}
+
+    def increment(self, name, amount=1, labels=()):
+        # Also used to change a gauge
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histograms = self.values[name]
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = Histogram(self.descriptions[name][2])
+            histogram.observe(value)
+
+    def set_callback(self, name, function):
+        self.callbacks[name] = function
+
+    def render(self):
+        # The values are copied under the lock, and the callbacks are called after it,
+        # as they may be slow, and the lock is taken by every request
+        with self.lock:
+            callbacks = dict(self.callbacks)
+            sections = [(name, self.render_values(name)) for name in sorted(self.descriptions)
+                        if name not in callbacks]
+        sections.extend((name, None) for name in callbacks if name in self.descriptions)
+        lines = []
+        for name, value_lines in sorted(sections):
+            metric_type, help_text, bounds = self.descriptions[name]
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            if value_lines is not None:
+                lines.extend(value_lines)
+                continue
+            try:
+                lines.append(name + " " + format_value(callbacks[name]()))
+            except Exception as error:
+                # Only this metric is left out of the exposition
+                print "Reading the metric " + name + " failed: " + str(error)
+        return "\n".join(lines) + "\n"
+
+    def render_values(self, name):
+        # Must be called with the lock held
+        lines = []
+        if self.descriptions[name][0] == HISTOGRAM:
+            for labels, histogram in sorted(self.values[name].iteritems()):
+                for bound, count in histogram.get_cumulative_counts():
+                    lines.append(name + "_bucket" + format_labels(labels + (('le', bound),)) + " " + str(count))
+                lines.append(name + "_bucket" + format_labels(labels + (('le', '+Inf'),)) + " " +
+                             str(histogram.count))
+                lines.append(name + "_sum" + format_labels(labels) + " " + repr(histogram.sum))
+                lines.append(name + "_count" + format_labels(labels) + " " + str(histogram.count))
+        else:
+            for labels, value in sorted(self.values[name].iteritems()):
+                lines.append(name + format_labels(labels) + " " + format_value(value))
+        return lines
+
+
+# Shared by the whole process
+metrics = Metrics()
+
+# Connections and requests
+metrics.describe('chat_connections', GAUGE, "Connected clients.")
+metrics.describe('chat_connections_total', COUNTER, "Clients that connected.")
+metrics.describe('chat_logged_in_clients', GAUGE, "Logged in clients.")
+metrics.describe('chat_suspended_sessions', GAUGE, "Sessions of clients that lost their connection, "
+                                                   "which can still be resumed.")
+metrics.describe('chat_pings_total', COUNTER, "Pings sent to clients that sent nothing for a while.")
+metrics.describe('chat_idle_disconnects_total', COUNTER, "Clients disconnected as they sent nothing for too long.")
+metrics.describe('chat_requests_total', COUNTER, "Requests handled, by request type.")
+metrics.describe('chat_invalid_requests_total', COUNTER, "Requests that were not valid.")
+metrics.describe('chat_rate_limited_requests_total', COUNTER, "Requests refused by the rate limiter.")
+metrics.describe('chat_parse_seconds', HISTOGRAM, "Time to decode and verify a request.")
+metrics.describe('chat_request_seconds', HISTOGRAM, "Time to handle a request, by request type.")
+
+# Sending to clients
+metrics.describe('chat_fanout_seconds', HISTOGRAM, "Time to queue a message for the members of a room, "
+                                                   "or for every client.")
+metrics.describe('chat_fanout_recipients', HISTOGRAM, "Recipients of a message sent to a room, or to every client.",
+                 SIZE_BUCKETS)
+metrics.describe('chat_write_frames', HISTOGRAM, "Frames written to a client with a single write.", SIZE_BUCKETS)
+metrics.describe('chat_dropped_frames_total', COUNTER, "Frames dropped as the client did not read fast enough.")
+metrics.describe('chat_slow_consumer_disconnects_total', COUNTER,
+                 "Clients disconnected as they did not read fast enough.")
+
+# Message history
+metrics.describe('chat_log_write_seconds', HISTOGRAM, "Time to write a batch of messages to the history.")
+metrics.describe('chat_log_records_total', COUNTER, "Messages written to the history.")
+metrics.describe('chat_log_queue_depth', GAUGE, "Messages waiting to be written to the history.")
+metrics.describe('chat_log_write_errors_total', COUNTER, "Failed writes and syncs of the history, which are retried.")
+metrics.describe('chat_history_reads_total', COUNTER, "History reads, by whether they were served from the "
+                                                      "recent messages in memory or from disk.")
+metrics.describe('chat_history_bytes', GAUGE, "Size of the history on disk.")
+metrics.describe('chat_history_segments_archived_total', COUNTER, "History segments compressed.")
+metrics.describe('chat_history_segments_deleted_total', COUNTER, "History segments deleted by the retention.")
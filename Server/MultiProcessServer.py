@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import signal
+import socket
+import shutil
+import tempfile
+import time
+import traceback
+from MessageBus import MessageBusHub, BusClient
+from AdminServer import AdminServer
+from Metrics import metrics
+
+"""
+Runs the server as several worker processes, to use more than one CPU core.
+
+Every worker runs its own server (threaded or async) on the same port, using
+SO_REUSEPORT, so the kernel spreads the incoming connections over the workers.
+The workers share logged in users, rooms and messages through a MessageBusHub in
+the main process (see MessageBus.py).
+
+The history is written by the LogWriter of the main process only. The workers send
+their messages to it over the bus, and read the history with a read only HistoryStore.
+
+With an admin port, the main process serves the metrics of the LogWriter on it, and
+worker N (from 1) the metrics of its clients on the admin port + N.
+"""
+
+# Not defined by the socket module of every python version
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class MultiProcessServer:
+
+    # Seconds the workers get to close their clients when the server is stopped
+    shutdown_grace_period = 2.0
+
+    def __init__(self, worker_count, log_writer, admin_port=0):
+        self.worker_count = worker_count
+        self.log_writer = log_writer
+        self.admin_port = admin_port
+        self.bus_directory = tempfile.mkdtemp(prefix='chat-bus-')
+        self.bus_path = os.path.join(self.bus_directory, 'bus.sock')
+        self.worker_pids = []
+
+    def run(self, serve_worker):
+        """
+        Forks the workers, each calling serve_worker(bus_client, worker_number), and relays the
+        messages between them until the server is stopped (KeyboardInterrupt).
+        """
+        hub = MessageBusHub(self.bus_path, self.log_writer)
+        admin_server = None
+        # Output buffered before forking would otherwise be written by every worker
+        sys.stdout.flush()
+        try:
+            for worker_number in range(1, self.worker_count + 1):
+                pid = os.fork()
+                if pid == 0:
+                    hub.listener.close()
+                    self.run_worker(serve_worker, worker_number)
+                self.worker_pids.append(pid)
+            # Threads are started after forking, as only the forking thread lives on in a child
+            hub.start()
+            self.log_writer.start()
+            metrics.set_callback('chat_suspended_sessions', lambda: len(hub.suspended_sessions))
+            if self.admin_port:
+                admin_server = AdminServer(self.admin_port)
+                admin_server.start()
+            print "Started " + str(self.worker_count) + " workers."
+            while self.worker_pids:
+                pid = os.wait()[0]
+                self.worker_pids.remove(pid)
+        except KeyboardInterrupt:
+            self.stop_workers()
+        finally:
+            if admin_server is not None:
+                admin_server.stop()
+            hub.close()
+            shutil.rmtree(self.bus_directory, ignore_errors=True)
+
+    def run_worker(self, serve_worker, worker_number):
+        # Runs in the child process, which must never return to the code of the main process
+        exit_code = 0
+        try:
+            serve_worker(BusClient(self.bus_path, os.getpid()), worker_number)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        os._exit(exit_code)
+
+    def stop_workers(self):
+        # Workers that are still running after the grace period are killed
+        for pid in self.worker_pids:
+            self.signal_worker(pid, signal.SIGINT)
+        deadline = time.time() + self.shutdown_grace_period
+        while self.worker_pids and time.time() < deadline:
+            pid = os.waitpid(-1, os.WNOHANG)[0]
+            if pid:
+                self.worker_pids.remove(pid)
+            else:
+                time.sleep(0.05)
+        for pid in self.worker_pids:
+            self.signal_worker(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.worker_pids = []
+
+    @staticmethod
+    def signal_worker(pid, signal_number):
+        try:
+            os.kill(pid, signal_number)
+        except OSError:
+            # The worker has already stopped
+            pass
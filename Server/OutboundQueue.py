@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from BinaryEncoding import JSON
+from Metrics import metrics
+
+"""
+Bounded queue of encoded frames waiting to be written to one client.
+
+Broadcasts only put frames on the queues of the recipients, and a writer drains
+each queue on its own (ConnectionWriter in threaded mode, the event loop in
+async mode). A client that reads slowly therefore only fills up its own queue,
+instead of stalling the sender and every other recipient.
+
+When the queue is full the slow consumer policy decides what happens:
+    - drop_oldest   the oldest frame in the queue is dropped
+    - disconnect    the queue is closed, and the client is disconnected
+    - block         the sender waits until there is room in the queue
+
+The writer takes all the frames in the queue at once (up to WRITE_BATCH_SIZE bytes)
+and writes them with a single system call, so a busy room does not cost a write
+for every message and recipient. With a batch window the first frame is also held
+back for a few milliseconds, so the frames queued meanwhile are written with it.
+"""
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+
+SLOW_CONSUMER_POLICIES = [DROP_OLDEST, DISCONNECT, BLOCK]
+
+# Max bytes written to a client at a time, unless a single frame is larger
+WRITE_BATCH_SIZE = 64 * 1024
+
+
+class OutboundQueue(object):
+
+    # There is one queue for every connection
+    __slots__ = ('max_size', 'policy', 'frames', 'condition', 'closed', 'overflowed', 'dropped_frames', 'encoding',
+                 'compression_threshold', 'batch_window', 'first_frame_time')
+
+    def __init__(self, max_size, policy, batch_window=0.0):
+        self.max_size = max_size
+        self.policy = policy
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        # True if the queue was closed because the client could not keep up
+        self.overflowed = False
+        self.dropped_frames = 0
+        # The encoding of the client, used to encode the responses put on the queue
+        self.encoding = JSON
+        # Frames of at least this size are compressed, None if the client did not ask for compression
+        self.compression_threshold = None
+        # Seconds the first frame in the queue is held back, and the time it was queued
+        self.batch_window = batch_window
+        self.first_frame_time = 0.0
+
+    def put_response(self, response):
+        # Queues a Response, encoded for this client
+        return self.put(response.get_frame(self.encoding, self.compression_threshold))
+
+    def put_responses(self, responses):
+        # Queues several Responses at once, so the writer takes them together.
+        # The condition is reentrant, so put() can be called while holding it
+        frames = [response.get_frame(self.encoding, self.compression_threshold) for response in responses]
+        with self.condition:
+            for frame in frames:
+                if not self.put(frame):
+                    return False
+            return True
+
+    def put(self, frame):
+        """
+        Queues a frame for writing. Returns False if the frame was not queued
+        because the queue is closed.
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_size:
+                if self.policy == DROP_OLDEST:
+                    self.frames.popleft()
+                    self.dropped_frames += 1
+                    metrics.increment('chat_dropped_frames_total')
+                elif self.policy == DISCONNECT:
+                    self.overflowed = True
+                    self.closed = True
+                    metrics.increment('chat_slow_consumer_disconnects_total')
+                    self.frames.clear()
+                    self.condition.notify_all()
+                    return False
+                else:
+                    while len(self.frames) >= self.max_size and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return False
+            if self.batch_window and not self.frames:
+                self.first_frame_time = time.time()
+            self.frames.append(frame)
+            self.condition.notify_all()
+            return True
+
+    def get_frames(self, max_bytes=WRITE_BATCH_SIZE):
+        """
+        Blocks until a frame is available, and until the batch window of the first frame
+        has passed. Returns the frames in the queue, up to max_bytes (at least one
+        frame). Returns None when the queue is closed and all frames have been taken.
+        """
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            remaining = 0
+            if self.batch_window and not self.closed:
+                remaining = self.first_frame_time + self.batch_window - time.time()
+        if remaining > 0:
+            # Sleeps without the lock, as a timed wait on the condition polls in Python 2
+            time.sleep(remaining)
+        with self.condition:
+            if not self.frames:
+                return None
+            return self.take_frames(max_bytes)
+
+    def get_frames_nowait(self, max_bytes=WRITE_BATCH_SIZE):
+        # Returns an empty list if there is no frame in the queue
+        with self.condition:
+            return self.take_frames(max_bytes)
+
+    def take_frames(self, max_bytes):
+        # Must be called with the condition held
+        frames = []
+        size = 0
+        while self.frames and (not frames or size + len(self.frames[0]) <= max_bytes):
+            frame = self.frames.popleft()
+            frames.append(frame)
+            size += len(frame)
+        if frames:
+            self.condition.notify_all()
+        return frames
+
+    def has_frames(self):
+        return len(self.frames) > 0
+
+    def ready_to_write(self):
+        # True if there are frames, and the first one is no longer held back by the batch window
+        if not self.frames:
+            return False
+        return not self.batch_window or len(self.frames) >= self.max_size or \
+            time.time() >= self.first_frame_time + self.batch_window
+
+    def close(self):
+        # Frames already in the queue can still be taken with get()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from threading import Thread, Lock, Event
+import time
+
+"""
+Tells clients who is logged in, without sending a notice to every client for every
+login and logout.
+
+Clients subscribe with the 'presence' request, and get a snapshot of the logged in
+users with a version number:
+    {'version': 7, 'users': ['alice', 'bob']}
+
+Logins and logouts are then collected for window_ms milliseconds, and sent to the
+subscribers as a single delta with the next version:
+    {'version': 8, 'joined': ['carol'], 'left': ['bob']}
+
+A user logging in and out again within the same window is not sent at all. When a
+lot of clients reconnect at once (e.g. after a restart), every subscriber gets a few
+large deltas instead of one notice per client.
+"""
+
+
+class Presence(Thread):
+
+    def __init__(self, server, window_ms=100):
+        Thread.__init__(self)
+        # Flag to run thread as a deamon
+        self.daemon = True
+        self.server = server
+        self.window_ms = window_ms
+        self.lock = Lock()
+        self.users = set()
+        # Version of the last delta sent to the subscribers
+        self.version = 0
+        # Logins and logouts since the last delta
+        self.joined = set()
+        self.left = set()
+        self.changed = Event()
+        # username -> OutboundQueue
+        self.subscribers = {}
+        # Sorted list of the users, rebuilt when it is needed after a change
+        self.sorted_users = None
+
+    def add(self, username):
+        with self.lock:
+            self.users.add(username)
+            self.sorted_users = None
+            if username in self.left:
+                self.left.discard(username)
+            else:
+                self.joined.add(username)
+        self.changed.set()
+
+    def remove(self, username):
+        with self.lock:
+            if username not in self.users:
+                return
+            self.users.discard(username)
+            self.sorted_users = None
+            if username in self.joined:
+                self.joined.discard(username)
+            else:
+                self.left.add(username)
+        self.changed.set()
+
+    def get_usernames(self):
+        # Returns the same list object until the users change
+        with self.lock:
+            if self.sorted_users is None:
+                self.sorted_users = sorted(self.users)
+            return self.sorted_users
+
+    def subscribe(self, username, outbound):
+        """
+        Sends a snapshot to the client, and then every delta. The snapshot is queued while
+        holding the lock, so the client gets no delta that is older than the snapshot.
+        The snapshot already contains the changes that are not sent yet, but applying
+        them again from the next delta does not change the roster.
+        """
+        with self.lock:
+            if self.sorted_users is None:
+                self.sorted_users = sorted(self.users)
+            snapshot_json = self.server.request_parser.presence_snapshot_json(self.version, self.sorted_users)
+            outbound.put_response(snapshot_json)
+            self.subscribers[username] = outbound
+
+    def unsubscribe(self, username, outbound):
+        with self.lock:
+            # The user may already have logged in again, from another connection
+            if self.subscribers.get(username) is outbound:
+                self.subscribers.pop(username)
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            # Changes made during the window are sent together
+            time.sleep(self.window_ms / 1000.0)
+            self.changed.clear()
+            self.send_delta()
+
+    def send_delta(self):
+        with self.lock:
+            if not self.joined and not self.left:
+                return
+            self.version += 1
+            delta_json = self.server.request_parser.presence_delta_json(self.version, sorted(self.joined),
+                                                                        sorted(self.left))
+            self.joined = set()
+            self.left = set()
+            subscribers = self.subscribers.values()
+        # The delta is encoded once per encoding, and the lock is not held while queueing it
+        for outbound in subscribers:
+            outbound.put_response(delta_json)
+        if subscribers:
+            self.server.wake()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import time
+from threading import Lock
+from TokenBucket import TokenBucket
+
+"""
+Limits the number of requests the server handles, with token buckets (see TokenBucket.py):
+
+    - every client has a bucket of its own, so a single client flooding requests is
+      refused once it used up its burst, without slowing down the other clients
+    - all clients share a global bucket, which limits the total load on the server
+      (on each worker process, when running several)
+
+Requests are checked before they are decoded, so a refused request costs little
+more than reading its frame. A rate of 0 turns a limit off.
+"""
+
+
+class RateLimiter:
+
+    def __init__(self, client_rate=0, client_burst=0, global_rate=0, global_burst=0):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_bucket = None
+        if global_rate > 0:
+            self.global_bucket = TokenBucket(global_rate, global_burst)
+        # The global bucket is used by every client handler thread
+        self.lock = Lock()
+        self.client_rejections = 0
+        self.global_rejections = 0
+
+    def new_client_bucket(self):
+        # None if clients are not limited, so no bucket is held for every connection
+        if self.client_rate > 0:
+            return TokenBucket(self.client_rate, self.client_burst)
+        return None
+
+    def allow(self, client_bucket):
+        # Returns False if the request must be refused
+        now = time.time()
+        if client_bucket is not None and not client_bucket.take(now):
+            with self.lock:
+                self.client_rejections += 1
+            return False
+        if self.global_bucket is not None:
+            with self.lock:
+                if not self.global_bucket.take(now):
+                    self.global_rejections += 1
+                    return False
+        return True
+
+    def get_metrics(self):
+        with self.lock:
+            return \
+                {
+                    'client_rejections': self.client_rejections,
+                    'global_rejections': self.global_rejections
+                }
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+from itertools import islice
+
+
+class RecentMessages:
+
+    """
+    The last messages of the history, kept in memory, so the history sent on login,
+    history pages and the messages missed by a resumed session are read without
+    touching the HistoryStore. Older messages are read from the store.
+
+    Messages are kept as the (seq, timestamp, record) tuples read_range() of the
+    HistoryStore returns, so they need no decoding. They are added as they are
+    numbered, before they are written to disk (or, in worker processes, as the main
+    process sends them on, see MessageBus.py).
+
+    At most max_messages messages, of about max_bytes together, are kept. The oldest
+    messages are dropped first, so the sequence numbers in memory are contiguous.
+    """
+
+    # Added to the size of the text of every message, for the tuple and the record
+    MESSAGE_OVERHEAD = 200
+
+    def __init__(self, max_messages=2000, max_bytes=4 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (seq, timestamp, record, size), oldest first
+        self.messages = deque()
+        self.size = 0
+        # The sequence number of the last message added
+        self.last_seq = 0
+
+    def add(self, seq, timestamp, record):
+        size = self.MESSAGE_OVERHEAD + sum(len(value) for value in record.itervalues()
+                                           if isinstance(value, basestring))
+        with self.lock:
+            if not seq == self.last_seq + 1:
+                # Only contiguous messages are kept, the ones in between are read from the store
+                self.messages.clear()
+                self.size = 0
+            self.last_seq = seq
+            self.messages.append((seq, timestamp, record, size))
+            self.size += size
+            while len(self.messages) > self.max_messages or (self.size > self.max_bytes and len(self.messages) > 1):
+                self.size -= self.messages.popleft()[3]
+
+    def load(self, history_store):
+        # Starts with the last messages of the history, before new messages are added
+        messages = history_store.read_last(self.max_messages)
+        self.last_seq = messages[0][0] - 1 if messages else history_store.last_seq
+        for seq, timestamp, record in messages:
+            self.add(seq, timestamp, record)
+
+    def read_range(self, start_seq, end_seq):
+        """
+        Returns (first seq, messages): the first sequence number in memory, and the
+        messages in memory from start_seq up to, but not including, end_seq. The
+        messages before the first sequence number are only in the store.
+        """
+        with self.lock:
+            if not self.messages:
+                return self.last_seq + 1, []
+            first_seq = self.messages[0][0]
+            start = max(start_seq - first_seq, 0)
+            end = max(min(end_seq - first_seq, len(self.messages)), start)
+            return first_seq, [message[:3] for message in islice(self.messages, start, end)]
+
+    def __len__(self):
+        return len(self.messages)
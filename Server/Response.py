@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import time
+from Framing import HEADER, encode_frame, encode_compressed_frame
+from BinaryEncoding import BINARY, encode_response
+from ResponseCache import response_cache
+
+
+class Response(object):
+
+    """
+    A response to one or more clients, before it is encoded. Clients may use
+    different encodings (json or binary, see BinaryEncoding.py), so a response is
+    encoded to a frame when it is queued for a client, at most once per encoding.
+    Clients that asked for compression get a compressed frame (see Framing.py), which
+    is also made once, however many clients get the response.
+    """
+
+    __slots__ = ('sender', 'response', 'content', 'room', 'recipient', 'timestamp', 'seq', 'json_frame',
+                 'binary_frame', 'compressed_frames')
+
+    def __init__(self, sender, response, content, room=None, recipient=None, timestamp=None, seq=None):
+        self.sender = sender
+        self.response = response
+        self.content = content
+        self.room = room
+        self.recipient = recipient
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        # The sequence number of a message in the history, set before the response is encoded
+        self.seq = seq
+        self.json_frame = None
+        self.binary_frame = None
+        # (encoding, compression threshold) -> frame
+        self.compressed_frames = None
+
+    def get_frame(self, encoding, compression_threshold=None):
+        if compression_threshold is not None:
+            return self.get_compressed_frame(encoding, compression_threshold)
+        if encoding == BINARY:
+            if self.binary_frame is None:
+                self.binary_frame = encode_frame(encode_response(self.sender, self.response, self.content,
+                                                                 self.room, self.recipient, self.timestamp,
+                                                                 self.seq))
+            return self.binary_frame
+        if self.json_frame is None:
+            self.json_frame = encode_frame(response_cache.encode_response(self.sender, self.response, self.content,
+                                                                          self.room, self.recipient, self.seq,
+                                                                          self.timestamp))
+        return self.json_frame
+
+    def get_compressed_frame(self, encoding, compression_threshold):
+        if self.compressed_frames is None:
+            self.compressed_frames = {}
+        key = (encoding, compression_threshold)
+        frame = self.compressed_frames.get(key)
+        if frame is None:
+            # The payload is taken from the uncompressed frame, which is cached as well
+            payload = self.get_frame(encoding)[HEADER.size:]
+            frame = self.compressed_frames[key] = encode_compressed_frame(payload, compression_threshold)
+        return frame
+
+    def to_tuple(self):
+        # Sent to other worker processes by the message bus, which can not send objects
+        return self.sender, self.response, self.content, self.room, self.recipient, self.timestamp, self.seq
+
+    @staticmethod
+    def from_tuple(fields):
+        return Response(*fields)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from json.encoder import encode_basestring_ascii
+
+"""
+Encodes the json responses sent to clients, without building and serializing a
+dictionary for every response.
+
+Every response has the same envelope:
+
+    {"timestamp": <local time>, "sender": ..., "response": ..., "content": ...
+     [, "room": ...] [, "recipient": ...] [, "seq": ...]}
+
+so a response is joined from pre-encoded parts. Only the strings that change
+(the sender, the content, ...) are encoded, with the same escaping as json.dumps.
+
+    - The timestamp has a resolution of one second, so it is formatted and encoded
+      once per second, and shared by all responses created in that second.
+    - Static responses (e.g. the help text, and the errors sent for invalid requests)
+      are added with add_static_response, and fully encoded once per second. A flood
+      of invalid requests then costs little more than a dictionary lookup per request.
+"""
+
+
+def encode_value(value):
+    # Strings are encoded directly, other content (e.g. the messages of a history response) with json
+    if isinstance(value, basestring):
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+class ResponseCache:
+
+    def __init__(self):
+        # (second, encoded timestamp). Replaced as a whole, so it can be read without a lock
+        self.cached_timestamp = (None, None)
+        # (sender, response, content) -> encoded response after the timestamp
+        self.static_templates = {}
+        # (sender, response, content) -> (encoded timestamp, encoded response)
+        self.static_responses = {}
+
+    def get_encoded_timestamp(self, timestamp=None):
+        # Local time in format 'Tue Jan 13 10:17:09 2009', encoded as a json string
+        second = int(time.time() if timestamp is None else timestamp)
+        cached_timestamp = self.cached_timestamp
+        if not cached_timestamp[0] == second:
+            encoded_timestamp = encode_basestring_ascii(time.asctime(time.localtime(second)))
+            # A response created in an earlier second does not replace the current one
+            if cached_timestamp[0] is None or second > cached_timestamp[0]:
+                self.cached_timestamp = (second, encoded_timestamp)
+            return encoded_timestamp
+        return cached_timestamp[1]
+
+    def add_static_response(self, sender, response, content):
+        key = (sender, response, content)
+        if key not in self.static_templates:
+            self.static_templates[key] = self.encode_fields(sender, response, content)
+
+    def encode_response(self, sender, response, content, room=None, recipient=None, seq=None, timestamp=None):
+        encoded_timestamp = self.get_encoded_timestamp(timestamp)
+        if room is None and recipient is None and seq is None and isinstance(content, basestring):
+            key = (sender, response, content)
+            template = self.static_templates.get(key)
+            if template is not None:
+                cached_response = self.static_responses.get(key)
+                # The timestamp is compared by identity, as it is the same object during a second
+                if cached_response is None or cached_response[0] is not encoded_timestamp:
+                    cached_response = (encoded_timestamp, '{"timestamp": ' + encoded_timestamp + template)
+                    self.static_responses[key] = cached_response
+                return cached_response[1]
+        return '{"timestamp": ' + encoded_timestamp + self.encode_fields(sender, response, content, room, recipient,
+                                                                        seq)
+
+    @staticmethod
+    def encode_fields(sender, response, content, room=None, recipient=None, seq=None):
+        # The part of the envelope after the timestamp
+        fields = ', "sender": ' + encode_value(sender) + \
+                 ', "response": ' + encode_value(response) + \
+                 ', "content": ' + encode_value(content)
+        # Messages also tell which room, or which user, they were sent to
+        if room is not None:
+            fields += ', "room": ' + encode_value(room)
+        if recipient is not None:
+            fields += ', "recipient": ' + encode_value(recipient)
+        # Messages written to the history have its sequence number, see the 'resume' request
+        if seq is not None:
+            fields += ', "seq": ' + str(seq)
+        return fields + '}'
+
+
+# Shared by all clients, so the timestamp and the static responses are encoded once for the whole server
+response_cache = ResponseCache()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import bisect
+import threading
+from array import array
+
+"""
+Inverted index over the message history, for the 'search' request:
+
+    search <terms> [from:<user>] [room:<room>] [after:<date>] [before:<date>]
+
+Every word of a message, its sender and its room map to the sorted list of the
+sequence numbers of the messages containing them (an array, so a posting costs 4 or
+8 bytes). A query intersects the lists of its words and filters, starting with the
+shortest list, so it never reads messages that do not match. The time filters
+become a range of sequence numbers, found with the timestamp index of the
+HistoryStore. Only the matching messages are read from the history.
+
+A client only finds the messages of the rooms it is in. The lists of the rooms are
+also used to page through the history of a client's rooms (see find_in_rooms).
+
+Dates are local time, as 'YYYY-MM-DD', 'YYYY-MM-DDTHH:MM' or 'YYYY-MM-DDTHH:MM:SS'.
+
+The index is kept in memory. It is built from the history when the server starts,
+and the LogWriter adds the messages it writes. A read only HistoryStore (in the
+worker processes) is written by another process, so the index catches up with it
+before every query. Messages deleted from the history (see HistoryRetention.py)
+are removed from the index when it catches up.
+"""
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S']
+
+SEARCH_SYNTAX = "Enter 'search <words> [from:<user>] [room:<room>] [after:<date>] [before:<date>]', " \
+                "with dates as YYYY-MM-DD or YYYY-MM-DDTHH:MM."
+
+
+def get_words(text):
+    return set(word.lower() for word in WORD.findall(text))
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, date_format))
+        except ValueError:
+            pass
+    raise ValueError("'" + value + "' is not a date. " + SEARCH_SYNTAX)
+
+
+def parse_query(content):
+    """
+    Returns the query of a 'search' request as a tuple
+    (words, sender, room, after timestamp, before timestamp). Raises ValueError with a
+    message for the client if the query is not valid.
+    """
+    words = set()
+    sender = room = after = before = None
+    for part in content.split():
+        key, separator, value = part.partition(':')
+        if separator and value and key in ('from', 'room', 'after', 'before'):
+            if key == 'from':
+                sender = value
+            elif key == 'room':
+                room = value
+            elif key == 'after':
+                after = parse_date(value)
+            else:
+                before = parse_date(value)
+        else:
+            words.update(get_words(part))
+    if not words and sender is None and room is None:
+        raise ValueError("Enter at least one word, or a user or room to search for. " + SEARCH_SYNTAX)
+    return words, sender, room, after, before
+
+
+def contains(postings, seq):
+    index = bisect.bisect_left(postings, seq)
+    return index < len(postings) and postings[index] == seq
+
+
+class SearchIndex:
+
+    # Messages read from the history at a time when catching up
+    catch_up_batch_size = 1000
+
+    def __init__(self, history_store):
+        self.history_store = history_store
+        self.lock = threading.Lock()
+        # word -> array of sequence numbers, and the same for senders and rooms
+        self.words = {}
+        self.senders = {}
+        self.rooms = {}
+        # The first and the last sequence number in the index
+        self.first_seq = 1
+        self.last_seq = 0
+
+    """
+        Indexing
+    """
+
+    def add_messages(self, messages):
+        # messages is a list of (seq, record), in the order they were written
+        with self.lock:
+            for seq, record in messages:
+                # The message may already have been read from the history by catch_up
+                if seq <= self.last_seq:
+                    continue
+                for word in get_words(record['content']):
+                    self.add_posting(self.words, word, seq)
+                self.add_posting(self.senders, record['sender'], seq)
+                if record.get('room') is not None:
+                    self.add_posting(self.rooms, record['room'], seq)
+                self.last_seq = seq
+
+    @staticmethod
+    def add_posting(postings, key, seq):
+        seqs = postings.get(key)
+        if seqs is None:
+            seqs = postings[key] = array('L')
+        seqs.append(seq)
+
+    def catch_up(self):
+        # Indexes the messages in the history that are not in the index yet. Returns their number
+        self.history_store.refresh()
+        if self.history_store.first_seq() > self.first_seq:
+            self.remove_before(self.history_store.first_seq())
+        added = 0
+        while self.last_seq < self.history_store.last_seq:
+            start_seq = max(self.last_seq + 1, self.history_store.first_seq())
+            messages = self.history_store.read_range(start_seq, self.catch_up_batch_size)
+            if not messages:
+                break
+            self.add_messages([(seq, record) for seq, timestamp, record in messages])
+            added += len(messages)
+        return added
+
+    def remove_before(self, first_seq):
+        # Removes the messages before first_seq, which are no longer in the history
+        with self.lock:
+            for postings in [self.words, self.senders, self.rooms]:
+                for key in postings.keys():
+                    seqs = postings[key]
+                    position = bisect.bisect_left(seqs, first_seq)
+                    if position == len(seqs):
+                        del postings[key]
+                    elif position:
+                        del seqs[:position]
+            self.first_seq = first_seq
+
+    """
+        Searching
+    """
+
+    def search(self, words, sender=None, room=None, after=None, before=None, limit=20, rooms=None):
+        """
+        Returns the sequence numbers of the last limit messages matching the query
+        (oldest first), and the number of matching messages. If rooms is given, only
+        the messages sent to those rooms are found.
+        """
+        if rooms is not None and room is not None and room not in rooms:
+            return [], 0
+        self.catch_up()
+        start_seq = 1
+        end_seq = None
+        if after is not None:
+            start_seq = self.history_store.find_seq_by_timestamp(after)
+        if before is not None:
+            end_seq = self.history_store.find_seq_by_timestamp(before)
+        with self.lock:
+            posting_lists = [self.words.get(word) for word in words]
+            if sender is not None:
+                posting_lists.append(self.senders.get(sender))
+            if room is not None:
+                posting_lists.append(self.rooms.get(room))
+            # A message must be in one of the rooms, so their lists are not intersected
+            room_lists = []
+            if room is None and rooms is not None:
+                room_lists = [self.rooms[name] for name in rooms if name in self.rooms]
+                if not room_lists:
+                    return [], 0
+                if len(room_lists) == 1:
+                    posting_lists.extend(room_lists)
+                    room_lists = []
+            if any(postings is None for postings in posting_lists):
+                return [], 0
+            posting_lists.sort(key=len)
+            shortest = posting_lists[0]
+            others = posting_lists[1:]
+            # Only the part of the shortest list within the time range is checked
+            low = bisect.bisect_left(shortest, start_seq)
+            high = len(shortest) if end_seq is None else bisect.bisect_left(shortest, end_seq)
+            if not others and not room_lists:
+                return list(shortest[max(low, high - limit):high]), max(high - low, 0)
+            matches = []
+            total = 0
+            for position in xrange(high - 1, low - 1, -1):
+                seq = shortest[position]
+                if all(contains(postings, seq) for postings in others) and \
+                        (not room_lists or any(contains(postings, seq) for postings in room_lists)):
+                    total += 1
+                    if len(matches) < limit:
+                        matches.append(seq)
+        matches.reverse()
+        return matches, total
+
+    def find_in_rooms(self, rooms, before_seq, limit):
+        """
+        Returns (seqs, more, last seq): the sequence numbers of the last limit messages
+        sent to the rooms before before_seq (oldest first), whether there are older
+        ones, and the last sequence number in the index. Messages after it are not
+        indexed yet.
+        """
+        self.catch_up()
+        with self.lock:
+            seqs = []
+            more = False
+            for room in rooms:
+                postings = self.rooms.get(room)
+                if postings is None:
+                    continue
+                high = bisect.bisect_left(postings, before_seq)
+                low = max(high - limit, 0)
+                seqs.extend(postings[low:high])
+                more = more or low > 0
+            last_seq = self.last_seq
+        seqs.sort()
+        if len(seqs) > limit:
+            more = True
+            seqs = seqs[-limit:]
+        return seqs, more, last_seq
+
+    def read_messages(self, seqs):
+        # Returns the messages as (seq, timestamp, record) tuples
+        messages = []
+        for seq in seqs:
+            # The message may have been deleted since the search
+            if seq >= self.history_store.first_seq():
+                messages.extend(self.history_store.read_range(seq, 1))
+        return messages
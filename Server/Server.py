@@ -1,9 +1,30 @@
 # -*- coding: utf-8 -*-
 import SocketServer
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from Framing import FrameDecoder, FrameError
 from ServerMessageParser import ServerMessageParser
-import threading
+from ClientHandlerMixin import ClientHandlerMixin
+from ClientSession import ClientSession
+from ChatServerMixin import ChatServerMixin
+from AsyncServer import AsyncChatServer, AsyncClientHandler
+from OutboundQueue import OutboundQueue, SLOW_CONSUMER_POLICIES, BLOCK
+from ConnectionWriter import ConnectionWriter
+from HistoryStore import HistoryStore
+from HistoryRetention import HistoryRetention
+from LogWriter import LogWriter
+from RecentMessages import RecentMessages
+from Presence import Presence
+from SearchIndex import SearchIndex
+from RateLimiter import RateLimiter
+from Metrics import metrics
+from AdminServer import AdminServer
+from IdleReaper import IdleReaper
+from MultiProcessServer import MultiProcessServer, SO_REUSEPORT
 import socket
-import json
+import argparse
+import time
 
 """
 Variables and functions that must be used by all the ClientHandler objects
@@ -11,13 +32,16 @@ must be written here (e.g. a dictionary for connected clients)
 """
 
 
-class ClientHandler(SocketServer.BaseRequestHandler):
+class ClientHandler(ClientHandlerMixin, SocketServer.BaseRequestHandler):
 
     """
     This is the ClientHandler class. Everytime a new client connects to the
     server, a new ClientHandler object will be created. This class represents
     only connected clients, and not the server itself. If you want to write
     logic for the server, you must write it outside this class
+
+    The request logic itself lives in ClientHandlerMixin, so that it can be
+    shared with the AsyncClientHandler
     """
 
     def setup(self):
@@ -27,114 +51,62 @@ class ClientHandler(SocketServer.BaseRequestHandler):
         self.ip = self.client_address[0]
         self.port = self.client_address[1]
         self.connection = self.request
-        self.server = server
-        self.username = ""
-        self.logged_in = False
-        self.request_parser = ServerMessageParser(self)
+        # Frames are batched by the server (see OutboundQueue.py), so Nagle's algorithm would only delay them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session = ClientSession(self.server.rate_limiter.new_client_bucket())
+        self.outbound = OutboundQueue(self.server.outbound_queue_size, self.server.slow_consumer_policy,
+                                      self.server.write_batch_window)
+        self.writer = ConnectionWriter(self.connection, self.outbound)
+        # Checked by the idle_reaper of the server
+        self.last_read_time = time.time()
+        metrics.increment('chat_connections')
+        metrics.increment('chat_connections_total')
 
     def handle(self):
         """
         This method handles the connection between a client and the server.
         """
         print "Client connected on IP: " + self.ip
+        self.writer.start()
+        if self.server.idle_reaper is not None:
+            self.server.idle_reaper.add(self)
         try:
 
+            frame_decoder = FrameDecoder()
             while True:
-                payload = self.connection.recv(4096)
-                parsed_payload = self.request_parser.parse(payload)
-                request = parsed_payload[0]
-                content = parsed_payload[1]
-                request_is_valid = parsed_payload[2]
-                json_response = parsed_payload[3]
-
-                # LOGIN
-                if self.request_parser.is_login(request) and request_is_valid:
-                    self.login_user(content)
-                    print "User " + self.username + " logged in."
-                    self.connection.sendall(json_response)
-                    is_log, history_response = self.request_parser.get_history_response_json()
-                    if is_log:
-                        self.connection.sendall(history_response)
-
-                # LOGOUT
-                elif self.request_parser.is_logout(request) and request_is_valid:
-                    self.connection.sendall(json_response)
-                    self.logout_user()
-                    print "User " + self.username + " logged out."
-
-                elif self.request_parser.is_message(request) and request_is_valid:
-                    self.send_message_to_all_clients(json_response)
-                    self.log_message(json_response, self.server.log_write_lock, self.server.log_file_path)
-
-                else:
-                    self.connection.sendall(json_response)
-
-        except socket.error:
-            print "Client with IP: " + self.ip + " disconnected."
+                data = self.connection.recv(4096)
+                if not data:
+                    break
+                self.last_read_time = time.time()
+                # A single recv may contain several payloads, or only a part of one
+                for payload in frame_decoder.feed(data):
+                    self.handle_payload(payload)
+
+        except (socket.error, FrameError):
+            pass
         finally:
-            if self.logged_in:
-                self.logout_user()
+            print "Client with IP: " + self.ip + " disconnected."
+            if self.server.idle_reaper is not None:
+                self.server.idle_reaper.remove(self)
+            if self.session.logged_in:
+                self.disconnect_user()
+            # Let the writer send the last responses before the connection is closed
+            self.outbound.close()
+            self.writer.join(1.0)
             self.connection.close()
+            metrics.increment('chat_connections', -1)
+
+    def close_idle(self):
+        # Called by the IdleReaper thread. Makes the blocking recv() in handle() return
+        print "Client with IP: " + self.ip + " timed out."
+        self.writer.disconnect()
+
+
+
+
 
 
-    def login_user(self, username):
-        self.username = username
-        self.logged_in = True
-        with self.server.logged_in_clients_lock:
-            # Adding the client to the set of logged in clients
-            self.server.logged_in_clients[self.username] = self.connection
-        logged_in_json = self.request_parser.user_logged_in_json()
-        for client in self.server.logged_in_clients:
-            if not client == self.username:
-                client_connection = self.server.logged_in_clients[client]
-                client_connection.sendall(logged_in_json)
-
-    def logout_user(self):
-        self.logged_in = False
-        self.remove_client(self.username)
-
-    # Sends a message to all connected clients.
-    # If one of the clients are disconnected, the client is removed and all other clients will be notified
-    def send_message_to_all_clients(self, message_json):
-        with self.server.logged_in_clients_lock:
-            for client in self.server.logged_in_clients:
-                client_user = client
-                client_connection = self.server.logged_in_clients[client]
-                try:
-                    client_connection.sendall(message_json)
-                except socket.error:
-                    print client_user + "was disconnected."
-                    self.remove_client(client_user)
-
-    def remove_client(self, username):
-        for client in self.server.logged_in_clients:
-            if username == client:
-                self.server.logged_in_clients.pop(username)
-                self.notify_clients_on_client_logout(username)
-                break
-
-    def notify_clients_on_client_logout(self, logout_username):
-        logged_out_json = self.request_parser.user_logged_out_json(logout_username)
-        for client in self.server.logged_in_clients:
-            client_connection = self.server.logged_in_clients[client]
-            client_connection.sendall(logged_out_json)
-
-    def log_message(self, message_json, lock, path):
-        message = json.loads(message_json)
-        timestamp = message['timestamp']
-        sender = message['sender']
-        content = message['content']
-        log_string =  sender + ": " + timestamp + "\n" + content + "\n\n"
-        with lock:
-            with open(path, "a") as log:
-                log.write(log_string)
-
-
-
-
-
-
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class ThreadedTCPServer(ChatServerMixin, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     """
     This class is present so that each client connected will be ran as a own
     thread. In that way, all clients will be served by the server.
@@ -143,41 +115,192 @@ class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     """
     allow_reuse_address = True
 
-    # Hold all logged in clients
-    logged_in_clients = {}
-    logged_in_clients_lock = threading.Lock()
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
 
-    log_file_path = "/Users/Lars/Code/ktn-chat-application/Log/message_history.log"
-    log_write_lock = threading.Lock()
-
-
-
-
-if __name__ == "__main__":
-    """
-    This is the main method and is executed when you type "python Server.py"
-    in your terminal.
 
-    No alterations are necessary
-    """
-    HOST, PORT = 'localhost', 10005
-    print "Server running..."
-    # Set up and initiate the TCP server
-    server = ThreadedTCPServer
+def serve(arguments, history_store, log_writer, message_bus=None, admin_port=0):
+    # Runs a server until it is stopped (KeyboardInterrupt)
+    server = None
+    admin_server = None
     try:
-        server = ThreadedTCPServer((HOST, PORT), ClientHandler)
+        if arguments.mode == 'async':
+            server = AsyncChatServer((HOST, PORT), AsyncClientHandler)
+        else:
+            server = ThreadedTCPServer((HOST, PORT), ClientHandler)
+        server.request_parser = ServerMessageParser(server)
+        server.rate_limiter = RateLimiter(arguments.rate_limit, arguments.rate_burst,
+                                          arguments.global_rate_limit, arguments.global_rate_burst)
+        server.presence = Presence(server, arguments.presence_window)
+        server.presence.start()
+        server.outbound_queue_size = arguments.outbound_queue_size
+        server.slow_consumer_policy = arguments.slow_consumer_policy
+        server.compression_threshold = arguments.compression_threshold
+        server.write_batch_window = arguments.write_batch_window / 1000.0
+        server.history_store = history_store
+        server.log_writer = log_writer
+        # Loaded before any message is sent, so the new messages follow on
+        server.recent_messages = RecentMessages(arguments.recent_messages, arguments.recent_messages_size * 1024 * 1024)
+        server.recent_messages.load(history_store)
+        server.history_replay_limit = arguments.history_replay_limit
+        server.resume_timeout = arguments.resume_timeout
+        if arguments.idle_timeout:
+            server.idle_reaper = IdleReaper(arguments.idle_timeout, arguments.heartbeat_interval)
+            if arguments.mode == 'threaded':
+                # The async server checks the idle clients from its event loop
+                server.idle_reaper.start()
+        server.search_index = SearchIndex(history_store)
+        start_time = time.time()
+        indexed_messages = server.search_index.catch_up()
+        print "Indexed " + str(indexed_messages) + " messages for search in %.1f s" % (time.time() - start_time)
+        if message_bus is None:
+            # Workers find the new messages in the history when searching, see SearchIndex.py
+            log_writer.search_index = server.search_index
+        server.message_bus = message_bus
+        metrics.set_callback('chat_logged_in_clients', lambda: len(server.logged_in_clients))
+        if message_bus is None:
+            metrics.set_callback('chat_suspended_sessions', lambda: len(server.suspended_sessions))
+        metrics.set_callback('chat_rate_limited_requests_total',
+                             lambda: sum(server.rate_limiter.get_metrics().values()))
+        if admin_port:
+            admin_server = AdminServer(admin_port)
+            admin_server.start()
+            print "Metrics on http://localhost:" + str(admin_port) + "/metrics"
+        if message_bus is not None:
+            message_bus.start_serving(server)
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     finally:
         print "Server shutdown..."
-        server.shutdown()
-        server.server_close()
+        if admin_server is not None:
+            admin_server.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            if server.rate_limiter is not None:
+                print "Rate limiter: " + str(server.rate_limiter.get_metrics())
 
 
+def serve_worker(message_bus, worker_number):
+    # Runs in every worker process of a multi-process server
+    ChatServerMixin.reuse_port = True
+    # The history is written by the main process
+    history_store = HistoryStore(ChatServerMixin.history_directory, read_only=True)
+    # Every worker has its own metrics, on the admin ports after the one of the main process
+    admin_port = 0
+    if arguments.admin_port:
+        admin_port = arguments.admin_port + worker_number
+    serve(arguments, history_store, None, message_bus, admin_port)
 
 
 
 
+if __name__ == "__main__":
+    """
+    This is the main method and is executed when you type "python Server.py"
+    in your terminal.
 
+    No alterations are necessary
+    """
+    HOST, PORT = 'localhost', 10005
 
+    argument_parser = argparse.ArgumentParser(description="Chat server")
+    argument_parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                                 help="'threaded' serves each client in its own thread, "
+                                      "'async' serves all clients from a single event loop")
+    argument_parser.add_argument('--outbound-queue-size', type=int, default=ChatServerMixin.outbound_queue_size,
+                                 help="max number of frames waiting to be written to a single client")
+    argument_parser.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES,
+                                 default=ChatServerMixin.slow_consumer_policy,
+                                 help="what to do when the outbound queue of a client is full")
+    argument_parser.add_argument('--write-batch-window', type=float, default=0, metavar='MS',
+                                 help="hold frames back for up to MS milliseconds, so more frames to the same "
+                                      "client are written at once (0: only frames that are already queued)")
+    argument_parser.add_argument('--compression-threshold', type=int, default=ChatServerMixin.compression_threshold,
+                                 metavar='BYTES',
+                                 help="compress frames of at least this size, for clients that ask for compression")
+    argument_parser.add_argument('--history-replay-limit', type=int, default=ChatServerMixin.history_replay_limit,
+                                 help="number of messages from the history sent to a client on login")
+    argument_parser.add_argument('--recent-messages', type=int, default=2000, metavar='N',
+                                 help="keep the last N messages of the history in memory, so history requests "
+                                      "and resumed sessions do not read them from disk")
+    argument_parser.add_argument('--recent-messages-size', type=int, default=4, metavar='MB',
+                                 help="max size of the messages kept in memory")
+    argument_parser.add_argument('--resume-timeout', type=int, default=ChatServerMixin.resume_timeout,
+                                 metavar='SECONDS',
+                                 help="how long a client that lost its connection can resume its session "
+                                      "(0: sessions can not be resumed)")
+    argument_parser.add_argument('--idle-timeout', type=int, default=ChatServerMixin.idle_timeout,
+                                 metavar='SECONDS',
+                                 help="disconnect clients that sent nothing for SECONDS, e.g. a client whose "
+                                      "network is gone (0: never)")
+    argument_parser.add_argument('--heartbeat-interval', type=int, default=ChatServerMixin.heartbeat_interval,
+                                 metavar='SECONDS',
+                                 help="send a 'ping' to clients that sent nothing for SECONDS, which they answer "
+                                      "with a 'pong' (0: off)")
+    argument_parser.add_argument('--log-batch-size', type=int, default=1000,
+                                 help="max number of messages written to the history at a time")
+    argument_parser.add_argument('--log-fsync-interval', type=int, default=0, metavar='MS',
+                                 help="sync the history to disk at most MS milliseconds after a write "
+                                      "(0: not by time)")
+    argument_parser.add_argument('--log-fsync-records', type=int, default=0, metavar='N',
+                                 help="sync the history to disk every N messages (0: not by count). "
+                                      "If neither is set the OS decides when the history is stored")
+    argument_parser.add_argument('--history-segment-size', type=int, default=64, metavar='MB',
+                                 help="start a new history segment when the current one is this large")
+    argument_parser.add_argument('--history-segment-hours', type=float, default=0, metavar='HOURS',
+                                 help="start a new history segment when the first message of the current one "
+                                      "is this old (0: only by size)")
+    argument_parser.add_argument('--history-archive-after', type=float, default=24, metavar='HOURS',
+                                 help="compress history segments when their last message is this old (0: never)")
+    argument_parser.add_argument('--history-retention', type=float, default=0, metavar='DAYS',
+                                 help="delete history segments when their last message is this old (0: never)")
+    argument_parser.add_argument('--history-max-size', type=int, default=0, metavar='MB',
+                                 help="delete the oldest history segments while the history is larger (0: no limit)")
+    argument_parser.add_argument('--presence-window', type=int, default=ChatServerMixin.presence_window_ms,
+                                 metavar='MS', help="logins and logouts are sent to the clients following the "
+                                                    "presence together, at most every MS milliseconds")
+    argument_parser.add_argument('--rate-limit', type=float, default=ChatServerMixin.client_rate_limit,
+                                 metavar='N', help="max requests per second from a single client (0: no limit)")
+    argument_parser.add_argument('--rate-burst', type=int, default=ChatServerMixin.client_rate_burst,
+                                 metavar='N', help="number of requests a client may send at once, above the rate")
+    argument_parser.add_argument('--global-rate-limit', type=float, default=ChatServerMixin.global_rate_limit,
+                                 metavar='N', help="max requests per second from all clients together, per worker "
+                                                   "(0: no limit)")
+    argument_parser.add_argument('--global-rate-burst', type=int, default=ChatServerMixin.global_rate_burst,
+                                 metavar='N', help="number of requests all clients may send at once, above the "
+                                                   "global rate")
+    argument_parser.add_argument('--admin-port', type=int, default=0,
+                                 help="serve the metrics on http://localhost:ADMIN_PORT/metrics (0: off). "
+                                      "With several workers, worker N uses ADMIN_PORT + N")
+    argument_parser.add_argument('--workers', type=int, default=1,
+                                 help="number of worker processes accepting clients on the same port. "
+                                      "Workers share users, rooms and messages through a message bus")
+    arguments = argument_parser.parse_args()
+    if arguments.mode == 'async' and arguments.slow_consumer_policy == BLOCK:
+        argument_parser.error("the '" + BLOCK + "' policy can not be used in async mode, "
+                              "as it would block the event loop")
+
+    print "Server running (" + arguments.mode + " mode)..."
+    # Set up and initiate the TCP server
+    history_store = HistoryStore(ChatServerMixin.history_directory,
+                                 max_segment_bytes=arguments.history_segment_size * 1024 * 1024,
+                                 max_segment_seconds=arguments.history_segment_hours * 3600)
+    log_writer = LogWriter(history_store, arguments.log_batch_size,
+                           arguments.log_fsync_interval, arguments.log_fsync_records)
+    log_writer.history_retention = HistoryRetention(history_store, arguments.history_archive_after * 3600,
+                                                    arguments.history_retention * 86400,
+                                                    arguments.history_max_size * 1024 * 1024)
+    try:
+        if arguments.workers > 1:
+            MultiProcessServer(arguments.workers, log_writer, arguments.admin_port).run(serve_worker)
+        else:
+            log_writer.start()
+            serve(arguments, history_store, log_writer, admin_port=arguments.admin_port)
+    finally:
+        log_writer.stop()
+        history_store.close()
+        print "Log writer: " + str(log_writer.get_metrics())
@@ -1,6 +1,10 @@
 import json
-import time
 import re
+from ResponseCache import response_cache
+from Response import Response
+from BinaryEncoding import JSON, ENCODINGS, is_binary, decode_request
+from Framing import NO_COMPRESSION, COMPRESSIONS
+from SearchIndex import parse_query
 
 """
     Contains methods for
@@ -8,22 +12,28 @@ import re
     - error handling,
     - generating json responses that can be sent to clients,
     etc.
+
+    A single parser is shared by all the clients of a server (see Server.py), so it
+    holds no client state. The state of a client is passed in as its ClientSession.
 """
 
 
 class ServerMessageParser:
 
-    def __init__(self, client_handler_class):
+    def __init__(self, server):
 
         self.server_name = "Chat-server"
-        self.client_handler_class = client_handler_class
-        self.server = self.client_handler_class.server
+        self.server = server
 
         # Possible response from server to client
         self.error_response = 'error'
         self.info_response = 'info'
         self.message_response = 'message'
         self.history_response = 'history'
+        self.presence_response = 'presence'
+        self.search_response = 'search'
+        self.session_response = 'session'
+        self.ping_response = 'ping'
 
         # Possible requests from client to server
         self.login_request = 'login'
@@ -31,6 +41,15 @@ class ServerMessageParser:
         self.message_request = 'msg'
         self.names_request = 'names'
         self.help_request = 'help'
+        self.history_request = 'history'
+        self.join_request = 'join'
+        self.leave_request = 'leave'
+        self.rooms_request = 'rooms'
+        self.direct_message_request = 'dm'
+        self.presence_request = 'presence'
+        self.search_request = 'search'
+        self.resume_request = 'resume'
+        self.pong_request = 'pong'
 
         #  Used by parse() to access specific parsing methods
         self.possible_requests = {
@@ -38,19 +57,67 @@ class ServerMessageParser:
             self.logout_request: self.parse_logout,
             self.message_request: self.parse_msg,
             self.names_request: self.parse_names,
-            self.help_request: self.parse_help
+            self.help_request: self.parse_help,
+            self.history_request: self.parse_history,
+            self.join_request: self.parse_join,
+            self.leave_request: self.parse_leave,
+            self.rooms_request: self.parse_rooms,
+            self.direct_message_request: self.parse_dm,
+            self.presence_request: self.parse_presence,
+            self.search_request: self.parse_search,
+            self.resume_request: self.parse_resume,
+            self.pong_request: self.parse_pong
         }
 
         self.login_error_message = "You are not logged in. Enter 'login <username>' to log in.\n" \
                                    "<username> must be between 3 and 20 normal characters. [a-z, A-Z, 0-9, _]"
-
-
-
-    def parse(self, payload):
-        # Assumes that the payload is in json format
-        payload = json.loads(payload)
+        self.request_not_valid_message = "That request is not valid. Enter 'help' for a list of possible actions."
+        self.rate_limited_message = "You are sending requests too fast. Requests are ignored until you slow down."
+        self.help_message = 'Possible requests:\n' \
+            '- login <username>       3-20 normal characters (a-z, A-Z, 0-9, _)\n' \
+            '- logout                 logout from the chat\n' \
+            '- msg <content>          send a message to the users in your current room\n' \
+            '- dm <user> <content>    send a message to a single user\n' \
+            '- join <room>            join a room (it is created if it does not exist),\n' \
+            '                         and make it your current room\n' \
+            '- leave <room>           leave a room\n' \
+            '- rooms                  get a list of all rooms\n' \
+            '- names                  get a list of all logged in users\n' \
+            '- presence               follow who logs in and out\n' \
+            '- history                get older messages from the chat history\n' \
+            '- search <words>         search the chat history, optionally with from:<user>,\n' \
+            '                         room:<room>, after:<date> and before:<date>\n' \
+            '- resume <token> <seq>   continue a session after the connection was lost\n' \
+            '- help                   get a list of possible actions\n'
+
+        # The last names list, and its content for a 'names' response
+        self.names_content = (None, None)
+        # The history at the last login, and the history response sent on login
+        self.history_replay = (None, None)
+
+        # Responses that never change are encoded once, see ResponseCache.py
+        response_cache.add_static_response(self.server_name, self.error_response, self.login_error_message)
+        response_cache.add_static_response(self.server_name, self.error_response, self.request_not_valid_message)
+        response_cache.add_static_response(self.server_name, self.error_response, self.rate_limited_message)
+        response_cache.add_static_response(self.server_name, self.info_response, self.help_message)
+        response_cache.add_static_response(self.server_name, self.ping_response, "")
+
+
+
+    def parse(self, session, payload):
+        # Assumes that the payload is in json format, or in the binary encoding (see BinaryEncoding.py)
+        try:
+            if is_binary(payload):
+                payload = decode_request(payload)
+            else:
+                payload = json.loads(payload)
+            # Both fields are required, and must be strings
+            if not (isinstance(payload['request'], basestring) and isinstance(payload['content'], basestring)):
+                return None, None, False, self.request_not_valid_json()
+        except (ValueError, KeyError, TypeError):
+            return None, None, False, self.request_not_valid_json()
         if payload['request'] in self.possible_requests:
-            return self.possible_requests[payload['request']](payload)
+            return self.possible_requests[payload['request']](session, payload)
         else:
             # invalid request (feedback to client: use 'help')
             return payload['request'], payload['content'], False, self.request_not_valid_json()
@@ -69,46 +136,137 @@ class ServerMessageParser:
         If the request is valid, the json response may be sent to the client(s)
     """
 
-    def parse_login(self, payload):
-        verified_request = self.verify_login_request(payload)
+    def parse_login(self, session, payload):
+        verified_request = self.verify_login_request(session, payload)
         request = payload['request']
         content = payload['content']
         valid_request = verified_request[0]
+        if valid_request:
+            self.set_session_options(session, payload)
         json_response = self.get_login_response_json(verified_request, content)
         return request, content, valid_request, json_response
 
-    def parse_logout(self, payload):
-        verified_request = self.verify_logout_request(payload)
+    def parse_resume(self, session, payload):
+        # If the request is valid, the content returned is (username, rooms, active room, last seq)
+        verified_request = self.verify_resume_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        if valid_request:
+            self.set_session_options(session, payload)
+            content = verified_request[2] + (int(content.split()[1]),)
+        json_response = self.get_resume_response_json(verified_request)
+        return request, content, valid_request, json_response
+
+    @staticmethod
+    def set_session_options(session, payload):
+        # Responses after the login (or resume) response are sent in the encoding and compression the client asked for
+        session.encoding = payload.get('encoding', JSON)
+        session.compression = payload.get('compression', NO_COMPRESSION)
+
+    def parse_pong(self, session, payload):
+        # The answer to a 'ping', which needs no response. Valid whether logged in or not
+        verified_request = self.verify_pong_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = None
+        if not valid_request:
+            json_response = self.encode_response_to_json(self.server_name, self.error_response, verified_request[1])
+        return request, content, valid_request, json_response
+
+    def parse_logout(self, session, payload):
+        verified_request = self.verify_logout_request(session, payload)
         request = payload['request']
         content = payload['content']
         valid_request = verified_request[0]
         json_response = self.get_logout_response_json(verified_request)
         return request, content, valid_request, json_response
 
-    def parse_msg(self, payload):
-        verified_request = self.verify_msg_request(payload)
+    def parse_msg(self, session, payload):
+        verified_request = self.verify_msg_request(session, payload)
         request = payload['request']
         content = payload['content']
         valid_request = verified_request[0]
-        json_response = self.get_message_response_json(verified_request, content, self.client_handler_class.username)
+        json_response = self.get_message_response_json(verified_request, content, session.username,
+                                                       session.active_room)
         return request, content, valid_request, json_response
 
-    def parse_names(self, payload):
-        verified_request = self.verify_names_request(payload)
+    def parse_names(self, session, payload):
+        verified_request = self.verify_names_request(session, payload)
         request = payload['request']
         content = payload['content']
         valid_request = verified_request[0]
-        json_response = self.get_names_response_json(self.server.logged_in_clients, verified_request)  # TODO: WHERE DO WE GLOBALLY STORE LOGGED IN USERS AND CONNECTIONS??
+        json_response = self.get_names_response_json(self.server.get_usernames(), verified_request)
         return request, content, valid_request, json_response
 
-    def parse_help(self, payload):
-        verified_request = self.verify_help_request(payload)
+    def parse_help(self, session, payload):
+        verified_request = self.verify_help_request(session, payload)
         request = payload['request']
         content = payload['content']
         valid_request = verified_request[0]
         json_response = self.get_help_response_json(verified_request)
         return request, content, valid_request, json_response
 
+    def parse_history(self, session, payload):
+        verified_request = self.verify_history_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_history_page_response_json(session, verified_request, content)
+        return request, content, valid_request, json_response
+
+    def parse_join(self, session, payload):
+        verified_request = self.verify_join_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_join_response_json(verified_request, content)
+        return request, content, valid_request, json_response
+
+    def parse_leave(self, session, payload):
+        verified_request = self.verify_leave_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_leave_response_json(verified_request, content)
+        return request, content, valid_request, json_response
+
+    def parse_dm(self, session, payload):
+        # The content is '<recipient> <message>'
+        verified_request = self.verify_dm_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_direct_message_response_json(verified_request, content,
+                                                              session.username)
+        return request, content, valid_request, json_response
+
+    def parse_presence(self, session, payload):
+        # A valid request is answered with a snapshot by the presence, see Presence.py
+        verified_request = self.verify_presence_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_presence_response_json(verified_request)
+        return request, content, valid_request, json_response
+
+    def parse_search(self, session, payload):
+        verified_request = self.verify_search_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_search_response_json(session, verified_request, content)
+        return request, content, valid_request, json_response
+
+    def parse_rooms(self, session, payload):
+        verified_request = self.verify_rooms_request(session, payload)
+        request = payload['request']
+        content = payload['content']
+        valid_request = verified_request[0]
+        json_response = self.get_rooms_response_json(session, verified_request)
+        return request, content, valid_request, json_response
+
 
     """
         Methods for coding json response messages
@@ -124,6 +282,19 @@ class ServerMessageParser:
             content = "Login successful. Welcome to the chat " + username + "."
         return self.encode_response_to_json(self.server_name, response, content)
 
+    def get_resume_response_json(self, verified_request):
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            return self.encode_response_to_json(self.server_name, self.error_response, error_message)
+        username = verified_request[2][0]
+        return self.encode_response_to_json(self.server_name, self.info_response,
+                                            "Resume successful. Welcome back to the chat " + username + ".")
+
+    def get_session_response_json(self, session):
+        # The token the client resumes the session with, if the connection is lost
+        return self.encode_response_to_json(self.server_name, self.session_response, {'token': session.resume_token})
+
     def get_logout_response_json(self, verified_request):
         valid = verified_request[0]
         error_message = verified_request[1]
@@ -135,18 +306,47 @@ class ServerMessageParser:
             content = "Logout successful. Bye."
         return self.encode_response_to_json(self.server_name, response, content)
 
-    def get_message_response_json(self, verified_request, content, sender):
+    def get_message_response_json(self, verified_request, content, sender, room):
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            return self.encode_response_to_json(self.server_name, self.error_response, error_message)
+        return self.encode_response_to_json(sender, self.message_response, content, room)
+
+    def get_names_response_json(self, usernames, verified_request):
+        # usernames is assumed to be a list
         valid = verified_request[0]
         error_message = verified_request[1]
         if not valid:
             response = self.error_response
             content = error_message
         else:
-            response = self.message_response
-        return self.encode_response_to_json(sender, response, content)
+            response = self.info_response
+            content = self.get_names_content(usernames)
+        return self.encode_response_to_json(self.server_name, response, content)
 
-    def get_names_response_json(self, usernames, verified_request):
-        # usernames is assumed to be a dictionary
+    def get_names_content(self, usernames):
+        # The list from the presence only changes when a user logs in or out, so the content is reused until then
+        names_content = self.names_content
+        if names_content[0] is not usernames:
+            names_content = (usernames, "Logged in users:\n" + "".join("- " + username + "\n"
+                                                                          for username in usernames))
+            self.names_content = names_content
+        return names_content[1]
+
+    def get_presence_response_json(self, verified_request):
+        # Only sent if the request is not valid
+        return self.encode_response_to_json(self.server_name, self.error_response, verified_request[1])
+
+    def presence_snapshot_json(self, version, usernames):
+        content = {'version': version, 'users': usernames}
+        return self.encode_response_to_json(self.server_name, self.presence_response, content)
+
+    def presence_delta_json(self, version, joined, left):
+        content = {'version': version, 'joined': joined, 'left': left}
+        return self.encode_response_to_json(self.server_name, self.presence_response, content)
+
+    def get_help_response_json(self, verified_request):
         valid = verified_request[0]
         error_message = verified_request[1]
         if not valid:
@@ -154,12 +354,46 @@ class ServerMessageParser:
             content = error_message
         else:
             response = self.info_response
-            content = "Logged in users:\n"
-            for username in usernames:
-                content += ("- " + username + "\n")
+            content = self.help_message
         return self.encode_response_to_json(self.server_name, response, content)
 
-    def get_help_response_json(self, verified_request):
+    def get_direct_message_response_json(self, verified_request, content, sender):
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            return self.encode_response_to_json(self.server_name, self.error_response, error_message)
+        recipient, message = self.split_direct_message(content)
+        return self.encode_response_to_json(sender, self.message_response, message, recipient=recipient)
+
+    @staticmethod
+    def split_direct_message(content):
+        # Returns the recipient and the message of a 'dm' request
+        recipient, message = content.split(' ', 1)
+        return recipient, message
+
+    def get_join_response_json(self, verified_request, room):
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            response = self.error_response
+            content = error_message
+        else:
+            response = self.info_response
+            content = "You are now in the room " + room + ". Messages you send go to this room."
+        return self.encode_response_to_json(self.server_name, response, content)
+
+    def get_leave_response_json(self, verified_request, room):
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            response = self.error_response
+            content = error_message
+        else:
+            response = self.info_response
+            content = "You left the room " + room + "."
+        return self.encode_response_to_json(self.server_name, response, content)
+
+    def get_rooms_response_json(self, session, verified_request):
         valid = verified_request[0]
         error_message = verified_request[1]
         if not valid:
@@ -167,17 +401,88 @@ class ServerMessageParser:
             content = error_message
         else:
             response = self.info_response
-            content = 'Possible requests:\n' \
-                '- login <username>       3-20 normal characters (a-z, A-Z, 0-9, _)\n' \
-                '- logout                 logout from the chat\n' \
-                '- msg <content>          send a message to all logged in users\n' \
-                '- names                  get a list of all logged in users\n' \
-                '- help                   get a list of possible actions\n'
+            content = "Rooms:\n"
+            for room, member_count in self.server.get_room_sizes():
+                content += "- " + room + " (" + str(member_count) + " users)"
+                if room == session.active_room:
+                    content += " <- current room"
+                elif room in session.rooms:
+                    content += " <- joined"
+                content += "\n"
         return self.encode_response_to_json(self.server_name, response, content)
 
-    def get_history_response_json(self):
-        is_log, messages = self.get_log_messages(self.client_handler_class.server.log_file_path)
-        return is_log, self.encode_response_to_json(self.server_name, self.history_response, messages)
+    def get_history_response_json(self, session):
+        """
+        The last messages of the rooms of the session, sent on login. When a lot of clients
+        log in at once they are all in the default room and get the same messages, so the
+        response is reused until the history changes, and it is encoded and compressed once
+        for all of them (see Response.py)
+        """
+        last_seq = self.server.get_last_history_seq()
+        rooms = frozenset(session.rooms)
+        key = (self.server.history_store.first_seq(), last_seq, self.server.history_replay_limit, rooms)
+        cached_key, cached_history = self.history_replay
+        if cached_key == key:
+            return cached_history
+        is_log, messages = self.get_log_messages(rooms, self.server.history_replay_limit, last_seq=last_seq)
+        history = is_log, self.encode_response_to_json(self.server_name, self.history_response, messages)
+        self.history_replay = key, history
+        return history
+
+    def get_missed_messages_response_json(self, session, last_seq):
+        """
+        The messages sent to the rooms of a resumed session after last_seq, the last message
+        the client received. Sent as a history response, with 'resumed' set in the content.
+        Messages sent while the session was restored may also have been received as they
+        were sent. At most history_page_limit messages are read, and 'more' is True if
+        older messages were left out.
+        """
+        end_seq = self.server.get_last_history_seq()
+        start_seq = max(last_seq + 1, end_seq - self.server.history_page_limit + 1,
+                        self.server.history_store.first_seq())
+        log_messages = self.server.read_history(start_seq, end_seq - start_seq + 1)
+        messages = [self.get_log_message_content(seq, record)
+                    for seq, timestamp, record in log_messages if record.get('room') in session.rooms]
+        more = start_seq > last_seq + 1 and len(messages) > 0
+        return self.encode_response_to_json(self.server_name, self.history_response,
+                                            {'messages': messages, 'more': more, 'resumed': True})
+
+    def get_history_page_response_json(self, session, verified_request, content):
+        # Messages of the rooms of the session before a sequence number, requested with
+        # 'history <before-seq> <count>'. 'history' without content gives the last messages, as on login
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            return self.encode_response_to_json(self.server_name, self.error_response, error_message)
+        if content == 'None':
+            is_log, messages = self.get_log_messages(session.rooms, self.server.history_replay_limit)
+        else:
+            before_seq, count = [int(value) for value in content.split()]
+            is_log, messages = self.get_log_messages(session.rooms, count, before_seq)
+        return self.encode_response_to_json(self.server_name, self.history_response, messages)
+
+
+    def get_search_response_json(self, session, verified_request, content):
+        """
+        The last messages of the rooms of the session matching a 'search' request, oldest first:
+            {
+                'query': the query as sent by the client
+                'messages': [{'seq', 'timestamp', 'sender', 'content', 'room'}, ...]
+                'total': the number of matching messages, also those not sent
+            }
+        """
+        valid = verified_request[0]
+        error_message = verified_request[1]
+        if not valid:
+            return self.encode_response_to_json(self.server_name, self.error_response, error_message)
+        words, sender, room, after, before = parse_query(content)
+        search_index = self.server.search_index
+        seqs, total = search_index.search(words, sender, room, after, before, self.server.search_result_limit,
+                                          session.rooms)
+        messages = [self.get_log_message_content(seq, record)
+                    for seq, timestamp, record in search_index.read_messages(seqs)]
+        content = {'query': content, 'messages': messages, 'total': total}
+        return self.encode_response_to_json(self.server_name, self.search_response, content)
 
 
     """
@@ -188,34 +493,73 @@ class ServerMessageParser:
         Respond with tuple (True, "") or (False, "error message")
     """
 
-    def verify_login_request(self, payload):
+    def verify_login_request(self, session, payload):
         # Check if username contains only allowed characters
         # Check if username is not taken
         # Respond with tuple (True, "") or (False, "error message")
         username = payload['content']
+        options_error_message = self.verify_session_options(payload)
         valid = True
         error_message = ""
-        username_taken = False
-        for client in self.server.logged_in_clients:
-            # Checking for valid usernames
-            if username == client:
-                username_taken = True
-        if self.client_handler_class.logged_in:
+        if session.logged_in:
             valid = False
             error_message = "You are already logged in."
         elif len(username) < 3 or len(username) > 20 or not re.match("^[a-zA-Z0-9_]*$", username):
             valid = False
             error_message = "If you are trying to log in, enter 'login <username>.'\n" \
                             "<username> must be between 3 and 20 normal characters. [a-z, A-Z, 0-9, _]"
-        elif username_taken:
+        elif options_error_message:
+            valid = False
+            error_message = options_error_message
+        # With several worker processes, the username is reserved for this client by the claim
+        elif not self.server.claim_username(username):
             valid = False
             error_message = "That username has already been taken. Try another one."
         return valid, error_message
 
-    def verify_logout_request(self, payload):
+    def verify_resume_request(self, session, payload):
+        # Returns (valid, error message, the suspended session as (username, rooms, active room))
+        values = payload['content'].split()
+        options_error_message = self.verify_session_options(payload)
+        valid = False
+        resumed_session = None
+        if session.logged_in:
+            error_message = "You are already logged in."
+        elif not len(values) == 2 or not re.match("^[0-9a-f]+$", values[0]) \
+                or not re.match("^[0-9]+$", values[1]):
+            error_message = "Enter 'resume <token> <last-seq>' to continue a session after the connection was lost."
+        elif options_error_message:
+            error_message = options_error_message
+        else:
+            resumed_session = self.server.resume_session(values[0])
+            if resumed_session is None:
+                error_message = "The session can not be resumed, as it expired or the user logged in again. " \
+                                "Enter 'login <username>' to log in."
+            else:
+                valid = True
+                error_message = ""
+                resumed_session = tuple(resumed_session)
+        return valid, error_message, resumed_session
+
+    @staticmethod
+    def verify_session_options(payload):
+        # Returns an error message if the encoding or compression of a login or resume is not known
+        if payload.get('encoding', JSON) not in ENCODINGS:
+            return "The encoding must be one of: " + ", ".join(ENCODINGS) + "."
+        if payload.get('compression', NO_COMPRESSION) not in COMPRESSIONS:
+            return "The compression must be one of: " + ", ".join(COMPRESSIONS) + "."
+        return ""
+
+    @staticmethod
+    def verify_pong_request(session, payload):
+        if not payload['content'] == 'None':
+            return False, "A 'pong' is sent without content, as the answer to a 'ping'."
+        return True, ""
+
+    def verify_logout_request(self, session, payload):
         # Should return false if there is actual content attached
         # with the "logout" keyword
-        if self.client_handler_class.logged_in:
+        if session.logged_in:
             valid = True
             error_message = ""
             if not payload['content'] == 'None':
@@ -226,19 +570,22 @@ class ServerMessageParser:
             error_message = self.login_error_message
         return valid, error_message
 
-    def verify_msg_request(self, payload):
-        if self.client_handler_class.logged_in:
+    def verify_msg_request(self, session, payload):
+        if session.logged_in:
             valid = True
             error_message = ""
+            if session.active_room is None:
+                valid = False
+                error_message = "You are not in a room. Enter 'join <room>' to join one."
         else:
             valid = False
             error_message = self.login_error_message
         return valid, error_message
 
-    def verify_names_request(self, payload):
+    def verify_names_request(self, session, payload):
         # Should return false if there is actual content attached
         # with the "names" keyword
-        if self.client_handler_class.logged_in:
+        if session.logged_in:
             valid = True
             error_message = ""
             if not payload['content'] == 'None':
@@ -249,7 +596,121 @@ class ServerMessageParser:
             error_message = self.login_error_message
         return valid, error_message
 
-    def verify_help_request(self, payload):
+    def verify_history_request(self, session, payload):
+        # The content must be 'None' or two positive numbers: '<before-seq> <count>'
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            values = payload['content'].split()
+            if payload['content'] == 'None':
+                pass
+            elif not len(values) == 2 or not all(re.match("^[0-9]+$", value) and int(value) > 0 for value in values):
+                valid = False
+                error_message = "Enter 'history' to get older messages from the chat history, " \
+                                "or 'history <before-seq> <count>'."
+            elif int(values[1]) > self.server.history_page_limit:
+                valid = False
+                error_message = "At most " + str(self.server.history_page_limit) + \
+                                " messages can be requested at a time."
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    def verify_search_request(self, session, payload):
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            try:
+                parse_query(payload['content'])
+            except ValueError as error:
+                valid = False
+                error_message = error.args[0]
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    def verify_dm_request(self, session, payload):
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            values = payload['content'].split(' ', 1)
+            if not len(values) == 2 or len(values[1].strip()) == 0:
+                valid = False
+                error_message = "If you are trying to send a direct message, enter 'dm <user> <content>'."
+            elif not self.server.is_logged_in(values[0]):
+                valid = False
+                error_message = self.user_not_logged_in_message(values[0])
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    @staticmethod
+    def user_not_logged_in_message(username):
+        return username + " is not logged in. Enter 'names' for a list of logged in users."
+
+    def verify_join_request(self, session, payload):
+        room = payload['content']
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            if not self.is_valid_room_name(room):
+                valid = False
+                error_message = "If you are trying to join a room, enter 'join <room>'.\n" \
+                                "<room> must be between 3 and 20 normal characters. [a-z, A-Z, 0-9, _]"
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    def verify_leave_request(self, session, payload):
+        room = payload['content']
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            if room not in session.rooms:
+                valid = False
+                error_message = "You are not in a room called '" + room + "'. Enter 'rooms' to see your rooms."
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    def verify_presence_request(self, session, payload):
+        # Should return false if there is actual content attached
+        # with the "presence" keyword
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            if not payload['content'] == 'None':
+                valid = False
+                error_message = "Enter 'presence' without additional content to follow who logs in and out."
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    def verify_rooms_request(self, session, payload):
+        # Should return false if there is actual content attached
+        # with the "rooms" keyword
+        if session.logged_in:
+            valid = True
+            error_message = ""
+            if not payload['content'] == 'None':
+                valid = False
+                error_message = "Enter 'rooms' without additional content to get a list of rooms."
+        else:
+            valid = False
+            error_message = self.login_error_message
+        return valid, error_message
+
+    @staticmethod
+    def is_valid_room_name(room):
+        return 3 <= len(room) <= 20 and re.match("^[a-zA-Z0-9_]*$", room)
+
+    def verify_help_request(self, session, payload):
         # Should return false if there is actual content attached
         # with the "help" keyword
         valid = True
@@ -281,18 +742,79 @@ class ServerMessageParser:
     def is_names(self, request):
         return request == self.names_request
 
+    def is_history(self, request):
+        return request == self.history_request
+
+    def is_direct_message(self, request):
+        return request == self.direct_message_request
+
+    def is_presence(self, request):
+        return request == self.presence_request
+
+    def is_search(self, request):
+        return request == self.search_request
+
+    def is_join(self, request):
+        return request == self.join_request
 
+    def is_leave(self, request):
+        return request == self.leave_request
 
+    def is_resume(self, request):
+        return request == self.resume_request
 
+    def is_pong(self, request):
+        return request == self.pong_request
 
-    def get_log_messages(self, path):
-        log = open(path, "r")
-        messages = log.read()
-        log.close()
-        is_log = True
-        if len(messages.strip()) == 0:
-            is_log = False
-        return is_log, messages
+
+
+
+
+    def get_log_messages(self, rooms, count, before_seq=None, last_seq=None):
+        """
+        Reads the last count messages sent to the rooms before before_seq (or up to last_seq),
+        without reading the rest of the history. Returns the content of a history response:
+            {
+                'messages': [{'seq', 'timestamp', 'sender', 'content', 'room'}, ...] oldest first
+                'more': True if there are older messages of the rooms in the history
+            }
+        """
+        first_seq = self.server.history_store.first_seq()
+        if before_seq is None:
+            if last_seq is None:
+                last_seq = self.server.get_last_history_seq()
+            before_seq = last_seq + 1
+        # The messages of the rooms are found with the search index, so a quiet room does not
+        # cost a scan of the history. The last messages may not be indexed yet, and are filtered
+        seqs, more, indexed_seq = self.server.search_index.find_in_rooms(rooms, before_seq, count)
+        start_seq = max(indexed_seq + 1, first_seq)
+        log_messages = []
+        if start_seq < before_seq:
+            log_messages = [message for message in self.server.read_history(start_seq, before_seq - start_seq)
+                            if message[2].get('room') in rooms]
+        # Only the indexed messages that fit in the page are read
+        indexed_count = max(count - len(log_messages), 0)
+        more = more or len(seqs) > indexed_count or len(log_messages) > count
+        indexed_messages = []
+        for seq in seqs[max(len(seqs) - indexed_count, 0):]:
+            # The message may have been deleted since it was found
+            indexed_messages.extend(self.server.read_history(seq, 1))
+        messages = [self.get_log_message_content(seq, record)
+                    for seq, timestamp, record in (indexed_messages + log_messages)[-count:]]
+        is_log = len(messages) > 0
+        return is_log, {'messages': messages, 'more': more and is_log}
+
+    @staticmethod
+    def get_log_message_content(seq, record):
+        # A message from the history, as sent in history and search responses
+        return \
+            {
+                'seq': seq,
+                'timestamp': record['timestamp'],
+                'sender': record['sender'],
+                'content': record['content'],
+                'room': record.get('room')
+            }
 
 
     """
@@ -305,70 +827,39 @@ class ServerMessageParser:
             'response': <response type>
             'content': the content of the response displayed to the client user
         }
-    """
 
-    @staticmethod
-    def encode_response_to_json(sender, response, content):
-        # Encodes a server respond message into json
-        # Local time in format 'Tue Jan 13 10:17:09 2009'
-        localtime = time.asctime(time.localtime(time.time()))
+        Message responses also include 'room': <the room the message was sent to>,
+        or 'recipient': <the user a direct message was sent to>
 
-        response_message = \
-            {
-                'timestamp': localtime,
-                'sender': sender,
-                'response': response,
-                'content': content
-            }
+        The methods return a Response, which is encoded to json, or to the binary
+        encoding, for each client it is sent to (see Response.py)
+    """
 
-        return json.dumps(response_message)
+    @staticmethod
+    def encode_response_to_json(sender, response, content, room=None, recipient=None):
+        return Response(sender, response, content, room, recipient)
 
     def not_logged_in_json(self):
-        # Local time in format 'Tue Jan 13 10:17:09 2009'
-        localtime = time.asctime(time.localtime(time.time()))
-        response_message = \
-            {
-                'timestamp': localtime,
-                'sender': self.server_name,
-                'response': self.error_response,
-                'content': "You are not logged in. Enter 'login <username>' to log in.\n"
-                           "<username> must be between 3 and 20 normal characters. [a-z, A-Z, 0-9, _]"
-            }
-        return json.dumps(response_message)
+        return self.encode_response_to_json(self.server_name, self.error_response, self.login_error_message)
 
     def request_not_valid_json(self):
-        # Local time in format 'Tue Jan 13 10:17:09 2009'
-        localtime = time.asctime(time.localtime(time.time()))
-        response_message = \
-            {
-                'timestamp': localtime,
-                'sender': self.server_name,
-                'response': self.error_response,
-                'content': "That request is not valid. Enter 'help' for a list of possible actions."
-            }
-        return json.dumps(response_message)
+        return self.encode_response_to_json(self.server_name, self.error_response, self.request_not_valid_message)
 
-    def user_logged_out_json(self, username):
-        # Local time in format 'Tue Jan 13 10:17:09 2009'
-        localtime = time.asctime(time.localtime(time.time()))
-        response_message = \
-            {
-                'timestamp': localtime,
-                'sender': self.server_name,
-                'response': self.info_response,
-                'content': username + " logged out."
-            }
-        return json.dumps(response_message)
+    def rate_limited_json(self):
+        return self.encode_response_to_json(self.server_name, self.error_response, self.rate_limited_message)
 
-    def user_logged_in_json(self):
-        # Local time in format 'Tue Jan 13 10:17:09 2009'
-        localtime = time.asctime(time.localtime(time.time()))
-        response_message = \
-            {
-                'timestamp': localtime,
-                'sender': self.client_handler_class.username,
-                'response': self.info_response,
-                'content': self.client_handler_class.username + " logged in."
-            }
-        return json.dumps(response_message)
+    def ping_json(self):
+        # Sent to a client that sent nothing for a while, which answers with a 'pong' (see IdleReaper.py)
+        return self.encode_response_to_json(self.server_name, self.ping_response, "")
+
+    def user_not_logged_in_json(self, username):
+        return self.encode_response_to_json(self.server_name, self.error_response,
+                                            self.user_not_logged_in_message(username))
+
+    def user_joined_room_json(self, session, room):
+        content = session.username + " joined the room " + room + "."
+        return self.encode_response_to_json(self.server_name, self.info_response, content)
 
+    def user_left_room_json(self, session, room):
+        content = session.username + " left the room " + room + "."
+        return self.encode_response_to_json(self.server_name, self.info_response, content)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class SuspendedSessions:
+
+    """
+    The sessions of clients whose connection was lost, kept until they expire, so the
+    client can resume them with its resume token (see the 'resume' request). Held by
+    the server, or with several workers by the MessageBusHub of the main process, as a
+    client may reconnect to another worker.
+
+    Sessions are kept in the order they were suspended, so the expired ones are always
+    at the front.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # resume token -> (username, rooms, active room, expiry time)
+        self.sessions = OrderedDict()
+
+    def suspend(self, token, username, rooms, active_room, expiry_time):
+        with self.lock:
+            self.remove_expired(time.time())
+            self.sessions[token] = (username, rooms, active_room, expiry_time)
+
+    def resume(self, token):
+        # Returns (username, rooms, active room), or None if there is no session with the token or it expired
+        with self.lock:
+            self.remove_expired(time.time())
+            session = self.sessions.pop(token, None)
+        if session is None:
+            return None
+        return session[:3]
+
+    def remove_expired(self, now):
+        # Must be called with the lock held
+        while self.sessions:
+            token, session = next(self.sessions.iteritems())
+            if session[3] > now:
+                break
+            del self.sessions[token]
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import threading
+
+"""
+Hashed timer wheel, for timers that are added and cancelled far more often than
+they fire (e.g. an idle timeout for every connection).
+
+The wheel has slot_count slots of tick seconds each, and a timer is kept in the slot
+of its deadline. Adding and cancelling a timer is O(1), and expire() only looks at
+the slots of the ticks that passed, so a tick costs the same with ten or with tens
+of thousands of timers. Timers fire at most one tick late. A timer more than a full
+turn of the wheel away stays in its slot until the turn it is due.
+"""
+
+
+class TimerWheel:
+
+    def __init__(self, now, tick=1.0, slot_count=512):
+        self.tick = tick
+        self.lock = threading.Lock()
+        # Every slot maps an item to its deadline
+        self.slots = [{} for _ in xrange(slot_count)]
+        # item -> the slot it is in, so it can be cancelled
+        self.item_slots = {}
+        # The last tick whose slot was expired
+        self.last_tick = int(now / tick) - 1
+
+    def schedule(self, item, deadline):
+        # Adds a timer for the item, or moves it if it already has one
+        with self.lock:
+            self.remove(item)
+            # A slot that was already expired is only looked at again after a full turn
+            tick = max(int(deadline / self.tick), self.last_tick + 1)
+            slot = tick % len(self.slots)
+            self.slots[slot][item] = deadline
+            self.item_slots[item] = slot
+
+    def cancel(self, item):
+        with self.lock:
+            self.remove(item)
+
+    def remove(self, item):
+        # Must be called with the lock held
+        slot = self.item_slots.pop(item, None)
+        if slot is not None:
+            del self.slots[slot][item]
+
+    def expire(self, now):
+        """
+        Removes and returns the items whose deadline has passed. Only the slots of the
+        ticks that ended since the last call are looked at (at most one full turn).
+        """
+        expired = []
+        with self.lock:
+            last_tick = int(now / self.tick) - 1
+            for tick in xrange(self.last_tick + 1, min(last_tick, self.last_tick + len(self.slots)) + 1):
+                timers = self.slots[tick % len(self.slots)]
+                for item, deadline in timers.items():
+                    if deadline <= now:
+                        del timers[item]
+                        del self.item_slots[item]
+                        expired.append(item)
+            self.last_tick = max(self.last_tick, last_tick)
+        return expired
+
+    def __len__(self):
+        return len(self.item_slots)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+class TokenBucket(object):
+
+    """
+    Allows rate actions per second on average, and bursts of up to burst actions.
+    The bucket holds up to burst tokens, is refilled with rate tokens per second,
+    and every action takes a token. The bucket is refilled when a token is taken,
+    so an idle bucket costs nothing.
+    Not thread safe, see RateLimiter.py
+    """
+
+    # There is a bucket for every connection
+    __slots__ = ('rate', 'burst', 'tokens', 'last_time')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.last_time = time.time()
+
+    def take(self, now=None):
+        # Returns False if there is no token left
+        if now is None:
+            now = time.time()
+        elapsed = now - self.last_time
+        self.last_time = now
+        # The clock may be set back
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False